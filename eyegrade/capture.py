@@ -17,6 +17,7 @@
 #
 
 import cv2
+import numpy as np
 
 from . import geometry
 from . import utils
@@ -85,7 +86,8 @@ class ExamDecisions:
 class ExamCapture:
     """Capture of an exam, including the image, cell geometry and drawing."""
 
-    def __init__(self, image, answer_cells, id_cells, progress=1.0):
+    def __init__(self, image, answer_cells, id_cells, progress=1.0,
+                 image_drawn=None, image_reference=None):
         """Creates a new ExamCapture object.
 
         `image`: original capture of the exam (as captured by opencv);
@@ -97,10 +99,19 @@ class ExamCapture:
                     left to right).
         `progress`: progress ratio of the capture. Set 1.0 for exams in which
                     all the features have been detected.
+        `image_drawn`: optional image of the same size as `image` in which
+                       to draw, instead of allocating a new one.
+        `image_reference`: the frame as the camera captured it, for
+                           detecting whether the exam is removed. Needed
+                           only when `image` has been modified for
+                           debugging (lines drawn, processed image...).
+                           `image` is used by default.
 
         """
         self.image_raw = image
-        self.image_drawn = None
+        self.image_reference = \
+            image_reference if image_reference is not None else image
+        self.image_drawn = image_drawn
         self.answer_cells = answer_cells
         self.id_cells = id_cells
         self.progress = progress
@@ -138,11 +149,17 @@ class ExamCapture:
     def reset_image(self):
         """Resets the drawn image by cloning the original image.
 
-        All the drawings are lost.
+        All the drawings are lost. The drawn image is overwritten
+        if it has the size of the original one.
 
         """
         if self.image_raw is not None:
-            self.image_drawn = self.image_raw.copy()
+            if (self.image_drawn is not None
+                and self.image_drawn.shape == self.image_raw.shape
+                and self.image_drawn is not self.image_raw):
+                np.copyto(self.image_drawn, self.image_raw)
+            else:
+                self.image_drawn = self.image_raw.copy()
 
     def save_image_drawn(self, filename):
         assert self.image_drawn is not None
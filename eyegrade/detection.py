@@ -19,6 +19,11 @@ import math
 import copy
 import sys
 import itertools
+import time
+import json
+import threading
+import contextlib
+import collections
 
 import cv2
 import numpy as np
@@ -54,6 +59,70 @@ param_id_boxes_energy_break = 0.99
 param_id_boxes_min_height = 15
 param_id_boxes_discard_distance = 20
 
+# Parameters for frame-to-frame tracking of the tables
+param_tracking_rho_band = 6
+param_tracking_angles = [-0.015, -0.01, -0.005, 0.0, 0.005, 0.01, 0.015]
+param_tracking_sampling_step = 3
+param_tracking_min_support = 0.5
+param_tracking_plateau = 0.75
+param_tracking_max_failures = 2
+
+# Parameters for the region of interest
+param_roi_margin = 40
+param_roi_margin_ratio = 0.1
+param_roi_bottom_rows = 2.5
+param_roi_id_box_rows = 5
+
+# Parameters for coarse-to-fine line detection. The Hough thresholds
+# are meant for images of about this width:
+param_pyramid_width = 640
+
+# Parameters for the timing statistics of the detection stages
+param_timings_window = 100
+param_timings_percentiles = (50, 90, 99)
+
+# Parameters for the detection of exam removal by frame difference.
+# Frames are compared by correlation over the answer tables, scaled
+# down to this width:
+param_change_width = 80
+param_change_blur = 1.0
+param_change_margin_ratio = 0.1
+param_change_same_correlation = 0.85
+param_change_removed_correlation = 0.4
+
+# Parameters for fitting the grid of the tables to the detected lines.
+# Distances are relative to the spacing of the lines:
+param_grid_tolerance = 0.25
+param_grid_angle_window = 0.04
+param_grid_min_gap = 0.3
+param_grid_min_inliers = 0.6
+
+# Parameters for the contour-based search of the tables. The minimum
+# area of a table is relative to the image, and the areas of the
+# cells to the area of the largest cells of the table:
+param_contour_min_area = 0.002
+param_contour_cell_area = 0.4
+param_contour_full_cell_area = 0.8
+param_contour_min_cells = 0.6
+param_contour_tolerance = 0.3
+
+# Parameters for the rejection of camera frames that cannot contain
+# the tables. Frames are analyzed scaled down to this width:
+param_gate_width = 160
+param_gate_max_motion = 12
+param_gate_edge_magnitude = 40
+param_gate_min_edges = 0.02
+param_gate_orientation_bins = 18
+param_gate_min_orientation = 0.2
+
+# Maximum number of free images of each size kept for reuse
+param_buffer_pool_size = 8
+
+# Parameters for the camera frame grabber
+param_grabber_buffers = 3
+param_grabber_timeout = 1.0
+param_grabber_retry_delay = 0.05
+
 # Other parameters
 param_error_log = 'eyegrade-errors.log'
 param_error_image_pattern = 'error-%s.png'
@@ -75,6 +144,19 @@ class ExamDetector:
         'capture-proc-ipl': None,
         'error-logging': False,
         'logging-dir': '.',
+        'pyramid-lines': False,
+        'multi-threshold': False,
+        'frame-gate': False,
+        'grid-fit': False,
+        'table-engine': 'hough',
+        'timings-file': None,
+        }
+
+    # Methods that search the tables in a frame, by engine name. They
+    # return (lines, axes, corner_matrixes) as `_locate_tables` does.
+    table_engines = {
+        'hough': '_hough_tables',
+        'contours': '_contour_tables',
         }
 
     @classmethod
@@ -84,18 +166,49 @@ class ExamDetector:
     def __init__(self, dimensions, context, options, image_raw=None):
         self.options = options
         self.context = context
+        self.dimensions = dimensions
+        # Images taken from the buffer pool of the context
+        self._buffers = []
+        self.image_raw = None
+        self._own_image_raw = False
+        self.reset(image_raw=image_raw)
+
+    def reset(self, image_raw=None):
+        """Prepares the detector for a new frame.
+
+        The frame is captured as in the constructor, unless
+        `image_raw` is given. The images of the previous frame are
+        released as in `release`.
+
+        """
+        self.release()
+        self.roi = None
+        self.image_proc = None
+        # Seconds spent in each stage of the detection
+        self.timings = collections.OrderedDict()
+        self.status = {'frame': True,
+                       'lines': False,
+                       'boxes': False,
+                       'cells': False,
+                       'infobits': False,
+                       'id-box-hlines': False,
+                       'id-box': False}
+        self.rejection = None
         if image_raw is not None:
             self.image_raw = image_raw
-            self.image_proc = pre_process(self.image_raw)
+            self._pre_process()
         elif not self.options['capture-from-file']:
             self.image_raw = self.context.capture()
-            self.image_proc = pre_process(self.image_raw)
+            self._own_image_raw = self.image_raw is not None
+            self.roi = self.context.roi
+            if self._gate_frame():
+                self._pre_process()
         elif self.options['capture-raw-file'] is not None:
             self.image_raw = \
                         images.load_image(self.options['capture-raw-file'])
             if self.image_raw is None:
                 raise utils.EyegradeException('', key='load_image')
-            self.image_proc = pre_process(self.image_raw)
+            self._pre_process()
         elif self.options['capture-proc-file'] is not None:
             self.image_raw = \
                         images.load_image(self.options['capture-proc-file'])
@@ -105,21 +218,38 @@ class ExamDetector:
             self.image_proc = self.options['capture-proc-ipl']
         else:
             raise Exception('Wrong capture options')
-        self.dimensions = dimensions
-        self.status = {'lines': False,
-                       'boxes': False,
-                       'cells': False,
-                       'infobits': False,
-                       'id-box-hlines': False,
-                       'id-box': False}
-        if self.options['show-image-proc']:
-            self.image_to_show = images.gray_to_rgb(self.image_proc)
+        if self.options['show-image-proc'] and self.image_proc is not None:
+            self._show_image_proc()
         elif self.options['show-lines']:
-            self.image_to_show = self.image_raw.copy()
+            self.image_to_show = self._acquire(self.image_raw.shape)
+            np.copyto(self.image_to_show, self.image_raw)
         else:
             self.image_to_show = self.image_raw
         self.decisions = None
         self.capture = None
+        self.success = False
+        self.tracked = False
+        self.tracked_segments = None
+
+    def release(self):
+        """Returns the images of this detector to the pool of the context.
+
+        They include the captured frame, if the detector captured it
+        from the camera, and the images of its `capture`. Call it
+        only when none of them is going to be used anymore.
+
+        """
+        pool = self.context.buffers
+        for image in self._buffers:
+            pool.release(image)
+        if self._own_image_raw:
+            pool.release(self.image_raw)
+        self._buffers = []
+        self._own_image_raw = False
+        self.image_raw = None
+        self.image_proc = None
+        self.image_to_show = None
+        self.capture = None
 
     def detect_safe(self):
         try:
@@ -129,6 +259,7 @@ class ExamDetector:
             self.status['cells'] = False
             self.status['infobits'] = False
             self.context.notify_failure()
+            self.context.reset_tracking()
             if self.options['error-logging']:
                 exc_type, exc_value, exc_traceback = sys.exc_info()
                 self._write_error_trace(exc_type, exc_value, exc_traceback)
@@ -143,30 +274,16 @@ class ExamDetector:
         id_cells = None
         id_hlines = None
         success = False
-        axes = None
-        lines = detect_lines(self.image_proc,
-                             self.context.get_hough_threshold())
-        if len(lines) >= 2:
-            self.status['lines'] = True
-            axes = detect_boxes(lines, self.dimensions)
-        if axes is None:
-            self.context.next_hough_threshold()
-        else:
-            self.status['boxes'] = True
-            axes = filter_axes(axes, self.dimensions,
-                               images.width(self.image_raw),
-                               images.height(self.image_raw),
-                               self.options['read-id'])
-            corner_matrixes = cell_corners(axes[1][1], axes[0][1],
-                                           images.width(self.image_raw),
-                                           images.height(self.image_raw),
-                                           self.dimensions)
+        lines, axes, corner_matrixes = self._locate_tables()
+        if axes is not None:
             if len(corner_matrixes) > 0:
                 self.status['cells'] = True
-                answer_cells = self._answer_cells_geometry(corner_matrixes)
-                answers = self._decide_cells(answer_cells)
+                with self._timing('classify-cells'):
+                    answer_cells = self._answer_cells_geometry(corner_matrixes)
+                    answers = self._decide_cells(answer_cells)
                 if self.options['infobits']:
-                    bits = read_infobits(self.image_proc, corner_matrixes)
+                    with self._timing('infobits'):
+                        bits = read_infobits(self.image_proc, corner_matrixes)
                     if bits is not None:
                         self.status['infobits'] = True
                         success = True
@@ -175,23 +292,34 @@ class ExamDetector:
                 else:
                     success = True
                 if success and self.options['read-id']:
-                    id_hlines, id_cells = \
-                        id_boxes_geometry(self.image_proc,
-                                          self.options['id-num-digits'],
-                                          axes[1][1], self.dimensions)
+                    with self._timing('id-geometry'):
+                        id_hlines, id_cells = \
+                            id_boxes_geometry(self.image_proc,
+                                              self.options['id-num-digits'],
+                                              axes[1][1], self.dimensions)
                     if id_hlines:
                         self.status['id-box-hlines'] = True
                     if not id_cells:
                         success = False
                     else:
                         self.status['id-box'] = True
-                        detected_id, id_scores = self._detect_id(id_cells)
+                        with self._timing('id-ocr'):
+                            detected_id, id_scores = self._detect_id(id_cells)
                 else:
                     id_cells = []
         if success:
             self.context.notify_success()
-        else:
+        elif self.status['frame']:
+            # Rejected frames say nothing about the Hough threshold
             self.context.notify_failure()
+        if self.context.tracking:
+            self._update_tracking(success, corner_matrixes, id_hlines,
+                                  id_cells)
+        if self.context.roi_detection and self.status['cells']:
+            self.context.roi = region_of_interest(corner_matrixes, id_cells,
+                                                  self.options['read-id'],
+                                                  images.width(self.image_raw),
+                                                  images.height(self.image_raw))
         # Draw debug information on the capture
         if self.options['show-lines']:
             if self.status['cells']:
@@ -214,11 +342,225 @@ class ExamDetector:
             self._draw_status_flags()
         self.decisions = capture.ExamDecisions(success, answers, detected_id,
                                                id_scores, infobits=bits)
-        self.capture = capture.ExamCapture(self.image_to_show, answer_cells,
-                                           id_cells, self._compute_progress())
+        self.capture = self._new_capture(answer_cells, id_cells,
+                                         self._compute_progress())
         self.success = success
+        self.context.add_timings(self.timings)
+        if self.options['timings-file'] is not None:
+            self._dump_timings()
         return success
 
+    def _locate_tables(self):
+        """Finds the lines of the answer tables and their cell corners.
+
+        The tables are first followed from their position in the
+        previous frame when the context tracks them, and searched with
+        the engine of the 'table-engine' option only when that is not
+        possible. Returns (lines, axes, corner_matrixes). `axes` is
+        None when no boxes are found.
+
+        """
+        if not self.status['frame']:
+            return [], None, []
+        iwidth = images.width(self.image_raw)
+        iheight = images.height(self.image_raw)
+        if self.context.tracked_segments is not None:
+            with self._timing('tracking'):
+                axes, segments = track_axes(self.image_proc,
+                                            self.context.tracked_segments)
+            if axes is not None:
+                with self._timing('cell-corners'):
+                    corner_matrixes = cell_corners(axes[1][1], axes[0][1],
+                                                   iwidth, iheight,
+                                                   self.dimensions)
+                if len(corner_matrixes) > 0:
+                    self.tracked = True
+                    self.tracked_segments = segments
+                    self.status['lines'] = True
+                    self.status['boxes'] = True
+                    return axes[0][1] + axes[1][1], axes, corner_matrixes
+        lines, axes, corner_matrixes = self._search_tables()
+        if len(corner_matrixes) == 0 and self.roi is not None:
+            # The sheet may have moved out of the region of interest:
+            # forget it and retry with the whole frame
+            self.context.roi = None
+            self.roi = None
+            self._pre_process()
+            if self.options['show-image-proc']:
+                self._show_image_proc()
+            self.status['lines'] = False
+            self.status['boxes'] = False
+            lines, axes, corner_matrixes = self._search_tables()
+        return lines, axes, corner_matrixes
+
+    def _search_tables(self):
+        engine = self.options['table-engine']
+        if engine not in self.table_engines:
+            raise ValueError('Unknown table engine: {0}'.format(engine))
+        return getattr(self, self.table_engines[engine])()
+
+    def _hough_tables(self):
+        if self.options['pyramid-lines']:
+            return self._pyramid_tables()
+        iwidth = images.width(self.image_raw)
+        iheight = images.height(self.image_raw)
+        if self.options['multi-threshold']:
+            return self._search_thresholds(self.image_proc, self.roi,
+                                           iwidth, iheight)
+        with self._timing('hough'):
+            lines = detect_lines(self.image_proc,
+                                 self.context.get_hough_threshold(),
+                                 roi=self.roi)
+        axes, corner_matrixes = self._tables_from_lines(lines, iwidth, iheight)
+        if axes is None and self.roi is None:
+            self.context.next_hough_threshold()
+        return lines, axes, corner_matrixes
+
+    def _contour_tables(self):
+        """Searches the tables in the contours of the thresholded image.
+
+        See `detect_tables_contours`. The Hough threshold of the
+        context is not used. The lines returned are those of the axes.
+
+        """
+        with self._timing('contours'):
+            axes, corner_matrixes = detect_tables_contours(self.image_proc,
+                                                           self.dimensions)
+        if axes is None:
+            return [], axes, corner_matrixes
+        self.status['lines'] = True
+        self.status['boxes'] = True
+        if not check_corners(corner_matrixes, images.width(self.image_raw),
+                             images.height(self.image_raw)):
+            corner_matrixes = []
+        return axes[0][1] + axes[1][1], axes, corner_matrixes
+
+    def _pyramid_tables(self):
+        """Coarse-to-fine version of `_hough_tables`.
+
+        The tables are searched in a version of the image scaled down
+        to `param_pyramid_width`, trying in the same frame all the
+        Hough thresholds until one of them works. Their lines are then
+        re-fitted at full resolution near the scaled up coarse lines.
+
+        """
+        iwidth = images.width(self.image_raw)
+        iheight = images.height(self.image_raw)
+        scale = min(1.0, param_pyramid_width / iwidth)
+        if scale < 1.0 and len(self.image_raw.shape) == 3:
+            swidth = int(round(iwidth * scale))
+            sheight = int(round(iheight * scale))
+            small_raw = cv2.resize(self.image_raw, (swidth, sheight),
+                                   dst=self._acquire((sheight, swidth, 3)),
+                                   interpolation=cv2.INTER_AREA)
+            if self.roi is not None:
+                small_roi = tuple(int(round(c * scale)) for c in self.roi)
+            else:
+                small_roi = None
+            with self._timing('pre-process'):
+                small_proc = pre_process(small_raw, roi=small_roi,
+                                         dst=self._acquire((sheight, swidth)),
+                                         gray=self._acquire((sheight, swidth)))
+        else:
+            scale = 1.0
+            swidth, sheight = iwidth, iheight
+            small_roi = self.roi
+            small_proc = self.image_proc
+        lines, axes, corner_matrixes = \
+            self._search_thresholds(small_proc, small_roi, swidth, sheight)
+        lines = [(rho / scale, theta) for rho, theta in lines]
+        if len(corner_matrixes) == 0 or scale == 1.0:
+            return lines, axes, corner_matrixes
+        with self._timing('refine-axes'):
+            axes = refine_axes(self.image_proc, axes, corner_matrixes,
+                               scale, self.dimensions)
+        with self._timing('cell-corners'):
+            corner_matrixes = cell_corners(axes[1][1], axes[0][1],
+                                           iwidth, iheight, self.dimensions)
+        return lines, axes, corner_matrixes
+
+    def _search_thresholds(self, image, roi, iwidth, iheight):
+        """Searches the tables with all the candidate Hough thresholds.
+
+        The thresholds are tried in the same frame, in the order of
+        `hough_threshold_candidates`, until one of them works. The
+        context then moves to that threshold. The Hough transform runs
+        only once for all of them.
+
+        """
+        lines = []
+        axes = None
+        corner_matrixes = []
+        candidates = self.context.hough_threshold_candidates()
+        with self._timing('hough'):
+            candidate_lines = detect_lines_thresholds(
+                image, [self.context.hough_thresholds[idx]
+                        for idx in candidates],
+                roi=roi)
+        for idx, idx_lines in zip(candidates, candidate_lines):
+            if len(idx_lines) < 2:
+                continue
+            lines = idx_lines
+            axes, corner_matrixes = self._tables_from_lines(lines, iwidth,
+                                                            iheight)
+            if len(corner_matrixes) > 0:
+                self.context.set_hough_threshold_idx(idx)
+                break
+        return lines, axes, corner_matrixes
+
+    def _tables_from_lines(self, lines, iwidth, iheight):
+        """Returns the axes and cell corners of the tables in the lines.
+
+        With the 'grid-fit' option, the layout of the tables is first
+        fitted to the lines with `fit_grid`. The heuristics of
+        `detect_boxes` and `filter_axes` are used when that option is
+        off or the fit fails. `axes` is None if no boxes are found.
+
+        """
+        axes = None
+        corner_matrixes = []
+        if len(lines) < 2:
+            return axes, corner_matrixes
+        self.status['lines'] = True
+        if self.options['grid-fit']:
+            with self._timing('fit-grid'):
+                axes = fit_grid(lines, self.dimensions)
+            if axes is not None:
+                self.status['boxes'] = True
+                with self._timing('cell-corners'):
+                    corner_matrixes = cell_corners(axes[1][1], axes[0][1],
+                                                   iwidth, iheight,
+                                                   self.dimensions)
+                if len(corner_matrixes) > 0:
+                    return axes, corner_matrixes
+        with self._timing('detect-boxes'):
+            axes = detect_boxes(lines, self.dimensions)
+        if axes is None:
+            return axes, corner_matrixes
+        self.status['boxes'] = True
+        with self._timing('filter-axes'):
+            axes = filter_axes(axes, self.dimensions, iwidth, iheight,
+                               self.options['read-id'])
+        with self._timing('cell-corners'):
+            corner_matrixes = cell_corners(axes[1][1], axes[0][1],
+                                           iwidth, iheight, self.dimensions)
+        return axes, corner_matrixes
+
+    def _update_tracking(self, success, corner_matrixes, id_hlines, id_cells):
+        """Tells the context which lines to follow in the next frame."""
+        segments = None
+        if self.status['cells']:
+            if id_cells:
+                id_lines = id_box_segments(id_hlines, id_cells)
+            elif self.tracked and self.options['read-id']:
+                # Keep following the id box lines re-fitted in this frame
+                id_lines = self.tracked_segments[1][:2]
+            else:
+                id_lines = []
+            if id_lines or not self.options['read-id']:
+                segments = tracking_segments(corner_matrixes, id_lines)
+        self.context.update_tracking(segments, success, self.tracked)
+
     def detect_manual(self, manual_points):
         """Called when cell corners are obtained from manual detection."""
         bits = None
@@ -226,7 +568,7 @@ class ExamDetector:
         answers = None
         answer_cells = None
         corner_matrixes = process_box_corners(manual_points, self.dimensions)
-        if corner_matrixes != []:
+        if len(corner_matrixes) > 0:
             self.status['cells'] = True
             answer_cells = self._answer_cells_geometry(corner_matrixes)
             answers = self._decide_cells(answer_cells)
@@ -242,8 +584,7 @@ class ExamDetector:
         id_scores = None
         self.decisions = capture.ExamDecisions(success, answers, detected_id,
                                                id_scores, infobits=bits)
-        self.capture = capture.ExamCapture(self.image_to_show, answer_cells,
-                                           id_cells, 1.0)
+        self.capture = self._new_capture(answer_cells, id_cells, 1.0)
         self.success = success
         return success
 
@@ -288,9 +629,119 @@ class ExamDetector:
         else:
             traceback.print_exception(exc_type, exc_value, exc_traceback)
 
+    def _pre_process(self):
+        """Thresholds the raw image into `image_proc`.
+
+        Both the result and the intermediate grayscale image are
+        buffers of the pool of the context.
+
+        """
+        with self._timing('pre-process'):
+            shape = self.image_raw.shape[:2]
+            if self.image_proc is None:
+                self.image_proc = self._acquire(shape)
+            gray = self._acquire(shape)
+            pre_process(self.image_raw, roi=self.roi, dst=self.image_proc,
+                        gray=gray)
+            self._release(gray)
+
+    def _gate_frame(self):
+        """Decides whether a camera frame is worth analyzing.
+
+        With the 'frame-gate' option, frames rejected by `gate_frame`
+        get the 'frame' status flag set to False and the reason in
+        `rejection`. The gate is not applied while the tables are
+        being tracked or searched in a region of interest, because
+        they were found in the previous frame. Returns True if the
+        frame has to be analyzed.
+
+        """
+        if (not self.options['frame-gate'] or self.image_raw is None
+            or self.context.tracked_segments is not None
+            or self.roi is not None):
+            self.context.gate_thumbnail = None
+            return True
+        with self._timing('gate'):
+            thumbnail = frame_thumbnail(self.image_raw)
+            self.rejection = gate_frame(thumbnail,
+                                        self.context.gate_thumbnail)
+        self.context.gate_thumbnail = thumbnail
+        self.status['frame'] = self.rejection is None
+        return self.status['frame']
+
+    def _show_image_proc(self):
+        self.image_to_show = self._acquire(self.image_raw.shape[:2] + (3,))
+        cv2.cvtColor(self.image_proc, cv2.COLOR_GRAY2RGB,
+                     dst=self.image_to_show)
+
+    def _new_capture(self, answer_cells, id_cells, progress):
+        if self.image_to_show is not None:
+            image_drawn = self._acquire(self.image_to_show.shape)
+        else:
+            image_drawn = None
+        image_reference = None
+        if (self.image_to_show is not None
+            and self.image_to_show is not self.image_raw):
+            # The image shown has debugging drawings, or is the processed
+            # one: keep the frame as captured for the change detection
+            if len(self.image_raw.shape) == 3:
+                image_reference = images.rgb_to_gray(self.image_raw)
+            else:
+                image_reference = self.image_raw.copy()
+        return capture.ExamCapture(self.image_to_show, answer_cells, id_cells,
+                                   progress, image_drawn=image_drawn,
+                                   image_reference=image_reference)
+
+    def _acquire(self, shape):
+        """Takes an image from the buffer pool of the context."""
+        image = self.context.buffers.acquire(shape)
+        self._buffers.append(image)
+        return image
+
+    def _release(self, image):
+        self._buffers = [b for b in self._buffers if b is not image]
+        self.context.buffers.release(image)
+
+    @contextlib.contextmanager
+    def _timing(self, stage):
+        """Adds the time spent in the block to the timing of `stage`.
+
+        A monotonic clock is used. A stage may run several times in
+        the same frame (e.g. when several Hough thresholds are
+        tried); its times are added up.
+
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] = (self.timings.get(stage, 0.0)
+                                   + time.perf_counter() - start)
+
+    def _dump_timings(self):
+        """Appends the timings of this frame to the timings file.
+
+        Each frame is a JSON object in its own line, with times in
+        milliseconds.
+
+        """
+        record = collections.OrderedDict([
+            ('time', time.time()),
+            ('success', self.success),
+            ('tracked', self.tracked),
+            ('roi', self.roi is not None),
+            ('hough-threshold', self.context.get_hough_threshold()),
+            ('timings', collections.OrderedDict(
+                (stage, 1000 * seconds)
+                for stage, seconds in self.timings.items())),
+        ])
+        with open(self.options['timings-file'], 'a') as file_:
+            file_.write(json.dumps(record) + '\n')
+
     def _answer_cells_geometry(self, corner_matrixes):
         cells = []
         for corners in corner_matrixes:
+            corners = [[tuple(p) for p in row] for row in corners.tolist()]
             for i in range(0, len(corners) - 1):
                 row = []
                 for j in range(0, len(corners[0]) - 1):
@@ -306,15 +757,19 @@ class ExamDetector:
         return cells
 
     def _decide_cells(self, answer_cells):
-        decisions = []
+        # All the cells are classified together with just one SVM call
+        samples = []
         for row in answer_cells:
-            row_decisions = []
             for cell in row:
                 corners = np.array([cell.plu, cell.pru, cell.pld, cell.prd])
-                samp = sample.CrossSampleFromCam(corners, self.image_proc)
-                decision = self.context.crosses_classifier.is_cross(samp)
-                row_decisions.append(decision)
-            decisions.append(decide_answer(row_decisions))
+                samples.append(sample.CrossSampleFromCam(corners,
+                                                         self.image_proc))
+        crosses = self.context.crosses_classifier.is_cross_batch(samples)
+        decisions = []
+        pos = 0
+        for row in answer_cells:
+            decisions.append(decide_answer(crosses[pos:pos + len(row)]))
+            pos += len(row)
         return decisions
 
     def _set_left_to_right(self, cells):
@@ -356,20 +811,20 @@ class ExamDetector:
     def _detect_id(self, id_cells):
         if id_cells is None:
             detected_id = None
-        digits = []
-        id_scores = []
+        samples = []
         for cell in id_cells:
             corners = np.array([cell.plu, cell.pru, cell.pld, cell.prd])
-            samp = sample.DigitSampleFromCam(corners, self.image_proc)
-            digit, scores = self.context.ocr.classify_digit(samp)
-            digits.append(digit)
-            id_scores.append(scores)
+            samples.append(sample.DigitSampleFromCam(corners, self.image_proc))
+        results = self.context.ocr.classify_digit_batch(samples)
+        digits = [digit for digit, scores in results]
+        id_scores = [scores for digit, scores in results]
         detected_id = "".join([str(d) if d is not None else '0' \
                                for d in digits])
         return detected_id, id_scores
 
     def _draw_status_flags(self):
         flags = []
+        flags.append(('F', self.status['frame']))
         flags.append(('L', self.status['lines']))
         flags.append(('B', self.status['boxes']))
         flags.append(('C', self.status['cells']))
@@ -394,9 +849,8 @@ class ExamDetector:
 
     def _draw_cell_corners(self, corner_matrixes):
         for corners in corner_matrixes:
-            for h in corners:
-                for c in h:
-                    images.draw_point(self.image_to_show, c)
+            for c in corners.reshape(-1, 2).tolist():
+                images.draw_point(self.image_to_show, tuple(c))
 
 
 class ExamDetectorContext:
@@ -404,13 +858,22 @@ class ExamDetectorContext:
         ExamCapture objects.
 
     """
-    def __init__(self, camera_id=-1, fixed_hough_threshold=None):
+    def __init__(self, camera_id=-1, fixed_hough_threshold=None,
+                 tracking=False, roi_detection=False):
         """Creates a new camera capture context.
 
         A default initial camera can be specified with `camera_id` (an
         integer). Pass -1 (the default value) for letting this object
         choose the first available camera.
 
+        If `tracking` is True, the answer tables found in a frame are
+        followed in the next frames by re-fitting their lines locally,
+        and the Hough transform is run only when that fails.
+
+        If `roi_detection` is True, camera frames are thresholded and
+        searched only around the area in which the tables were found
+        in the last frame, as long as they keep being found there.
+
         """
         if not fixed_hough_threshold:
             self.hough_thresholds = param_hough_thresholds
@@ -420,7 +883,17 @@ class ExamDetectorContext:
         self.failures_in_a_row = 0
         self.camera = None
         self.camera_id = camera_id
+        self.grabber = None
         self.threshold_locked = False
+        self.tracking = tracking
+        self.tracked_segments = None
+        self.tracking_failures = 0
+        self.roi_detection = roi_detection
+        self.roi = None
+        # Scaled down previous frame, for the frame gate
+        self.gate_thumbnail = None
+        self.timings = collections.OrderedDict()
+        self.buffers = BufferPool()
         self.ocr = classifiers.DefaultDigitClassifier()
         self.crosses_classifier = classifiers.DefaultCrossesClassifier()
 
@@ -448,6 +921,8 @@ class ExamDetectorContext:
                     self.camera = self._try_camera(previous_camera)
                     if self.camera is None:
                         self.camera, self.camera_id = self._try_next_camera(-1)
+        if self.camera is not None and self.grabber is None:
+            self._start_grabber()
         return self.camera is not None
 
     def current_camera_id(self):
@@ -466,10 +941,12 @@ class ExamDetectorContext:
         """
 
         if self.camera is not None:
+            self._stop_grabber()
             del self.camera
         camera, camera_id = self._try_next_camera(self.camera_id)
         if camera is not None:
             self.camera, self.camera_id = camera, camera_id
+            self._start_grabber()
             return True
         else:
             return False
@@ -484,6 +961,24 @@ class ExamDetectorContext:
     def get_hough_threshold(self):
         return self.hough_thresholds[self.hough_thresholds_idx]
 
+    def hough_threshold_candidates(self):
+        """Indices of the thresholds to try, starting with the current one.
+
+        The rest of them follow in order of closeness to the current
+        one. Only the current one is returned if it is locked.
+
+        """
+        idx = self.hough_thresholds_idx
+        if self.threshold_locked:
+            return [idx]
+        return sorted(range(len(self.hough_thresholds)),
+                      key=lambda i: (abs(i - idx), i))
+
+    def set_hough_threshold_idx(self, idx):
+        if not self.threshold_locked and idx != self.hough_thresholds_idx:
+            self.hough_thresholds_idx = idx
+            self.failures_in_a_row = 0
+
     def next_hough_threshold(self):
         if not self.threshold_locked:
             self.hough_thresholds_idx = ((self.hough_thresholds_idx + 1)
@@ -498,55 +993,97 @@ class ExamDetectorContext:
     def notify_success(self):
         self.failures_in_a_row = 0
 
+    def update_tracking(self, segments, success, tracked):
+        """Stores the table lines to follow in the next frame.
+
+        `segments` are the ones computed by `tracking_segments` from
+        the current frame, or None if the tables were not found.
+        Tracking is abandoned after several tracked frames in a row
+        that do not produce a successful detection.
+
+        """
+        if success or not tracked:
+            self.tracking_failures = 0
+        else:
+            self.tracking_failures += 1
+        if (segments is None
+            or self.tracking_failures >= param_tracking_max_failures):
+            self.tracked_segments = None
+            self.tracking_failures = 0
+        else:
+            self.tracked_segments = segments
+
+    def reset_tracking(self):
+        self.tracked_segments = None
+        self.tracking_failures = 0
+
+    def add_timings(self, timings):
+        """Stores the stage timings of a detector, in seconds.
+
+        Only the last `param_timings_window` times of each stage are
+        kept.
+
+        """
+        for stage, seconds in timings.items():
+            if stage not in self.timings:
+                self.timings[stage] = \
+                    collections.deque(maxlen=param_timings_window)
+            self.timings[stage].append(seconds)
+
+    def timing_percentiles(self, percentiles=param_timings_percentiles):
+        """Returns the percentiles of the recent timings of each stage.
+
+        The result maps stage names to dictionaries that map each
+        percentile to a time in seconds.
+
+        """
+        stats = collections.OrderedDict()
+        for stage, times in self.timings.items():
+            values = np.percentile(np.array(times), percentiles)
+            stats[stage] = collections.OrderedDict(
+                zip(percentiles, values.tolist()))
+        return stats
+
     def close_camera(self):
         """Closes the current camera.
 
         The same camera will be opened again when open_camera() is called.
 
         """
+        self._stop_grabber()
         if self.camera is not None:
             self.camera.release()
         self.camera = None
 
-    def capture(self, clone=False, resize=None):
-        """Returns a capture.
+    def capture(self, resize=None):
+        """Returns the newest frame of the camera.
 
-        If `clone` is True, the image returned is a copy of the
-        original.  Use this option if you plan to modify the image or
-        store it for later, because the buffer of the original image
-        will be reused by OpenCV por the next capture.
+        Frames are decoded continuously by a background thread, so
+        the frame is always a recent one, and never one returned
+        before. The caller owns the image: it is not reused for
+        later frames.
 
         `resize` is a tuple (width, height). If it is not None, then
-        the image is scaled to that size. Scaling implies a new copy
-        regardless the value of `clone`.
+        the image is scaled to that size.
 
         """
         image = None
-        if resize is not None:
-            # The image will be cloned when resizing
-            clone = False
         if self.camera is not None:
-            image = self.capture_image(clone=clone)
+            image = self.grabber.read()
             if image is None:
                 image = np.zeros((480, 640, 3), dtype=np.uint8)
             if resize is not None:
                 image = cv2.resize(image, resize, interpolation=cv2.INTER_AREA)
         return image
 
-    def dump_buffer(self, delay_suffered):
-        if self.camera is not None and delay_suffered > 0.1:
-            frames_to_drop = min(8, int(1 + (delay_suffered - 0.1) / 0.04))
-            for i in range(0, frames_to_drop):
-                self.capture_image(False)
+    def _start_grabber(self):
+        self.grabber = FrameGrabber(self.camera, pool=self.buffers)
+        self.grabber.start()
 
-    def capture_image(self, clone=False):
-        success, image = self.camera.read()
-        if not success:
-            image = None
-        elif clone:
-            return image.copy()
-        else:
-            return image
+    def _stop_grabber(self):
+        if self.grabber is not None:
+            self.grabber.stop()
+            self.grabber = None
 
     def _try_next_camera(self, cur_camera_id):
         camera = None
@@ -591,7 +1128,7 @@ class FalseExamDetectorContext(ExamDetectorContext):
     def close_camera(self):
         self.exams = []
 
-    def capture(self, clone=False, resize=None):
+    def capture(self, resize=None):
         if self.exams:
             exam = self.exams[self.next_exam_idx]
             image = self.session.load_raw_capture(exam.exam_id)
@@ -599,9 +1136,6 @@ class FalseExamDetectorContext(ExamDetectorContext):
             image = None
         return image
 
-    def dump_buffer(self, delay_suffered):
-        pass
-
     def notify_success(self):
         super(FalseExamDetectorContext, self).notify_success()
         self.next_exam_idx += 1
@@ -609,16 +1143,213 @@ class FalseExamDetectorContext(ExamDetectorContext):
             self.next_exam_idx = 0
 
 
-def pre_process(image):
-    gray = images.rgb_to_gray(image)
-    thr = cv2.adaptiveThreshold(gray, 255,
-                                cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-                                cv2.THRESH_BINARY_INV,
-                                param_adaptive_threshold_block_size,
-                                param_adaptive_threshold_offset)
-    return thr
+class BufferPool:
+    """Keeps images of the size of the frames for their reuse.
+
+    Images are taken with `acquire` and given back with `release`
+    when their content is not needed anymore, so that sustained
+    detection does not allocate large images for every frame. Up to
+    `max_free` free images of each shape are kept. It is thread-safe.
+
+    """
+    def __init__(self, max_free=param_buffer_pool_size):
+        self.max_free = max_free
+        self._free = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, shape, dtype=np.uint8):
+        """Returns an image of the given shape, with arbitrary content."""
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self._lock:
+            free = self._free.get(key)
+            if free:
+                return free.pop()
+        return np.empty(shape, dtype=dtype)
+
+    def release(self, image):
+        """Gives back an image. Nobody must use it afterwards."""
+        if image is None:
+            return
+        key = (image.shape, image.dtype.str)
+        with self._lock:
+            free = self._free.setdefault(key, [])
+            if (len(free) < self.max_free
+                and not any(other is image for other in free)):
+                free.append(image)
+
+
+class FrameGrabber:
+    """Decodes camera frames continuously in a background thread.
+
+    Frames are decoded into a small ring of buffers. `read` hands out
+    the newest one without copying it: the buffer leaves the ring,
+    and a new one is taken for it when its slot is next used, from
+    `pool` (a `BufferPool`) if given. Buffers of frames nobody reads
+    are reused to decode later frames.
 
-def detect_lines(image, hough_threshold):
+    """
+    def __init__(self, camera, num_buffers=param_grabber_buffers, pool=None):
+        self.camera = camera
+        self.pool = pool
+        self._shape = None
+        self._buffers = [None] * num_buffers
+        self._next = 0
+        self._latest = None
+        self._running = False
+        self._thread = None
+        self._condition = threading.Condition()
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the thread. Returns after its last frame is decoded."""
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def read(self, timeout=param_grabber_timeout):
+        """Returns the newest frame not returned before.
+
+        Waits for the next frame if that one was already returned.
+        Returns None if no frame arrives within `timeout` seconds.
+
+        """
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._latest is not None or not self._running,
+                timeout)
+            if self._latest is None:
+                return None
+            image = self._buffers[self._latest]
+            self._buffers[self._latest] = None
+            self._latest = None
+            return image
+
+    def _run(self):
+        while self._running:
+            if not self.camera.grab():
+                time.sleep(param_grabber_retry_delay)
+                continue
+            # Only this thread changes _next, and _latest never
+            # points to the slot being written
+            slot = self._next
+            if (self._buffers[slot] is None and self.pool is not None
+                and self._shape is not None):
+                self._buffers[slot] = self.pool.acquire(self._shape)
+            success, image = self.camera.retrieve(self._buffers[slot])
+            if not success:
+                continue
+            self._shape = image.shape
+            with self._condition:
+                self._buffers[slot] = image
+                self._latest = slot
+                self._next = (slot + 1) % len(self._buffers)
+                self._condition.notify_all()
+
+
+def frame_thumbnail(image, width=param_gate_width):
+    """Returns a scaled down grayscale version of the image."""
+    height = max(1, int(round(width * images.height(image)
+                              / images.width(image))))
+    if len(image.shape) == 3:
+        image = images.rgb_to_gray(image)
+    return cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+
+def gate_frame(thumbnail, previous=None):
+    """Tells whether a frame cannot contain the answer tables.
+
+    `thumbnail` is the frame as returned by `frame_thumbnail`, and
+    `previous` the one of the previous frame, if any. Returns None if
+    the frame may contain the tables. Otherwise, returns the reason:
+    'motion' if the frame changes too much from the previous one, as
+    when a sheet is being moved; 'edges' if it has almost no edges;
+    and 'orientation' if its edges do not follow two perpendicular
+    directions, as the lines of a table do. Blurred frames have their
+    edges in one direction at most.
+
+    """
+    if previous is not None and previous.shape == thumbnail.shape:
+        motion = cv2.absdiff(thumbnail, previous).mean()
+        if motion > param_gate_max_motion:
+            return 'motion'
+    gx = cv2.Sobel(thumbnail, cv2.CV_32F, 1, 0)
+    gy = cv2.Sobel(thumbnail, cv2.CV_32F, 0, 1)
+    magnitude = cv2.magnitude(gx, gy)
+    edges = magnitude > param_gate_edge_magnitude
+    if edges.mean() < param_gate_min_edges:
+        return 'edges'
+    # Share of the edge energy around each orientation, and around
+    # its perpendicular one
+    bins = param_gate_orientation_bins
+    angles = cv2.phase(gx, gy)[edges] % math.pi
+    hist = np.histogram(angles, bins=bins, range=(0, math.pi),
+                        weights=magnitude[edges])[0]
+    hist /= hist.sum()
+    windows = hist + np.roll(hist, 1) + np.roll(hist, -1)
+    perpendicular = np.minimum(windows, np.roll(windows, bins // 2))
+    if perpendicular.max() < param_gate_min_orientation:
+        return 'orientation'
+    return None
+
+def pre_process(image, roi=None, dst=None, gray=None):
+    """Thresholds the image.
+
+    If `roi` (a rectangle x0, y0, x1, y1) is given, only that region
+    is thresholded. The rest of the result is left blank.
+
+    The result is written into `dst` and the grayscale version of the
+    image into `gray`, single channel images of the size of `image`,
+    when they are given. Otherwise, they are allocated.
+
+    """
+    if roi is not None:
+        x0, y0, x1, y1 = roi
+        # Threshold a slightly larger area, so that the pixels of the
+        # region get the same values they would get in the whole image
+        pad = param_adaptive_threshold_block_size // 2
+        px0 = max(0, x0 - pad)
+        py0 = max(0, y0 - pad)
+        px1 = min(images.width(image), x1 + pad)
+        py1 = min(images.height(image), y1 + pad)
+        if dst is None:
+            dst = images.new_image(images.width(image),
+                                   images.height(image), 1)
+        if gray is not None:
+            gray = gray[py0:py1, px0:px1]
+        pre_process(image[py0:py1, px0:px1], dst=dst[py0:py1, px0:px1],
+                    gray=gray)
+        dst[:y0] = 0
+        dst[y1:] = 0
+        dst[:, :x0] = 0
+        dst[:, x1:] = 0
+        return dst
+    gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY, dst=gray)
+    return cv2.adaptiveThreshold(gray, 255,
+                                 cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                 cv2.THRESH_BINARY_INV,
+                                 param_adaptive_threshold_block_size,
+                                 param_adaptive_threshold_offset,
+                                 dst=dst)
+
+def detect_lines(image, hough_threshold, roi=None):
+    """Returns the lines (rho, theta) of the image, sorted by theta.
+
+    If `roi` (a rectangle x0, y0, x1, y1) is given, lines are searched
+    only in that region, but they are returned in the coordinates
+    of the whole image.
+
+    """
+    if roi is not None:
+        x0, y0, x1, y1 = roi
+        return [(rho + x0 * math.cos(theta) + y0 * math.sin(theta), theta)
+                for rho, theta in detect_lines(image[y0:y1, x0:x1],
+                                               hough_threshold)]
     raw_lines = cv2.HoughLines(image, 1, 0.01, hough_threshold)
     if raw_lines is None:
         return []
@@ -628,6 +1359,35 @@ def detect_lines(image, hough_threshold):
     lines = [(float(l[0][0]), float(l[0][1])) for l in lines]
     return sorted(lines, key = lambda x: x[1])
 
+def detect_lines_thresholds(image, hough_thresholds, roi=None):
+    """Returns the lines of the image for each of the Hough thresholds.
+
+    The result is a list with, for each threshold, the same lines
+    `detect_lines` would return. The Hough transform runs only once,
+    with the lowest of the thresholds, and its lines are then filtered
+    by their number of votes.
+
+    """
+    if not hasattr(cv2, 'HoughLinesWithAccumulator'):
+        # Old versions of OpenCV
+        return [detect_lines(image, threshold, roi=roi)
+                for threshold in hough_thresholds]
+    if roi is not None:
+        x0, y0, x1, y1 = roi
+        return [[(rho + x0 * math.cos(theta) + y0 * math.sin(theta), theta)
+                 for rho, theta in lines]
+                for lines in detect_lines_thresholds(image[y0:y1, x0:x1],
+                                                     hough_thresholds)]
+    raw_lines = cv2.HoughLinesWithAccumulator(image, 1, 0.01,
+                                              min(hough_thresholds))
+    if raw_lines is None:
+        return [[] for threshold in hough_thresholds]
+    raw_lines = raw_lines.reshape(-1, 3)
+    raw_lines = raw_lines[np.argsort(raw_lines[:, 1], kind='stable')]
+    return [[(float(rho), float(theta))
+             for rho, theta, votes in raw_lines if votes > threshold]
+            for threshold in hough_thresholds]
+
 def detect_directions(lines):
     assert(len(lines) >= 2)
     axes = []
@@ -744,7 +1504,330 @@ def collapse_lines_angles(lines, expected, horizontal):
     main_lines.append((sum_rho / num_lines, sum_theta / num_lines))
     return main_lines
 
+def fit_grid(lines, dimensions):
+    """Fits the layout of the tables to the lines of the image.
+
+    The lines of the two dominant perpendicular directions are taken
+    as the vertical and horizontal lines of the tables. The vertical
+    lines are fitted as one group of equally spaced lines per table,
+    and the horizontal ones as a single group, with `fit_lattice`.
+    Lines of the layout that were not detected are interpolated, and
+    spurious lines are ignored. The horizontal lines above the
+    tables, such as those of the id box, are kept. Returns axes as
+    `detect_boxes` does, but with exactly the lines of the layout,
+    or None if the lines do not support the layout.
+
+    """
+    axes = grid_directions(lines)
+    if axes is None:
+        return None
+    vlines = collapse_lines_angles(axes[0][1], None, False)
+    hlines = collapse_lines_angles(axes[1][1], None, True)
+    if vlines is None or hlines is None:
+        return None
+    vlines = fit_lattice(vlines, [box[0] for box in dimensions])
+    if vlines is None:
+        return None
+    table_hlines = fit_lattice(hlines, [max(box[1] for box in dimensions)])
+    if table_hlines is None:
+        return None
+    spacing = table_hlines[1][0] - table_hlines[0][0]
+    hlines = [l for l in hlines if l[0] < table_hlines[0][0] - 0.5 * spacing]
+    return [(axes[0][0], vlines), (axes[1][0], hlines + table_hlines)]
+
+def grid_directions(lines):
+    """Returns the lines of the two dominant perpendicular directions.
+
+    The result has the format of `detect_directions`: the vertical
+    axis (closest to angle 0) first, each one with its lines sorted
+    by rho. Lines of the vertical axis are normalized to angles near
+    0. Returns None if one of the directions has less than two lines.
+
+    """
+    if len(lines) < 2:
+        return None
+    thetas = np.array([l[1] for l in lines])
+    window = param_grid_angle_window
+    # Number of lines around each angle, in the pi modulus
+    extended = np.sort(np.concatenate((thetas - math.pi, thetas,
+                                       thetas + math.pi)))
+    def support(angles):
+        return (np.searchsorted(extended, angles + window, side='right')
+                - np.searchsorted(extended, angles - window, side='left'))
+    angle_1 = thetas[support(thetas).argmax()]
+    # The other direction is searched near the perpendicular one
+    candidates = ((angle_1 + math.pi / 2
+                   + np.linspace(-2 * window, 2 * window, 9)) % math.pi)
+    angle_2 = candidates[support(candidates).argmax()]
+    axes = []
+    for angle in sorted((angle_1, angle_2),
+                        key=lambda a: min(a, math.pi - a)):
+        near_zero = min(angle, math.pi - angle) < math.pi / 4
+        axis_lines = []
+        for rho, theta in lines:
+            diff = abs((theta - angle + math.pi / 2) % math.pi - math.pi / 2)
+            if diff > window:
+                continue
+            if near_zero and theta > math.pi / 2:
+                rho, theta = -rho, theta - math.pi
+            axis_lines.append((rho, theta))
+        if len(axis_lines) < 2:
+            return None
+        axis_lines.sort()
+        avg = sum(theta for rho, theta in axis_lines) / len(axis_lines)
+        axes.append((avg, axis_lines))
+    return axes
+
+def fit_lattice(lines, groups):
+    """Fits groups of equally spaced lines to the given lines.
+
+    `lines` is a list of lines (rho, theta) sorted by rho. The model
+    has, from left to right, a group of `n + 1` lines for each `n` in
+    `groups`, all of them with about the same spacing and separated
+    by gaps. Each detected line supports the model if it is close
+    to one of its lines. The best placement of the groups is chosen,
+    and the lines of each group are then fitted by least squares to
+    the lines that support them. Returns the lines of the model, or
+    None if not enough lines support it or the first or last line
+    of a group is missing.
+
+    """
+    if len(lines) < 2:
+        return None
+    rhos = np.array([l[0] for l in lines])
+    thetas = np.array([l[1] for l in lines])
+    spacing = _lattice_spacing(np.diff(rhos))
+    if spacing is None:
+        return None
+    tolerance = param_grid_tolerance * spacing
+    # Candidate positions of the first line of each group, their
+    # scores and their inliers (the detected line closest to each of
+    # their lines, or -1)
+    candidates = []
+    for n in groups:
+        steps = np.arange(n + 1)
+        starts = np.unique(np.round((rhos[:, None]
+                                     - spacing * steps).ravel(), 1))
+        model = starts[:, None] + spacing * steps
+        distances = np.abs(model[:, :, None] - rhos)
+        closest = distances.argmin(axis=2)
+        distance = distances.min(axis=2)
+        inliers = np.where(distance <= tolerance, closest, -1)
+        scores = np.clip(1 - distance / tolerance, 0, None).sum(axis=1)
+        candidates.append((starts, scores, inliers))
+    # Best placement of the groups from left to right
+    best = candidates[0][1]
+    previous = []
+    for (n, (starts_0, _, _)), (starts, scores, _) \
+            in zip(zip(groups, candidates), candidates[1:]):
+        allowed = (starts_0[None, :] + (n + param_grid_min_gap) * spacing
+                   <= starts[:, None])
+        totals = np.where(allowed, best[None, :], -np.inf)
+        previous.append(totals.argmax(axis=1))
+        best = scores + totals.max(axis=1)
+    if not np.isfinite(best.max()):
+        return None
+    chosen = [int(best.argmax())]
+    for prev in reversed(previous):
+        chosen.insert(0, int(prev[chosen[0]]))
+    fitted = []
+    num_inliers = 0
+    for n, (_, _, inliers), idx in zip(groups, candidates, chosen):
+        steps = np.flatnonzero(inliers[idx] >= 0)
+        # The borders of each group must have been detected, because
+        # otherwise the position of the group is ambiguous
+        if len(steps) < 2 or steps[0] != 0 or steps[-1] != n:
+            return None
+        num_inliers += len(steps)
+        matched = inliers[idx][steps]
+        rho_fit = np.polyfit(steps, rhos[matched], 1)
+        theta_fit = np.polyfit(steps, thetas[matched], 1)
+        all_steps = np.arange(n + 1)
+        fitted.extend(zip(np.polyval(rho_fit, all_steps).tolist(),
+                          np.polyval(theta_fit, all_steps).tolist()))
+    if num_inliers < param_grid_min_inliers * (sum(groups) + len(groups)):
+        return None
+    return fitted
+
+def _lattice_spacing(differences):
+    """Estimates the spacing of a lattice from the differences of its lines.
+
+    It is the median of the largest group of similar differences.
+
+    """
+    differences = differences[differences > param_collapse_lines_maxgap]
+    if len(differences) == 0:
+        return None
+    similar = (np.abs(differences[:, None] - differences)
+               <= param_grid_tolerance * differences[:, None])
+    group = similar[similar.sum(axis=1).argmax()]
+    return float(np.median(differences[group]))
+
+def detect_tables_contours(image, dimensions):
+    """Finds the tables in the contours of the thresholded image.
+
+    Tables are the largest contours with enough holes (their cells)
+    of similar area, taken from left to right. The grid of each one
+    is fitted to its cells with `fit_table_cells`. The horizontal
+    lines of the lowest box with cells above the tables, such as the
+    id box, are also returned. Returns (axes, corner_matrixes) as
+    `axes_from_corners` and `cell_corners` do, or (None, []) if the
+    tables are not found.
+
+    """
+    contours, hierarchy = cv2.findContours(image, cv2.RETR_TREE,
+                                           cv2.CHAIN_APPROX_SIMPLE)[-2:]
+    if hierarchy is None:
+        return None, []
+    hierarchy = hierarchy[0]
+    min_area = param_contour_min_area * images.width(image) \
+               * images.height(image)
+    min_cells = param_contour_min_cells * min(c * r for c, r in dimensions)
+    boxes = []
+    # Only contours with holes can be tables
+    for idx in np.flatnonzero(hierarchy[:, 2] >= 0):
+        contour = contours[idx]
+        if cv2.contourArea(contour) < min_area:
+            continue
+        cells = contour_cells(contours, hierarchy, idx)
+        if len(cells) >= 2:
+            boxes.append((cv2.boundingRect(contour), contour, cells))
+    boxes.sort(key=lambda b: b[0][2] * b[0][3], reverse=True)
+    tables = [box for box in boxes if len(box[2]) >= min_cells]
+    if len(tables) < len(dimensions):
+        return None, []
+    tables = sorted(tables[:len(dimensions)], key=lambda t: t[0][0])
+    corner_matrixes = []
+    for (columns, rows), (_, _, cells) in zip(dimensions, tables):
+        corners = fit_table_cells(cells, columns, rows)
+        if corners is None:
+            return None, []
+        corner_matrixes.append(corners)
+    top = min(rect[1] for rect, _, _ in tables)
+    boxes = [box for box in boxes if box[0][1] + box[0][3] < top]
+    if boxes:
+        _, contour, _ = max(boxes, key=lambda b: b[0][1] + b[0][3])
+        tl, tr, br, bl = _extreme_corners(contour.reshape(-1, 2))
+        id_segments = [(tuple(tl), tuple(tr)), (tuple(bl), tuple(br))]
+    else:
+        id_segments = []
+    return axes_from_corners(corner_matrixes, id_segments), corner_matrixes
+
+def contour_cells(contours, hierarchy, idx):
+    """Returns the holes of a contour that may be cells of a table.
+
+    They are pairs (contour, full). Holes much smaller than the
+    largest ones are discarded. `full` is False for holes somewhat
+    smaller than them, probably cells split by a cross.
+
+    """
+    holes = []
+    child = hierarchy[idx][2]
+    while child >= 0:
+        holes.append(contours[child])
+        child = hierarchy[child][0]
+    areas = np.array([cv2.contourArea(hole) for hole in holes])
+    reference = np.percentile(areas, 75)
+    return [(hole, area >= param_contour_full_cell_area * reference)
+            for hole, area in zip(holes, areas)
+            if area >= param_contour_cell_area * reference]
+
+def fit_table_cells(cells, columns, rows):
+    """Fits the grid of a table to its cells, as `contour_cells` returns.
+
+    The position in the grid of each full cell is found by walking
+    from the top-left one to its neighbors, measured in the local
+    axes of each cell. The homography that maps the grid to the
+    image is then fitted by least squares to the centers of the full
+    cells. The rest of the cells only decide which rows and columns
+    are in the table. Returns an integer array of shape
+    (rows + 1, columns + 1, 2) with the corners of the cells, as
+    `cell_corners` does, or None if the cells do not fit the table.
+
+    """
+    geometry = [_cell_geometry(cell) for cell, full in cells if full]
+    if len(geometry) < max(4, param_contour_min_cells * columns * rows):
+        return None
+    centers = np.array([center for center, _ in geometry])
+    start = int(centers.sum(axis=1).argmin())
+    positions = {start: (0, 0)}
+    pending = [start]
+    while pending:
+        i = pending.pop()
+        center, basis = geometry[i]
+        coords = np.linalg.solve(basis, (centers - center).T).T
+        steps = np.rint(coords)
+        distance = np.abs(steps).max(axis=1)
+        # Neighbors up to two cells away, which skips split cells
+        neighbors = np.flatnonzero(
+            (np.abs(coords - steps).max(axis=1) <= param_contour_tolerance)
+            & (distance > 0) & (distance <= 2))
+        for j in neighbors:
+            if j not in positions:
+                positions[j] = (positions[i][0] + int(steps[j, 0]),
+                                positions[i][1] + int(steps[j, 1]))
+                pending.append(j)
+    indices = list(positions)
+    grid = np.array([positions[i] for i in indices], dtype=np.float32)
+    if (len(indices) < param_contour_min_cells * columns * rows
+        or (grid.max(axis=0) == grid.min(axis=0)).any()):
+        return None
+    homography, _ = cv2.findHomography(grid + 0.5, centers[indices], 0)
+    if homography is None:
+        return None
+    all_centers = np.array([_cell_geometry(cell)[0] for cell, _ in cells],
+                           dtype=np.float32)
+    all_grid = cv2.perspectiveTransform(all_centers[np.newaxis],
+                                        np.linalg.inv(homography))[0]
+    first = np.floor(all_grid.min(axis=0))
+    last = np.floor(all_grid.max(axis=0))
+    if last[0] - first[0] != columns - 1 or last[1] - first[1] != rows - 1:
+        return None
+    homography, _ = cv2.findHomography(grid - first + 0.5, centers[indices], 0)
+    if homography is None:
+        return None
+    xs, ys = np.meshgrid(np.arange(columns + 1), np.arange(rows + 1))
+    lattice = np.dstack((xs, ys)).reshape(1, -1, 2).astype(np.float32)
+    corners = cv2.perspectiveTransform(lattice, homography)[0]
+    return np.rint(corners).astype(int).reshape(rows + 1, columns + 1, 2)
+
+def _cell_geometry(cell):
+    """Returns the center of a cell and its axes as columns of a matrix."""
+    moments = cv2.moments(cell)
+    center = np.array([moments['m10'], moments['m01']]) \
+             / max(moments['m00'], 1e-6)
+    tl, tr, br, bl = _extreme_corners(cell.reshape(-1, 2).astype(np.float64))
+    return center, np.column_stack((((tr - tl) + (br - bl)) / 2,
+                                    ((bl - tl) + (br - tr)) / 2))
+
+def _extreme_corners(points):
+    """Returns the top-left, top-right, bottom-right and bottom-left points."""
+    sums = points.sum(axis=1)
+    differences = points[:, 0] - points[:, 1]
+    return (points[sums.argmin()], points[differences.argmax()],
+            points[sums.argmax()], points[differences.argmin()])
+
+def axes_from_corners(corner_matrixes, id_segments):
+    """Returns the axes of the lines of the tables.
+
+    They have the format of `detect_boxes`, with the vertical lines
+    of the tables and, as horizontal lines, the lines of
+    `id_segments` followed by those of the tables.
+
+    """
+    vsegments, hsegments = tracking_segments(corner_matrixes, id_segments)
+    vlines = [segment_to_line(p0, p1, False) for p0, p1 in vsegments]
+    hlines = [segment_to_line(p0, p1, True) for p0, p1 in hsegments]
+    return [(sum(l[1] for l in vlines) / len(vlines), vlines),
+            (sum(l[1] for l in hlines) / len(hlines), hlines)]
+
 def cell_corners(hlines, vlines, iwidth, iheight, dimensions):
+    """Returns the cell corners of the tables, or [] if they are not valid.
+
+    The result has an integer array per table, with shape
+    (rows + 1, columns + 1, 2): the intersections of its lines.
+
+    """
     h_expected = 1 + max([box[1] for box in dimensions])
     v_expected = len(dimensions) + sum([box[0] for box in dimensions])
     if len(vlines) != v_expected:
@@ -757,17 +1840,12 @@ def cell_corners(hlines, vlines, iwidth, iheight, dimensions):
         return []
     elif len(hlines) > h_expected:
         hlines = hlines[-h_expected:]
+    # Each table is a (rows + 1, columns + 1, 2) slice of the grid
+    grid = g.intersections_array(hlines, vlines)
     corner_matrixes = []
     vini = 0
     for width, height in dimensions:
-        corners = []
-        for i in range(0, height + 1):
-            cpart = []
-            corners.append(cpart)
-            for j in range(vini, vini + width + 1):
-                c = g.intersection(hlines[i], vlines[j])
-                cpart.append(c)
-        corner_matrixes.append(corners)
+        corner_matrixes.append(grid[:height + 1, vini:vini + width + 1])
         vini += 1 + width
     if check_corners(corner_matrixes, iwidth, iheight):
         return corner_matrixes
@@ -777,78 +1855,350 @@ def cell_corners(hlines, vlines, iwidth, iheight, dimensions):
 def check_corners(corner_matrixes, width, height):
     # Check differences between horizontal lines:
     corners = corner_matrixes[(len(corner_matrixes) - 1) // 2]
-    ypoints = [row[-1][1] for row in corners]
-    difs = []
-    difs2 = []
-    for i in range(1, len(ypoints)):
-        difs.append(ypoints[i] - ypoints[i - 1])
-    for i in range(1, len(difs)):
-        difs2.append(difs[i] - difs[i - 1])
-    max_difs2 = 1 + float(max(difs) - min(difs)) / len(difs) \
+    difs = np.diff(corners[:, -1, 1])
+    difs2 = np.diff(difs)
+    max_difs2 = 1 + float(difs.max() - difs.min()) / len(difs) \
         * param_check_corners_tolerance_mul
-    if max(difs2) > max_difs2:
+    if difs2.max() > max_difs2:
         return False
-    if 0.5 * max(difs) > min(difs):
+    if 0.5 * difs.max() > difs.min():
         return False
-    # Check that no points are negative
-    for corners in corner_matrixes:
-        for row in corners:
-            for point in row:
-                if point[0] < 0 or point[0] >= width \
-                        or point[1] < 0 or point[1] >= height:
-                    return False
-
-    # Check that the sequence of points is coherent
     for corners in corner_matrixes:
-        for i in range(0, len(corners) - 1):
-            for j in range(0, len(corners[0]) - 1):
-                if corners[i][j][1] >= corners[i + 1][j][1] or \
-                        corners[i][j + 1][1] >= corners[i + 1][j + 1][1] or \
-                        corners[i][j][0] >= corners[i][j + 1][0] or \
-                        corners[i + 1][j][0] >= corners[i + 1][j + 1][0]:
-                    return False
+        xs = corners[:, :, 0]
+        ys = corners[:, :, 1]
+        # Check that no points are out of the image
+        if xs.min() < 0 or xs.max() >= width \
+                or ys.min() < 0 or ys.max() >= height:
+            return False
+        # Check that the sequence of points is coherent
+        if (np.diff(ys, axis=0) <= 0).any() \
+                or (np.diff(xs, axis=1) <= 0).any():
+            return False
 
     # Success if control reaches here
     return True
 
+def tracking_segments(corner_matrixes, id_segments):
+    """Returns the segments of the lines of the tables, for tracking them.
+
+    The result is a pair (vsegments, hsegments) of lists of segments
+    (p0, p1): the vertical lines of the tables from left to right,
+    and the horizontal ones from top to bottom, starting with
+    `id_segments` (the lines of the id box, if any).
+
+    """
+    vsegments = []
+    for corners in corner_matrixes:
+        vsegments.extend(zip(map(tuple, corners[0].tolist()),
+                             map(tuple, corners[-1].tolist())))
+    hsegments = list(id_segments)
+    num_hlines = max(len(corners) for corners in corner_matrixes)
+    for i in range(num_hlines):
+        points = [tuple(p) for corners in corner_matrixes if len(corners) > i
+                  for p in (corners[i, 0].tolist(), corners[i, -1].tolist())]
+        hsegments.append((min(points), max(points)))
+    return vsegments, hsegments
+
+def id_box_segments(id_hlines, id_cells):
+    """Returns the segments of the two lines of the id box."""
+    x0 = min(id_cells[0].plu[0], id_cells[0].pld[0])
+    x1 = max(id_cells[-1].pru[0], id_cells[-1].prd[0])
+    return [(g.line_point(line, x=x0), g.line_point(line, x=x1))
+            for line in id_hlines]
+
+def track_axes(image, segments):
+    """Re-fits the lines of the tables found in a previous frame.
+
+    `segments` is the value returned by `tracking_segments`. Every
+    line is searched only near its previous position. Returns the
+    new axes, in the format of `filter_axes`, and the new segments,
+    or (None, None) if some line cannot be found.
+
+    """
+    vsegments, hsegments = segments
+    new_segments = track_segments(image, list(vsegments) + list(hsegments))
+    if None in new_segments:
+        return None, None
+    new_segments = (new_segments[:len(vsegments)],
+                    new_segments[len(vsegments):])
+    axes = []
+    for segment_list, horizontal in zip(new_segments, (False, True)):
+        lines = [segment_to_line(p0, p1, horizontal)
+                 for p0, p1 in segment_list]
+        angle = sum(line[1] for line in lines) / len(lines)
+        axes.append((angle, lines))
+    return axes, new_segments
+
+def track_segments(image, segments):
+    """Finds the segments that best match the given ones in a binary image.
+
+    Candidates for each segment are shifted up to
+    `param_tracking_rho_band` pixels in the perpendicular direction
+    and rotated around their center by the angles in
+    `param_tracking_angles`. All the candidates of all the segments
+    are scored at once by counting foreground pixels at points
+    sampled along them. Returns the list of new segments (p0, p1).
+    The segments whose best candidate does not have enough support
+    are None in that list.
+
+    """
+    ends = np.array(segments, dtype=np.float64)
+    p0 = ends[:, 0]
+    p1 = ends[:, 1]
+    lengths = np.maximum(np.hypot(*(p1 - p0).T), 1)
+    centers = (p0 + p1) / 2
+    directions = (p1 - p0) / lengths[:, np.newaxis]
+    normals = np.column_stack((-directions[:, 1], directions[:, 0]))
+    offsets = np.arange(-param_tracking_rho_band,
+                        param_tracking_rho_band + 1, dtype=np.float64)
+    angles = np.array(param_tracking_angles)
+    cos_a = np.cos(angles)
+    sin_a = np.sin(angles)
+    # Directions of the rotated candidates: (segments, angles, 2)
+    rotated = np.stack(
+        (directions[:, 0:1] * cos_a - directions[:, 1:2] * sin_a,
+         directions[:, 0:1] * sin_a + directions[:, 1:2] * cos_a), axis=-1)
+    # Sampling positions along each segment: (segments, samples)
+    num_samples = int(lengths.max() // param_tracking_sampling_step) + 1
+    t = (np.linspace(-0.5, 0.5, num_samples)[np.newaxis, :]
+         * lengths[:, np.newaxis])
+    # Coordinates of the sampled points: (segments, angles, offsets, samples)
+    coords = []
+    for k in range(2):
+        base = (centers[:, k, np.newaxis] +
+                offsets[np.newaxis, :] * normals[:, k, np.newaxis])
+        coords.append(np.rint(base[:, np.newaxis, :, np.newaxis]
+                              + rotated[:, :, np.newaxis, np.newaxis, k]
+                              * t[:, np.newaxis, np.newaxis, :])
+                      .astype(np.intp))
+    x, y = coords
+    inside = ((x >= 0) & (x < images.width(image))
+              & (y >= 0) & (y < images.height(image)))
+    values = image[np.where(inside, y, 0), np.where(inside, x, 0)] > 0
+    votes = np.count_nonzero(values & inside, axis=3)
+    new_segments = []
+    for i in range(len(segments)):
+        best_angle = np.argmax(votes[i].max(axis=1))
+        best_votes = votes[i, best_angle]
+        best = np.argmax(best_votes)
+        if best_votes[best] < param_tracking_min_support * num_samples:
+            new_segments.append(None)
+            continue
+        # Thick lines match at several offsets: take the center of the
+        # run of well supported offsets around the best one
+        supported = best_votes >= param_tracking_plateau * best_votes[best]
+        first = best
+        while first > 0 and supported[first - 1]:
+            first -= 1
+        last = best
+        while last < len(offsets) - 1 and supported[last + 1]:
+            last += 1
+        weights = best_votes[first:last + 1]
+        offset = np.dot(offsets[first:last + 1], weights) / weights.sum()
+        center = centers[i] + offset * normals[i]
+        half = rotated[i, best_angle] * lengths[i] / 2
+        new_segments.append((tuple(center - half), tuple(center + half)))
+    return new_segments
+
+def refine_axes(image, axes, corner_matrixes, scale, dimensions):
+    """Moves lines found in a scaled down image to the full size image.
+
+    `axes` and `corner_matrixes` were computed in the image scaled
+    down by `scale`. The lines of the tables are re-fitted in `image`
+    between their scaled up corners. The rest of the horizontal lines
+    (candidates for the id box) are re-fitted along the width of the
+    tables. Lines that cannot be re-fitted are just scaled up.
+    Returns the new axes.
+
+    """
+    h_expected = 1 + max([box[1] for box in dimensions])
+    corner_matrixes = [corners / scale for corners in corner_matrixes]
+    vsegments, hsegments = tracking_segments(corner_matrixes, [])
+    other_hlines = [(rho / scale, theta)
+                    for rho, theta in axes[1][1][:-h_expected]]
+    x0 = min(p[0] for p, _ in hsegments)
+    x1 = max(p[0] for _, p in hsegments)
+    other_segments = [(g.line_point(line, x=int(x0)),
+                       g.line_point(line, x=int(x1)))
+                      for line in other_hlines]
+    segments = vsegments + other_segments + hsegments
+    refined = track_segments(image, segments)
+    lines = []
+    for i, (segment, new_segment) in enumerate(zip(segments, refined)):
+        horizontal = i >= len(vsegments)
+        if new_segment is not None:
+            segment = new_segment
+        lines.append(segment_to_line(segment[0], segment[1], horizontal))
+    vlines = lines[:len(vsegments)]
+    hlines = lines[len(vsegments):]
+    return [(axes[0][0], vlines), (axes[1][0], hlines)]
+
+def segment_to_line(p0, p1, horizontal):
+    """Returns the (rho, theta) line of the segment p0-p1.
+
+    Theta is kept close to 0 for vertical lines and to pi/2 for
+    horizontal ones, as `detect_directions` does.
+
+    """
+    dx = p1[0] - p0[0]
+    dy = p1[1] - p0[1]
+    length = math.hypot(dx, dy)
+    if horizontal:
+        normal = (-dy / length, dx / length)
+    else:
+        normal = (dy / length, -dx / length)
+    theta = math.atan2(normal[1], normal[0])
+    rho = normal[0] * p0[0] + normal[1] * p0[1]
+    return (float(rho), float(theta))
+
+def region_of_interest(corner_matrixes, id_cells, read_id, iwidth, iheight):
+    """Returns the rectangle (x0, y0, x1, y1) in which to search the tables.
+
+    It is the bounding box of the tables, extended downwards to cover
+    the infobits and upwards to cover the id box when it has to be
+    read, plus some margin for the sheet to move between frames.
+    The id box can be wider than the tables: if its cells are not
+    known, the region spans the whole width of the image.
+
+    """
+    points = [corners.reshape(-1, 2) for corners in corner_matrixes]
+    if id_cells:
+        points.append(np.array([p for cell in id_cells
+                                for p in cell.corners()]))
+    points = np.concatenate(points)
+    x0, y0 = points.min(axis=0).tolist()
+    x1, y1 = points.max(axis=0).tolist()
+    num_rows = max(len(corners) for corners in corner_matrixes) - 1
+    row_height = (max(int(corners[-1, :, 1].max())
+                      for corners in corner_matrixes)
+                  - min(int(corners[0, :, 1].min())
+                        for corners in corner_matrixes)) / num_rows
+    margin_x = param_roi_margin + param_roi_margin_ratio * (x1 - x0)
+    margin_y = param_roi_margin + param_roi_margin_ratio * (y1 - y0)
+    y1 += param_roi_bottom_rows * row_height
+    if read_id:
+        y0 -= param_roi_id_box_rows * row_height
+        if not id_cells:
+            x0 = -margin_x
+            x1 = iwidth + margin_x
+    return (max(0, int(x0 - margin_x)),
+            max(0, int(y0 - margin_y)),
+            min(iwidth, int(math.ceil(x1 + margin_x))),
+            min(iheight, int(math.ceil(y1 + margin_y))))
+
+def compare_frames(image, reference, answer_cells):
+    """Tells whether a frame still shows the exam of a reference capture.
+
+    The frames are compared through the correlation of scaled down
+    grayscale versions of the region of the answer tables (a list of
+    lists of CellGeometry objects, as in the reference capture).
+    Returns True if the exam is clearly still there, False if it
+    clearly is not, and None if the difference is ambiguous.
+
+    """
+    if (image is None or reference is None or not answer_cells
+        or image.shape[:2] != reference.shape[:2]):
+        return None
+    corr = frame_correlation(image, reference,
+                             answer_cells_region(answer_cells,
+                                                 images.width(image),
+                                                 images.height(image)))
+    if corr >= param_change_same_correlation:
+        return True
+    elif corr <= param_change_removed_correlation:
+        return False
+    else:
+        return None
+
+def answer_cells_region(answer_cells, iwidth, iheight):
+    """Returns the rectangle (x0, y0, x1, y1) around the answer cells."""
+    points = np.array([p for cells in answer_cells
+                       for cell in cells for p in cell.corners()])
+    x0, y0 = points.min(axis=0).tolist()
+    x1, y1 = points.max(axis=0).tolist()
+    margin_x = param_change_margin_ratio * (x1 - x0)
+    margin_y = param_change_margin_ratio * (y1 - y0)
+    return (max(0, int(x0 - margin_x)),
+            max(0, int(y0 - margin_y)),
+            min(iwidth, int(math.ceil(x1 + margin_x))),
+            min(iheight, int(math.ceil(y1 + margin_y))))
+
+def frame_correlation(image, reference, region):
+    """Returns the correlation of two images in the given region.
+
+    It is a value from -1 to 1, robust to changes of brightness and
+    contrast. It is 0 when any of them is flat in that region.
+
+    """
+    x0, y0, x1, y1 = region
+    width = min(param_change_width, x1 - x0)
+    height = max(1, int(round(width * (y1 - y0) / (x1 - x0))))
+    samples = []
+    for img in (image, reference):
+        crop = img[y0:y1, x0:x1]
+        if len(crop.shape) == 3:
+            crop = images.rgb_to_gray(crop)
+        small = cv2.resize(crop, (width, height),
+                           interpolation=cv2.INTER_AREA).astype(np.float32)
+        # Blurring makes small movements of the sheet less relevant
+        small = cv2.GaussianBlur(small, (0, 0), param_change_blur)
+        small -= small.mean()
+        samples.append(small)
+    norm = math.sqrt(float((samples[0] ** 2).sum())
+                     * float((samples[1] ** 2).sum()))
+    if norm == 0:
+        return 0.0
+    return float((samples[0] * samples[1]).sum()) / norm
+
 def read_infobits(image, corner_matrixes):
-    mask = images.new_image(images.width(image), images.height(image), 1)
     bits = []
     for corners in corner_matrixes:
-        for i in range(1, len(corners[0])):
-            dx = g.diff_points(corners[-1][i - 1], corners[-1][i])
-            dy = g.diff_points(corners[-1][i], corners[-2][i])
-            center = g.round_point((corners[-1][i][0]
-                                    + dx[0] / 2 + dy[0] / 2.6,
-                                    corners[-1][i][1]
-                                    + dx[1] / 2 + dy[1] / 2.6))
-            bits.append(decide_infobit(image, mask, center, dy))
+        # A bit below each cell of the last row of the table
+        dxs = corners[-1, :-1] - corners[-1, 1:]
+        dys = corners[-1, 1:] - corners[-2, 1:]
+        centers = np.rint(corners[-1, 1:] + dxs / 2 + dys / 2.6)
+        for center, dy in zip(centers.astype(np.int64).tolist(),
+                              dys.tolist()):
+            bits.append(decide_infobit(image, tuple(center), tuple(dy)))
     # Check validity
     if min([b[0] ^ b[1] for b in bits]) == True:
         return [b[0] for b in bits]
     else:
         return None
 
-def decide_infobit(image, mask, center_up, dy):
+def decide_infobit(image, center_up, dy):
     center_down = g.add_points(center_up, dy)
     radius = int(round(math.sqrt(dy[0] * dy[0] + dy[1] * dy[1]) \
                            * param_bit_mask_radius_multiplier))
     if radius == 0:
         radius = 1
-    images.zero_image(mask)
-    cv2.circle(mask, center_up, radius, (1), thickness=-1)
-    mask_pixels = cv2.countNonZero(mask)
-    masked = cv2.multiply(image, mask)
-    masked_pixels_up = cv2.countNonZero(masked)
-    images.zero_image(mask)
-    cv2.circle(mask, center_down, radius, (1), thickness=-1)
-    masked = cv2.multiply(image, mask)
-    masked_pixels_down = cv2.countNonZero(masked)
+    mask_pixels, masked_pixels_up = disk_count(image, center_up, radius)
+    _, masked_pixels_down = disk_count(image, center_down, radius)
     if mask_pixels < 1:
         return (False, False)
     return (float(masked_pixels_up) / mask_pixels >= param_bit_mask_threshold,
             float(masked_pixels_down) / mask_pixels >= param_bit_mask_threshold)
 
+def disk_count(image, center, radius):
+    """Counts pixels of a filled circle drawn on the image.
+
+    Returns (pixels of the circle, non-zero image pixels in the circle).
+    Only pixels inside the image are counted. The circle is rasterized
+    by `cv2.circle` on a mask that just covers it.
+
+    """
+    x0 = max(0, center[0] - radius - 1)
+    y0 = max(0, center[1] - radius - 1)
+    x1 = min(images.width(image), center[0] + radius + 2)
+    y1 = min(images.height(image), center[1] + radius + 2)
+    if x0 >= x1 or y0 >= y1:
+        return 0, 0
+    mask = images.new_image(x1 - x0, y1 - y0, 1)
+    cv2.circle(mask, (center[0] - x0, center[1] - y0), radius, (1),
+               thickness=-1)
+    window = image[y0:y1, x0:x1]
+    return cv2.countNonZero(mask), np.count_nonzero(window[mask > 0])
+
 def decide_answer(cell_decisions):
     marked = [i for i in range(0, len(cell_decisions)) if cell_decisions[i]]
     if len(marked) == 1:
@@ -963,10 +2313,17 @@ def id_boxes_adjust_points(image, p_up, p_down, line_up, line_down,
         if p[0] >= 0 and p[0] < iwidth and p[1] >= 0:
             points_down.append(p)
     pairs = [(u, v) for u in points_up for v in points_down]
+    # Pairs with points below the image are only an error if reached
+    iheight = images.height(image)
+    inside = [u[1] < iheight and v[1] < iheight for u, v in pairs]
+    pair_energies = iter(id_boxes_match_levels(
+        image, [pair for pair, ok in zip(pairs, inside) if ok]))
     energies = []
     best = None
-    for u, v in pairs:
-        energy = id_boxes_match_level(image, u, v)
+    for (u, v), ok in zip(pairs, inside):
+        if not ok:
+            raise IndexError('Point out of the image')
+        energy = next(pair_energies)
         if energy > param_id_boxes_energy_break:
             best = ((u, v), energy)
             break
@@ -995,27 +2352,47 @@ def id_boxes_adjust_points(image, p_up, p_down, line_up, line_down,
 
 def id_boxes_adjust_point_vertically(image, point, line, interval, iwidth):
     rho, theta = line
-    lines = [line]
+    rhos = [rho]
     for i in range(interval[0], interval[1] + 1):
-        lines.append((rho + i, theta))
-        lines.append((rho - i, theta))
+        rhos.append(rho + i)
+        rhos.append(rho - i)
+    # Points of every line at x = point[0] - 2 ... point[0] + 2,
+    # computed as g.line_point does
+    rhos = np.array(rhos)[:, np.newaxis]
+    xs = np.arange(point[0] - 2, point[0] + 3)[np.newaxis, :]
+    ys = np.trunc((rhos - xs * math.cos(theta))
+                  / math.sin(theta)).astype(np.int64)
+    xs = np.broadcast_to(xs, ys.shape)
+    valid = (ys >= 0) & (xs >= 0) & (xs < iwidth)
+    matches = np.count_nonzero(image[np.where(valid, ys, 0),
+                                     np.where(valid, xs, 0)] * valid,
+                               axis=1)
     values = []
-    for l in lines:
-        match = 0
-        for xx in range(point[0] - 2, point[0] + 3):
-            x, y = g.line_point(l, x=xx)
-            if y >= 0 and x >= 0 and x < iwidth and image[y, x] > 0:
-                match += 1
-        p = g.line_point(l, x=point[0])
+    for match, y in zip(matches.tolist(), ys[:, 2].tolist()):
+        p = (point[0], y)
         values.append((match, p[1], p))
     values.sort(reverse = True)
     best = [(m, ppp) for (m, yyy, ppp) in values if m == values[0][0]]
     return best[len(best) // 2][1]
 
 def id_boxes_match_level(image, p0, p1):
-    points = [(x, y) for (x, y) in g.walk_line(p0, p1)]
-    active = len([(x, y) for (x, y) in points if image[y, x] > 0])
-    return float(active) / len(points)
+    return id_boxes_match_levels(image, [(p0, p1)])[0]
+
+def id_boxes_match_levels(image, pairs):
+    """Returns the fraction of active pixels in the line of each pair.
+
+    `pairs` is a list of (p0, p1) points. All the lines are walked
+    at once. The result is a list with a value for each pair.
+
+    """
+    if not pairs:
+        return []
+    xs, ys, lengths = g.walk_lines_array([p0 for p0, p1 in pairs],
+                                         [p1 for p0, p1 in pairs])
+    # Padding repeats the last point of each line: don't count it
+    padding = np.arange(xs.shape[1])[np.newaxis, :] >= lengths[:, np.newaxis]
+    active = np.count_nonzero((image[ys, xs] > 0) & ~padding, axis=1)
+    return (active / lengths).tolist()
 
 # Utility functions
 #
@@ -1067,32 +2444,23 @@ def line_bounds(image, line, iwidth):
     if (not g.point_is_valid(p0, image_dimensions)
         or not g.point_is_valid(p1, image_dimensions)):
         return None, None
-    # get bounds
-    ini_found = False
-    ini = None
-    end = None
-    last = 0
-    count = 0
-    for x, y in g.walk_line(p0, p1):
-        value = 1 if image[y, x] > 0 else 0
-        if value == last:
-            count += 1
-        else:
-            last = value
-            count = 1
-        if not ini_found:
-            if last == 1:
-                if count == 1:
-                    ini = (x, y)
-                elif count == 3:
-                    ini_found = True
-        else:
-            if last == 1 and count > 2:
-                end = (x, y)
-    if ini is None or end is None:
-        ini = None
-        end = None
-    return ini, end
+    # get bounds: ini is the first point of the first run of at least
+    # three active pixels, and end the last point, after the third
+    # point of that run, that is at least the third one of its run
+    xs, ys = g.walk_line_array(p0, p1)
+    active = image[ys, xs] > 0
+    if not active.any():
+        return None, None
+    positions = np.arange(len(active))
+    run_starts = np.flatnonzero(np.diff(active, prepend=False))
+    run_start_of = run_starts[np.searchsorted(run_starts, positions,
+                                              side='right') - 1]
+    in_long_run = np.flatnonzero(active & (positions - run_start_of >= 2))
+    if len(in_long_run) < 2:
+        return None, None
+    ini = run_start_of[in_long_run[0]]
+    end = in_long_run[-1]
+    return (int(xs[ini]), int(ys[ini])), (int(xs[end]), int(ys[end]))
 
 def process_box_corners(points, dimensions):
     num_boxes = len(dimensions)
@@ -1127,17 +2495,19 @@ def process_box_corners(points, dimensions):
         # (left-up, right-up, left-bottom, right-bottom)
         boxes.append(fix_box_if_needed((group1[2 * i], group1[2 * i + 1],
                                         group2[2 * i], group2[2 * i + 1])))
-    corners = []
+    corner_matrixes = []
     for box_dims, box_corners in zip(dimensions, boxes):
-        corners.append(construct_box(box_corners, box_dims[0], box_dims[1]))
-    return corners
+        corner_matrixes.append(construct_box(box_corners, box_dims[0],
+                                             box_dims[1]))
+    return corner_matrixes
 
 def construct_box(outer_corners, num_columns, num_rows):
     """Returns the corners of all the cells in a box.
 
        'outer_corners' is a 4-tuple with the coordinates of the outer
        corners of the box: (left-up, right-up, left-bottom,
-       right-bottom).
+       right-bottom). The result is an integer array with shape
+       (num_rows + 1, num_columns + 1, 2).
 
     """
     plu, pru, pld, prd = outer_corners
@@ -1147,17 +2517,10 @@ def construct_box(outer_corners, num_columns, num_rows):
     line_right_len = g.distance(pru, prd)
     factor_h = line_down_len / line_up_len
     factor_v = line_right_len / line_left_len
-    vert_left = g.interpolate_line_progressive(plu, pld,
-                                               num_rows + 1, factor_h)
-    vert_right = g.interpolate_line_progressive(pru, prd,
-                                                num_rows + 1, factor_h)
-    corners = []
-    for i in range(0, num_rows + 1):
-        pl = vert_left[i]
-        pr = vert_right[i]
-        corners.append(g.interpolate_line_progressive(pl, pr, num_columns + 1,
-                                                      factor_v))
-    return corners
+    vert_left, vert_right = g.interpolate_lines_progressive(
+        (plu, pru), (pld, prd), num_rows + 1, factor_h)
+    return g.interpolate_lines_progressive(vert_left, vert_right,
+                                           num_columns + 1, factor_v)
 
 def fix_box_if_needed(box_corners):
     """Due to a bug, sometimes corners were not properly detected.
@@ -29,6 +29,8 @@ if (not os.getenv('LANG')
 
 import sys
 import time
+import collections
+import traceback
 import webbrowser
 import gettext
 
@@ -61,32 +63,197 @@ utils.EyegradeException.register_error('incompatible_schema',
     short_message=_('Incompatible session format. This is {0} version {1} '
                     'but the session was created by version {2}'))
 
-param_fps = 8
-capture_period = 1.0 / param_fps
 capture_change_period = 1.0
 capture_change_period_failure = 0.3
+# Consecutive failed checks after which the exam is considered removed,
+# when the failures come from the frame difference or from Hough
+change_failures_removed_clear = 2
+change_failures_removed = 4
 after_removal_delay = 1.0
 
+# Maximum number of detected frames waiting to be rendered
+param_pipeline_depth = 2
+# Seconds to wait before searching again after a detection that failed
+# to start (e.g. no frame available)
+detection_retry_delay = 0.3
+
 
 class ImageDetectTask:
-    """Used for running image detection in another thread."""
-    def __init__(self, detector):
-        self.detector = detector
+    """Used for running image detection in another thread.
 
-    def run(self):
-        self.detector.detect_safe()
+    The detector is created in the worker thread too, so that waiting
+    for the frame and pre-processing it do not block the GUI.
+
+    """
+    def __init__(self, dimensions, context, options):
+        self.dimensions = dimensions
+        self.context = context
+        self.options = options
         self.detector = None
 
+    def run(self):
+        """Detects the next frame.
+
+        It never raises: if the detector cannot be created (e.g. there
+        is no frame because the camera has been closed), `detector`
+        is left as None.
+
+        """
+        try:
+            self.detector = detection.ExamDetector(self.dimensions,
+                                                   self.context,
+                                                   self.options)
+            self.detector.detect_safe()
+        except Exception:
+            if self.detector is not None:
+                self.detector.release()
+                self.detector = None
+            if self.options['error-logging']:
+                traceback.print_exc()
+
+
+class SearchPipeline:
+    """Overlaps the detection of a frame with the rendering of others.
+
+    The grabber thread of the detection context keeps capturing
+    frames, a worker thread detects the newest one and the GUI thread
+    renders the results of previous detections, all at the same time.
+    Detections run one at a time because they share the tracking state
+    of the context; the next one starts as soon as the previous one
+    finishes, without waiting for its result to be rendered. Results
+    waiting to be rendered are kept in a bounded queue that drops the
+    oldest one when it is full.
+
+    `create_task` returns a new `ImageDetectTask`, or None to stop the
+    pipeline. `render` receives each detector in the GUI thread. The
+    detectors that are dropped are released. When a task ends without
+    a detector, the next one is launched after `detection_retry_delay`
+    seconds.
+
+    """
+    def __init__(self, interface, create_task, render,
+                 depth=param_pipeline_depth):
+        self.interface = interface
+        self.create_task = create_task
+        self.render = render
+        self.depth = depth
+        self.results = collections.deque()
+        self.running = False
+        self.detecting = False
+        self.render_scheduled = False
+        self.generation = 0
+
+    def start(self):
+        self.stop()
+        self.running = True
+        self._launch()
+
+    def stop(self):
+        """Stops the pipeline and discards the pending results.
+
+        Detections already in progress are discarded when they finish.
+
+        """
+        self.running = False
+        self.generation += 1
+        while self.results:
+            self.results.popleft().release()
+
+    def _launch(self):
+        if not self.running or self.detecting:
+            return
+        task = self.create_task()
+        if task is None:
+            self.stop()
+            return
+        self.detecting = True
+        generation = self.generation
+        self.interface.run_worker(task,
+                                  lambda: self._detected(task, generation))
+
+    def _detected(self, task, generation):
+        self.detecting = False
+        if task.detector is None:
+            # The detection failed before it started: retry later,
+            # instead of looping on the error
+            if generation == self.generation:
+                self.interface.register_timer(
+                                    int(detection_retry_delay * 1000),
+                                    self._launch)
+            return
+        if generation != self.generation:
+            task.detector.release()
+        else:
+            if len(self.results) == self.depth:
+                self.results.popleft().release()
+            self.results.append(task.detector)
+        self._launch()
+        if self.results and not self.render_scheduled:
+            self.render_scheduled = True
+            self.interface.run_later(self._render_next)
+
+    def _render_next(self):
+        self.render_scheduled = False
+        if not self.results:
+            return
+        self.render(self.results.popleft())
+        if self.results and not self.render_scheduled:
+            # Let the event loop run between frames
+            self.render_scheduled = True
+            self.interface.run_later(self._render_next)
+
 
 class ImageChangeTask:
-    """Used for running image change detection in another thread."""
-    def __init__(self, detector, reference_image):
-        self.detector = detector
-        self.reference_image = reference_image
+    """Used for running image change detection in another thread.
+
+    The frame is first compared with the reference capture of the
+    exam, which is cheap. The exam is searched in the frame with the
+    Hough transform only when that comparison is ambiguous.
+    `frame_changed` tells whether the exam was found missing by the
+    comparison.
+
+    """
+    def __init__(self, dimensions, context, options, reference_capture):
+        self.dimensions = dimensions
+        self.context = context
+        self.options = options
+        self.reference_capture = reference_capture
+        self.exam_detected = False
+        self.frame_changed = False
 
     def run(self):
-        self.detector.exam_detected()
-        self.detector = None
+        """Checks whether the exam is still in front of the camera.
+
+        It never raises: if the frame cannot be captured or analyzed,
+        the exam is reported as not detected.
+
+        """
+        image = None
+        detector = None
+        try:
+            image = self.context.capture()
+            same_exam = detection.compare_frames(
+                                        image,
+                                        self.reference_capture.image_reference,
+                                        self.reference_capture.answer_cells)
+            if same_exam is None:
+                detector = detection.ExamDetector(self.dimensions,
+                                                  self.context, self.options,
+                                                  image_raw=image)
+                detector.exam_detected()
+                self.exam_detected = detector.exam_detected
+            else:
+                self.exam_detected = same_exam
+                self.frame_changed = not same_exam
+        except Exception:
+            self.exam_detected = False
+            self.frame_changed = False
+            if self.options['error-logging']:
+                traceback.print_exc()
+        finally:
+            if detector is not None:
+                detector.release()
+            self.context.buffers.release(image)
 
 
 class ManualDetectionManager:
@@ -183,7 +350,9 @@ class ProgramManager:
         self.detection_context = self._get_detection_context()
         self.detection_options = None
         self.drop_next_capture = False
-        self.dump_buffer = False
+        self.search_pipeline = SearchPipeline(self.interface,
+                                              self._new_detect_task,
+                                              self._after_image_detection)
         self._register_listeners()
         self.from_manual_detection = False
         self.manual_detect_manager = None
@@ -198,7 +367,8 @@ class ProgramManager:
         false_detector_session = os.getenv('EYEGRADE_CAMERA_SESSION')
         if not false_detector_session:
             return detection.ExamDetectorContext( \
-                                        camera_id=self.config['camera-dev'])
+                                        camera_id=self.config['camera-dev'],
+                                        tracking=True, roi_detection=True)
         else:
             return detection.FalseExamDetectorContext(false_detector_session)
 
@@ -226,9 +396,8 @@ class ProgramManager:
         self.latest_graded_exam = None
         self.latest_detector = None
         self.manual_detect_manager = None
-        self.interface.register_timer(50, self._next_search)
-        self.detection_context.dump_buffer(1.0)
-        self.next_capture = time.time() + 0.05
+        self.detection_context.reset_tracking()
+        self.search_pipeline.start()
 
     def _start_review_mode(self):
         if self.mode.in_grading():
@@ -256,7 +425,9 @@ class ProgramManager:
     def _start_auto_change_detection(self):
         if not self.from_manual_detection:
             self.change_failures = 0
+            self.clear_change_failures = 0
             self.interface.register_timer(1000, self._next_change_detection)
+            self.next_capture = time.time() + 1.0
 
     def _start_manual_detect_mode(self):
         self.mode.enter_manual_detect()
@@ -267,25 +438,26 @@ class ProgramManager:
                                    self.detection_context,
                                    self.detection_options)
 
-    def _next_search(self):
+    def _new_detect_task(self):
+        """Returns the next search task for the pipeline.
+
+        Returns None, which stops the pipeline, out of search mode.
+
+        """
         if not self.mode.in_search():
-            return
-        if self.dump_buffer:
-            self.dump_buffer = False
-            self.detection_context.dump_buffer(after_removal_delay)
-        detector = detection.ExamDetector(self.exam_data.dimensions,
-                                          self.detection_context,
-                                          self.detection_options)
-        self.current_detector = detector
-        task = ImageDetectTask(detector)
-        self.interface.run_worker(task, self._after_image_detection)
-
-    def _after_image_detection(self):
-        detector = self.current_detector
-        self.current_detector = None
+            return None
+        return ImageDetectTask(self.exam_data.dimensions,
+                               self.detection_context,
+                               self.detection_options)
+
+    def _after_image_detection(self, detector):
+        """Renders the result of a detection from the search pipeline."""
         if not self.mode.in_search():
             # The user switched to other mode while the image was processed
+            self.search_pipeline.stop()
+            detector.release()
             return
+        previous_detector = self.latest_detector
         self.latest_detector = detector
         if (detector.status['boxes']
             and self.detection_context.threshold_locked):
@@ -300,19 +472,34 @@ class ProgramManager:
                 detector.capture.draw_status()
             if detector.capture is not None:
                 self.interface.display_capture(detector.capture.image_drawn)
-            self._schedule_next_capture(capture_period, self._next_search)
         elif not self.drop_next_capture:
+            self.search_pipeline.stop()
             exam.draw_answers()
             self.exam = exam
             self._start_review_mode()
         else:
             # Special mode: do not lock until another capture is
             # available.  Used after auto exam removal detection.
+            self.search_pipeline.stop()
             exam.draw_answers()
             self.interface.display_capture(detector.capture.image_drawn)
-            self._schedule_next_capture(after_removal_delay, self._next_search)
+            self.interface.register_timer(int(after_removal_delay * 1000),
+                                          self._resume_search)
             self.drop_next_capture = False
-            self.dump_buffer = True
+        self._discard_detector(previous_detector)
+
+    def _discard_detector(self, detector):
+        """Releases the images of a detector, unless an exam uses them."""
+        if detector is None:
+            return
+        for exam in (self.exam, self.latest_graded_exam):
+            if exam is not None and exam.capture is detector.capture:
+                return
+        detector.release()
+
+    def _resume_search(self):
+        if self.mode.in_search():
+            self.search_pipeline.start()
 
     def _next_change_detection(self):
         """Used to detect exam removal.
@@ -324,38 +511,38 @@ class ProgramManager:
         if (not self.mode.in_review_from_grading()
             or not self.interface.is_action_checked(('tools', 'auto_change'))):
             return
-        self.detection_context.dump_buffer(1.0)
-        detector = detection.ExamDetector(self.exam_data.dimensions,
-                                          self.detection_context,
-                                          self.detection_options)
-        self.current_detector = detector
-        task = ImageChangeTask(detector, self.exam.capture)
-        self.interface.run_worker(task, self._after_change_detection)
-
-    def _after_change_detection(self):
+        task = ImageChangeTask(self.exam_data.dimensions,
+                               self.detection_context,
+                               self.detection_options,
+                               self.exam.capture)
+        self.interface.run_worker(task,
+                                  lambda: self._after_change_detection(task))
+
+    def _after_change_detection(self, task):
         """Continuation of `_next_change_detection`.
 
         Executed after the image has been processed. This method decides
         whether the exam has been removed.
 
         """
-        image = self.current_detector
-        self.current_detector = None
-        if image is None:
-            # This needs to be investigated: this case should never
-            # happen, but I saw it happen...
-            return
         if (not self.mode.in_review_from_grading()
             or not self.interface.is_action_checked(('tools', 'auto_change'))):
             return
         exam_removed = False
-        if image.exam_detected:
+        if task.exam_detected:
             period = capture_change_period
             self.change_failures = 0
+            self.clear_change_failures = 0
         else:
             period = capture_change_period_failure
             self.change_failures += 1
-            if self.change_failures >= 4:
+            if task.frame_changed:
+                self.clear_change_failures += 1
+            else:
+                self.clear_change_failures = 0
+            if (self.change_failures >= change_failures_removed
+                or self.clear_change_failures
+                                    >= change_failures_removed_clear):
                 exam_removed = True
         if not exam_removed:
             self._schedule_next_capture(period, self._next_change_detection)
@@ -367,15 +554,14 @@ class ProgramManager:
     def _schedule_next_capture(self, period, function):
         """Schedules the next image capture and registers the timer.
 
-        Call it from search mode, after an image has been processed, or
-        in review mode if automatic exam removal detection is active.
+        Call it in review mode if automatic exam removal detection is
+        active. Search mode is paced by the camera through the
+        search pipeline instead.
 
         """
         current_time = time.time()
         self.next_capture += period
         if current_time > self.next_capture:
-            self.detection_context.dump_buffer((current_time
-                                                - self.next_capture))
             wait = 0.010
             self.next_capture = time.time() + 0.010
         else:
@@ -741,6 +927,17 @@ class ProgramManager:
         exam_data = self.exam_data
         self.detection_options = detection.ExamDetector.get_default_options()
         self.detection_options['error-logging'] = self.config['error-logging']
+        self.detection_options['pyramid-lines'] = self.config['pyramid-lines']
+        self.detection_options['multi-threshold'] = \
+                                        self.config['multi-threshold']
+        self.detection_options['frame-gate'] = self.config['frame-gate']
+        self.detection_options['grid-fit'] = self.config['grid-fit']
+        if self.config['table-engine'] in \
+                detection.ExamDetector.table_engines:
+            self.detection_options['table-engine'] = \
+                                        self.config['table-engine']
+        self.detection_options['timings-file'] = \
+                                        self.config.get('timings-file')
         if exam_data.id_num_digits and exam_data.id_num_digits > 0:
             self.detection_options['read-id'] = True
             self.detection_options['id-num-digits'] = exam_data.id_num_digits
@@ -20,6 +20,8 @@ import math
 import itertools
 import statistics
 
+import numpy as np
+
 
 # Data representation:
 # - points: tuples (x, y)
@@ -148,6 +150,55 @@ def walk_line(p0, p1):
             y = y + ystep
             error = error + deltax
 
+def walk_line_array(p0, p1):
+    """Vectorized version of walk_line.
+
+    Returns two numpy arrays (xs, ys) with the coordinates of exactly
+    the same points walk_line(p0, p1) generates, in the same order.
+
+    """
+    xs, ys, lengths = walk_lines_array([p0], [p1])
+    return xs[0], ys[0]
+
+def walk_lines_array(points_0, points_1):
+    """Walks several lines at once, as walk_line would do with each one.
+
+    Receives two sequences with the end points of the lines. Returns
+    (xs, ys, lengths): xs and ys are two-dimensional integer arrays
+    with a row of coordinates per line, and lengths is the number of
+    points of each line. Rows are padded at the end with the last
+    point of their line.
+
+    """
+    ends_0 = np.array(points_0, dtype=np.int64).reshape(-1, 2)
+    ends_1 = np.array(points_1, dtype=np.int64).reshape(-1, 2)
+    x0, y0 = ends_0[:, 0], ends_0[:, 1]
+    x1, y1 = ends_1[:, 0], ends_1[:, 1]
+    steep = np.abs(y1 - y0) > np.abs(x1 - x0)
+    # Swap coordinates of steep lines, and then ends if needed
+    x0, y0 = np.where(steep, y0, x0), np.where(steep, x0, y0)
+    x1, y1 = np.where(steep, y1, x1), np.where(steep, x1, y1)
+    swap = x0 > x1
+    x0, x1 = np.where(swap, x1, x0), np.where(swap, x0, x1)
+    y0, y1 = np.where(swap, y1, y0), np.where(swap, y0, y1)
+    deltax = x1 - x0
+    deltay = np.abs(y1 - y0)
+    ystep = np.where(y0 < y1, 1, -1)
+    lengths = deltax + 1
+    k = np.minimum(np.arange(lengths.max())[np.newaxis, :],
+                   deltax[:, np.newaxis])
+    # The error term of the algorithm becomes negative (and y moves)
+    # ceil((2 k deltay - deltax) / (2 deltax)) times in the first k steps
+    denominator = np.maximum(2 * deltax, 1)[:, np.newaxis]
+    moves = np.maximum(0, -((deltax[:, np.newaxis]
+                             - 2 * k * deltay[:, np.newaxis])
+                            // denominator))
+    major = x0[:, np.newaxis] + k
+    minor = y0[:, np.newaxis] + ystep[:, np.newaxis] * moves
+    xs = np.where(steep[:, np.newaxis], minor, major)
+    ys = np.where(steep[:, np.newaxis], major, minor)
+    return xs, ys, lengths
+
 def walk_line_ordered(p0, p1):
     """Wrapper for walk_line that guarantees that points go from p0 to p1."""
     x0, y0 = p0
@@ -204,6 +255,28 @@ def interpolate_line_progressive(p0, p1, num_points, factor):
     points[-1] = p1
     return points
 
+def interpolate_lines_progressive(points_0, points_1, num_points, factor):
+    """Vectorized version of interpolate_line_progressive.
+
+       Interpolates at once the lines from each point in points_0 to
+       the point at the same position in points_1. Returns an integer
+       array with shape (number of lines, num_points, 2): row k holds
+       the points interpolate_line_progressive would return for the
+       k-th line.
+
+       """
+    p0 = np.array(points_0, dtype=np.int64).reshape(-1, 1, 2)
+    p1 = np.array(points_1, dtype=np.int64).reshape(-1, 1, 2)
+    n = num_points - 1
+    h1 = 2.0 / n / (factor + 1)
+    delta = h1 * (factor - 1) / (n - 1)
+    i = np.arange(1, num_points + 1)
+    positions = h1 * (i - 1) + 0.5 * delta * (i * i - 3 * i + 2)
+    points = np.rint(p0 + (p1 - p0) * positions[:, np.newaxis])
+    points = points.astype(np.int64)
+    points[:, -1] = p1[:, 0]
+    return points
+
 # Functions on lines represented as rho, theta
 #
 def intersection(hline, vline):
@@ -217,6 +290,24 @@ def intersection(hline, vline):
     x = (rho2 - y * math.sin(theta2)) / math.cos(theta2)
     return round_point((x, y))
 
+def intersections_array(hlines, vlines):
+    """Returns the intersection points of every (nearly) horizontal line
+       with every (nearly) vertical line.
+
+       The result is an integer array with shape (len(hlines),
+       len(vlines), 2). The point at [i, j] is the one
+       intersection(hlines[i], vlines[j]) returns.
+
+       """
+    hlines = np.array(hlines, dtype=np.float64).reshape(-1, 1, 2)
+    vlines = np.array(vlines, dtype=np.float64).reshape(1, -1, 2)
+    rho1, theta1 = hlines[..., 0], hlines[..., 1]
+    rho2, theta2 = vlines[..., 0], vlines[..., 1]
+    y = (rho1 * np.cos(theta2) - rho2 * np.cos(theta1)) \
+        / np.sin(theta1 - theta2)
+    x = (rho2 - y * np.sin(theta2)) / np.cos(theta2)
+    return np.rint(np.stack((x, y), axis=-1)).astype(np.int64)
+
 def line_point(line, x = None, y = None):
     """Returns a point in the line with the given x or y coordinate.
        Either x or y must be None. Throws division by zero exception
@@ -60,6 +60,22 @@ def load_image_grayscale(filename):
 def load_image(filename, **kwargs):
     return cv2.imread(filename, **kwargs)
 
+def count_image_pages(filename):
+    """Returns the number of pages (frames) of a multi-page image file."""
+    return cv2.imcount(filename)
+
+def load_image_page(filename, page):
+    """Loads just one page of a multi-page image file (e.g. a TIFF scan).
+
+    Returns None if the page cannot be loaded.
+
+    """
+    success, pages = cv2.imreadmulti(filename, page, 1,
+                                     flags=cv2.IMREAD_COLOR)
+    if not success or not pages:
+        return None
+    return pages[0]
+
 
 # Drawing functions
 #
@@ -44,20 +44,82 @@ class SVMClassifier:
     def features_len(self):
         return self.features_extractor.features_len
 
+    def __getstate__(self):
+        # SVM objects cannot be pickled: copies (e.g. those sent to
+        # worker processes) get an untrained SVM of their own
+        state = self.__dict__.copy()
+        del state['svm']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.reset()
+
     def train(self, samples, params=None):
-        features = np.ndarray(shape=(len(samples), self.features_len),
-                              dtype='float32')
-        labels = np.ndarray(shape=(len(samples), 1), dtype='int32')
-        for i, sample in enumerate(samples):
-            features[i,:] = self.features_extractor.extract(sample)
-            labels[i] = sample.label
-        self.svm.trainAuto(features, cv2.ml.ROW_SAMPLE, labels)
+        features = self.extract_features(samples)
+        labels = np.array([sample.label for sample in samples],
+                          dtype='int32')
+        self.train_features(features, labels, params=params)
+
+    def train_features(self, features, labels, params=None):
+        """Trains with an already extracted feature matrix.
+
+        `labels` contains the label of each row of `features`. `params`
+        is a dictionary with the C and gamma parameters of the RBF
+        kernel SVM. Without them, they are chosen by `trainAuto`.
+
+        """
+        labels = np.asarray(labels, dtype='int32').reshape(len(labels), 1)
+        if params is None:
+            self.svm.trainAuto(features, cv2.ml.ROW_SAMPLE, labels)
+        else:
+            self.svm.setType(cv2.ml.SVM_C_SVC)
+            self.svm.setKernel(cv2.ml.SVM_RBF)
+            self.svm.setC(params['C'])
+            self.svm.setGamma(params['gamma'])
+            self.svm.train(features, cv2.ml.ROW_SAMPLE, labels)
 
     def classify(self, sample):
-        features = np.ndarray(shape=(1, self.features_len), dtype='float32')
-        features[0,:] = self.features_extractor.extract(sample)
+        return self.classify_batch([sample])[0]
+
+    def classify_batch(self, samples):
+        """Classifies several samples with just one call to the SVM.
+
+        Returns the list of labels, in the same order as `samples`.
+
+        """
+        if len(samples) == 0:
+            return []
+        return self.classify_features(self.extract_features(samples))
+
+    def classify_features(self, features):
+        """Classifies the rows of an already extracted feature matrix."""
         retval, prediction = self.svm.predict(features)
-        return int(prediction[0, 0])
+        return [int(label) for label in prediction[:, 0]]
+
+    def extract_features(self, samples, out=None):
+        """Returns the feature matrix of the samples (one row each).
+
+        The features are written into `out` if it is given, a float32
+        matrix with a row per sample. Features cached in the samples
+        for this extractor (see `feature_cache`) are copied instead of
+        being extracted again.
+
+        """
+        key = self.features_extractor.cache_key
+        cached = [sample.cached_features(key) for sample in samples]
+        missing = [i for i, row in enumerate(cached) if row is None]
+        if len(missing) == len(samples):
+            return self.features_extractor.extract_batch(samples, out=out)
+        features = preprocessing.feature_matrix(len(samples),
+                                                self.features_len, out=out)
+        for i, row in enumerate(cached):
+            if row is not None:
+                features[i] = row
+        if missing:
+            features[missing] = self.features_extractor.extract_batch(
+                                        [samples[i] for i in missing])
+        return features
 
     def reset(self):
         self.svm = cv2.ml.SVM_create()
@@ -83,6 +145,15 @@ class SVMDigitClassifier(SVMClassifier):
         weights = self.confusion_matrix[:, digit]
         return (digit, weights)
 
+    def classify_digit_batch(self, samples):
+        """Batch version of `classify_digit`: one SVM call for all samples.
+
+        Returns a list of (digit, weights) pairs.
+
+        """
+        return [(digit, self.confusion_matrix[:, digit]) \
+                for digit in self.classify_batch(samples)]
+
     @staticmethod
     def _load_confusion_matrix(filename):
         if filename:
@@ -103,10 +174,11 @@ class DefaultDigitClassifier(SVMDigitClassifier):
                         load_from_file=load_from_file,
                         confusion_matrix_from_file=confusion_matrix_from_file)
 
-    def train(self, samples, params=None):
-        super(DefaultDigitClassifier, self).train( \
-                                              samples,
-                                              dict(C=3.16227766, gamma=0.01))
+    def train_features(self, features, labels, params=None):
+        if params is None:
+            params = dict(C=3.16227766, gamma=0.01)
+        super(DefaultDigitClassifier, self).train_features( \
+                                              features, labels, params=params)
 
 
 class SVMCrossesClassifier(SVMClassifier):
@@ -117,6 +189,10 @@ class SVMCrossesClassifier(SVMClassifier):
     def is_cross(self, sample):
         return self.classify(sample) == 1
 
+    def is_cross_batch(self, samples):
+        """Returns a list of booleans, one per sample, with one SVM call."""
+        return [label == 1 for label in self.classify_batch(samples)]
+
 
 class DefaultCrossesClassifier(SVMCrossesClassifier):
     def __init__(self, load_from_file=DEFAULT_CROSS_CLASS_FILE):
@@ -124,7 +200,8 @@ class DefaultCrossesClassifier(SVMCrossesClassifier):
                         preprocessing.CrossesFeatureExtractor(),
                         load_from_file=load_from_file)
 
-    def train(self, samples, params=None):
-        super(DefaultCrossesClassifier, self).train( \
-                                              samples,
-                                              dict(C=100, gamma=0.01))
+    def train_features(self, features, labels, params=None):
+        if params is None:
+            params = dict(C=100, gamma=0.01)
+        super(DefaultCrossesClassifier, self).train_features( \
+                                              features, labels, params=params)
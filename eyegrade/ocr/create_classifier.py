@@ -18,7 +18,8 @@
 import json
 import argparse
 
-from . import sample
+from . import feature_cache
+from . import preprocessing
 from . import classifiers
 from . import evaluation
 
@@ -27,21 +28,23 @@ def save_metadata(filename, metadata):
     with open(filename, mode='w') as f:
         json.dump(metadata, f, indent=4, sort_keys=True)
 
-def k_fold_cross_evaluation(classifier, sample_set, rounds):
+def k_fold_cross_evaluation(classifier, sample_set, rounds, processes=None):
     classifier.reset()
     partitions = sample_set.partition(rounds)
-    e = evaluation.KFoldCrossEvaluation(classifier, partitions)
+    e = evaluation.KFoldCrossEvaluation(classifier, partitions,
+                                        processes=processes)
     return e
 
 def train_with_all(classifier, sample_set):
     classifier.reset()
     classifier.train(sample_set.samples())
 
-def create_digit_classifier(sample_set, rounds):
+def create_digit_classifier(sample_set, rounds, processes=None):
     classifier = classifiers.DefaultDigitClassifier( \
                                         load_from_file=None,
                                         confusion_matrix_from_file=None)
-    e = k_fold_cross_evaluation(classifier, sample_set, rounds)
+    e = k_fold_cross_evaluation(classifier, sample_set, rounds,
+                                processes=processes)
     metadata = {
         'performance': {
             'success_rate': e.success_rate,
@@ -57,9 +60,10 @@ def create_digit_classifier(sample_set, rounds):
     train_with_all(classifier, sample_set)
     classifier.save(classifiers.DEFAULT_DIG_CLASS_FILE)
 
-def create_crosses_classifier(sample_set, rounds):
+def create_crosses_classifier(sample_set, rounds, processes=None):
     classifier = classifiers.DefaultCrossesClassifier(load_from_file=None)
-    e = k_fold_cross_evaluation(classifier, sample_set, rounds)
+    e = k_fold_cross_evaluation(classifier, sample_set, rounds,
+                                processes=processes)
     print('Success rate: {} (balanced: {})'.format(e.success_rate,
                                                    e.success_rate_balanced))
     metadata = {
@@ -84,21 +88,33 @@ def _parse_args():
             help='index file with the samples for training/evaluation')
     parser.add_argument('--rounds', type=int, default=10,
             help='number of rounds for k-fold cross evaluation (default 100)')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+            help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--no-feature-cache', dest='feature_cache',
+            action='store_false',
+            help='do not read or write the features cached on disk')
     return parser.parse_args()
 
 def main():
     args = _parse_args()
 
-    # Load the sample set:
-    sample_set = sample.SampleSet()
-    for filename in args.sample_files:
-        sample_set.load_from_loader(sample.SampleLoader(filename))
+    # Load the sample set, with its features cached on disk:
+    extractor = None
+    if args.feature_cache:
+        if args.classifier == 'digits':
+            extractor = preprocessing.FeatureExtractor()
+        else:
+            extractor = preprocessing.CrossesFeatureExtractor()
+    sample_set = feature_cache.load_sample_set(args.sample_files,
+                                               features_extractor=extractor)
 
     # Perform a k-fold cross-evaluation and create the classifier:
     if args.classifier == 'digits':
-        create_digit_classifier(sample_set, args.rounds)
+        create_digit_classifier(sample_set, args.rounds,
+                                processes=args.processes)
     else:
-        create_crosses_classifier(sample_set, args.rounds)
+        create_crosses_classifier(sample_set, args.rounds,
+                                  processes=args.processes)
 
 
 if __name__ == '__main__':
@@ -16,34 +16,176 @@
 # <https://www.gnu.org/licenses/>.
 #
 import argparse
+import collections
+import json
 import math
+import os.path
 
 import numpy as np
 
-from . import sample
+from . import feature_cache
 from . import classifiers
 from . import evaluation
 
 
 def decide_params(classifier, sample_set, c_values, gamma_values,
-                  threshold=None, k=10):
+                  threshold=None, k=10, processes=None, results_file=None,
+                  min_folds=None, eta=3, seed=0):
+    """Cross-evaluates the classifier with every (C, gamma) of a grid.
+
+    The folds of all the points of the grid run in a pool of
+    `processes` processes. They run by rungs: with `min_folds`, the
+    first rung evaluates every point with `min_folds` folds, and each
+    next one evaluates the best 1/`eta` of the points with `eta` times
+    more folds, until the best points get all the `k` folds
+    (successive halving). Without it, every point is evaluated with
+    every fold, one fold per rung. After every rung, the points whose
+    success rate is below `threshold` are dropped too.
+
+    The confusion matrix of every finished fold is appended to
+    `results_file` if given, and the folds already in it are not
+    evaluated again. The file is only valid for the same samples, `k`
+    and `seed`; ValueError is raised otherwise. It is raised too when
+    `min_folds` is given and is less than 1, or `eta` is less than 2.
+
+    Returns the list of (success_rate, balanced_success_rate, C,
+    gamma) tuples and the matrix of success rates. The rates of the
+    points dropped come from the folds they were evaluated with.
+
+    """
+    if min_folds is not None and min_folds < 1:
+        raise ValueError('min_folds must be at least 1')
+    if eta < 2:
+        raise ValueError('eta must be at least 2')
+    partitions = sample_set.partition(k, seed=seed)
+    samples = [s for partition in partitions for s in partition]
+    features = classifier.extract_features(samples)
+    labels = np.array([s.label for s in samples], dtype='int32')
+    folds = evaluation.fold_indices(partitions, samples)
+    header = {
+        'extractor': classifier.features_extractor.cache_key,
+        'k': k,
+        'num_samples': len(samples),
+        'seed': seed,
+    }
+    done = _read_results(results_file, header)
+    points = [(c, gamma) for c in c_values for gamma in gamma_values]
+    alive = points
+    log = _open_results(results_file, header)
+    try:
+        with evaluation.FoldRunner(classifier, features, labels,
+                                   processes=processes) as runner:
+            for num_folds in _rungs(k, min_folds, eta):
+                tasks = [((c, gamma, i), folds[i][0], folds[i][1],
+                          dict(C=c, gamma=gamma)) \
+                         for c, gamma in alive for i in range(num_folds)
+                         if i not in done[(c, gamma)]]
+                for (c, gamma, i), matrix in runner.run(tasks,
+                                                        ordered=False):
+                    done[(c, gamma)][i] = matrix
+                    _append_result(log, c, gamma, i, matrix)
+                rates = {point: _success_rate(_confusion_matrix(
+                                                done[point], num_folds)) \
+                         for point in alive}
+                alive = sorted(alive, key=rates.get, reverse=True)
+                print('{} folds: {} points, best C: {}, gamma: {} ({})'\
+                      .format(num_folds, len(alive), alive[0][0],
+                              alive[0][1], rates[alive[0]]))
+                if threshold is not None:
+                    alive = [p for p in alive if rates[p] >= threshold]
+                if min_folds:
+                    alive = alive[:math.ceil(len(alive) / eta)]
+                if not alive:
+                    break
+    finally:
+        if log is not None:
+            log.close()
     results = []
     rmat = np.zeros(shape=(len(c_values), len(gamma_values)), dtype='float32')
-    partitions = sample_set.partition(k)
     for i, c in enumerate(c_values):
         for j, gamma in enumerate(gamma_values):
-            params = dict(C=c, gamma=gamma)
-            print('C: {}, gamma: {}'.format(c, gamma))
-            e = evaluation.KFoldCrossEvaluation(classifier, partitions,
-                                                training_params=params,
-                                                threshold=threshold)
-            result = (e.success_rate, e.success_rate_balanced, c, gamma)
-            results.append(result)
-            rmat[i, j] = e.success_rate
-            print(result)
-            print(rmat)
+            matrix = _confusion_matrix(done[(c, gamma)], k)
+            results.append((_success_rate(matrix),
+                            _balanced_success_rate(matrix), c, gamma))
+            rmat[i, j] = results[-1][0]
     return results, rmat
 
+def _rungs(k, min_folds, eta):
+    """Returns the number of folds evaluated up to each rung."""
+    if not min_folds:
+        return list(range(1, k + 1))
+    rungs = [min(min_folds, k)]
+    while rungs[-1] < k:
+        rungs.append(min(rungs[-1] * eta, k))
+    return rungs
+
+def _confusion_matrix(fold_matrices, num_folds):
+    matrices = [m for i, m in fold_matrices.items() if i < num_folds]
+    return sum(matrices[1:], matrices[0])
+
+def _success_rate(confusion_matrix):
+    return confusion_matrix.trace() / confusion_matrix.sum()
+
+def _balanced_success_rate(confusion_matrix):
+    matrix_r = (np.array(confusion_matrix, dtype='float32')
+                / np.sum(confusion_matrix, axis=1)[np.newaxis].T)
+    return np.mean(matrix_r.diagonal())
+
+def _read_results(filename, header):
+    """Returns the confusion matrices of the folds in a results file.
+
+    They are returned as a dictionary from (C, gamma) to dictionaries
+    from fold numbers to confusion matrices.
+
+    """
+    done = collections.defaultdict(dict)
+    if filename is None or not os.path.exists(filename):
+        return done
+    records = []
+    with open(filename) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # Line cut by an interrupted run
+                continue
+    if records and records[0] != header:
+        raise ValueError('{} contains the results of another search'\
+                         .format(filename))
+    for record in records[1:]:
+        done[(record['C'], record['gamma'])][record['fold']] = \
+            np.array(record['confusion_matrix'], dtype='int')
+    return done
+
+def _open_results(filename, header):
+    if filename is None:
+        return None
+    last_char = None
+    if os.path.exists(filename) and os.path.getsize(filename) > 0:
+        with open(filename, mode='rb') as f:
+            f.seek(-1, os.SEEK_END)
+            last_char = f.read(1)
+    log = open(filename, mode='a')
+    if last_char is None:
+        _write_record(log, header)
+    elif last_char != b'\n':
+        # A line cut by an interrupted run must not swallow the next one
+        log.write('\n')
+    return log
+
+def _append_result(log, c, gamma, fold, confusion_matrix):
+    if log is not None:
+        _write_record(log, {
+            'C': c,
+            'gamma': gamma,
+            'fold': fold,
+            'confusion_matrix': confusion_matrix.tolist(),
+        })
+
+def _write_record(log, record):
+    log.write(json.dumps(record, sort_keys=True) + '\n')
+    log.flush()
+
 def _parse_args():
     parser = argparse.ArgumentParser( \
             description='Look for the best SVM parameters.')
@@ -53,13 +195,33 @@ def _parse_args():
             help='index file with the samples for training/evaluation')
     parser.add_argument('--rounds', type=int, default=10,
             help='number of rounds for k-fold cross evaluation (default 10)')
-    return parser.parse_args()
+    parser.add_argument('-j', '--processes', type=int, default=None,
+            help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--results', default=None,
+            help=('file to append the result of every fold to, and from '
+                  'which an interrupted search is resumed'))
+    parser.add_argument('--min-folds', type=int, default=2,
+            help=('folds that every point is evaluated with before '
+                  'dropping the worst ones (default 2, 0 to evaluate '
+                  'all the points with all the folds)'))
+    parser.add_argument('--eta', type=int, default=3,
+            help='1/eta of the points are kept after each rung (default 3)')
+    parser.add_argument('--seed', type=int, default=0,
+            help='seed of the random partition of the samples (default 0)')
+    parser.add_argument('--no-feature-cache', dest='feature_cache',
+            action='store_false',
+            help='do not read or write the features cached on disk')
+    args = parser.parse_args()
+    if args.min_folds < 0:
+        parser.error('--min-folds must not be negative')
+    if args.eta < 2:
+        parser.error('--eta must be at least 2')
+    if args.min_folds == 0:
+        args.min_folds = None
+    return args
 
 def main():
     args = _parse_args()
-    sample_set = sample.SampleSet()
-    for filename in args.sample_files:
-        sample_set.load_from_loader(sample.SampleLoader(filename))
     if args.classifier == 'digits':
         classifier = classifiers.DefaultDigitClassifier( \
                                         load_from_file=None,
@@ -68,10 +230,15 @@ def main():
     else:
         classifier = classifiers.DefaultCrossesClassifier(load_from_file=None)
         threshold = 0.99
+    extractor = classifier.features_extractor if args.feature_cache else None
+    sample_set = feature_cache.load_sample_set(args.sample_files,
+                                               features_extractor=extractor)
     c_values = [math.pow(10, i) for i in np.linspace(0, 4, 9)]
     gamma_values = [math.pow(10, i) for i in np.linspace(-3, -1, 5)]
     r = decide_params(classifier, sample_set, c_values, gamma_values,
-                      threshold=threshold)
+                      threshold=threshold, k=args.rounds,
+                      processes=args.processes, results_file=args.results,
+                      min_folds=args.min_folds, eta=args.eta, seed=args.seed)
     print(r)
 
 if __name__ == '__main__':
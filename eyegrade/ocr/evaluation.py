@@ -15,10 +15,17 @@
 # along with this program.  If not, see
 # <https://www.gnu.org/licenses/>.
 #
+import multiprocessing
+
 import numpy as np
 
 from . import sample
 
+# Per-process state of the k-fold workers, initialized by _init_worker()
+_worker_classifier = None
+_worker_features = None
+_worker_labels = None
+
 
 class Evaluation:
     def __init__(self, classifier, samples):
@@ -40,41 +47,160 @@ class Evaluation:
         self.results = np.zeros(len(self.samples), dtype=bool)
         self.confusion_matrix = np.zeros(shape=(num_classes, num_classes),
                                          dtype='int')
-        for i, samp in enumerate(self.samples):
-            detected = self.classifier.classify(samp)
+        samples = list(self.samples)
+        detections = self.classifier.classify_batch(samples)
+        for i, (samp, detected) in enumerate(zip(samples, detections)):
             self.confusion_matrix[samp.label, detected] += 1
             self.results[i] = samp.check_label(detected)
         self.success_rate = sum(self.results) / len(self.results)
 
 
 class KFoldCrossEvaluation(Evaluation):
+    """K-fold cross evaluation, with the folds run in parallel.
+
+    The features of all the samples are extracted just once. Every fold
+    is then trained and evaluated in a pool of `processes` processes
+    (as many as CPUs by default), each one with its own copy of the
+    classifier. With `processes=1` the folds run in this process, one
+    after another. Folds are merged in order, so that the evaluation
+    stops at the same fold as a sequential one when the success rate
+    falls below `threshold`.
+
+    """
     def __init__(self, classifier, sample_sets, oversampling=False,
-                 training_params=None, threshold=None):
+                 training_params=None, threshold=None, processes=None):
         self.classifier = classifier
         self.sample_sets = sample_sets
         self.training_params = training_params
         self.threshold = threshold
+        self.processes = processes
         self._evaluate(oversampling=oversampling)
 
     def _evaluate(self, oversampling=False):
         num_classes = self.classifier.num_classes
         self.confusion_matrix = np.zeros(shape=(num_classes, num_classes),
                                          dtype='int')
-        for i, evaluation_set in enumerate(self.sample_sets):
-            training_set = sample.SampleSet()
-            training_set.load_from_sample_sets(self.sample_sets[:i])
-            training_set.load_from_sample_sets(self.sample_sets[i + 1:])
-            if oversampling:
-                training_set = training_set.oversample()
-            self.classifier.train(training_set.samples(),
-                                  params=self.training_params)
-            evaluation = Evaluation(self.classifier, evaluation_set)
-            self.confusion_matrix += evaluation.confusion_matrix
-            self.classifier.reset()
-            total = self.confusion_matrix.sum()
-            correct = self.confusion_matrix.diagonal().sum()
-            self.success_rate = correct / total
-            print('Round {}: {}'.format(i, self.success_rate))
-            if (self.threshold is not None
-                and self.success_rate < self.threshold):
-                break
+        samples = [s for sample_set in self.sample_sets for s in sample_set]
+        features = self.classifier.extract_features(samples)
+        labels = np.array([s.label for s in samples], dtype='int32')
+        folds = fold_indices(self.sample_sets, samples,
+                             oversampling=oversampling)
+        tasks = [(i, training, evaluation, self.training_params) \
+                 for i, (training, evaluation) in enumerate(folds)]
+        with FoldRunner(self.classifier, features, labels,
+                        processes=self.processes,
+                        max_tasks=len(tasks)) as runner:
+            for i, confusion_matrix in runner.run(tasks):
+                self.confusion_matrix += confusion_matrix
+                total = self.confusion_matrix.sum()
+                correct = self.confusion_matrix.diagonal().sum()
+                self.success_rate = correct / total
+                print('Round {}: {}'.format(i, self.success_rate))
+                if (self.threshold is not None
+                    and self.success_rate < self.threshold):
+                    break
+
+
+class FoldRunner:
+    """Trains and evaluates folds over the rows of a feature matrix.
+
+    Folds run in a pool of `processes` processes (as many as CPUs by
+    default), or in this process if `processes` is 1 or there is just
+    one task (`max_tasks`). Use it as a context manager: leaving the
+    block terminates the folds still running.
+
+    """
+    def __init__(self, classifier, features, labels, processes=None,
+                 max_tasks=None):
+        self.classifier = classifier
+        self.features = features
+        self.labels = labels
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if max_tasks is not None:
+            processes = min(processes, max_tasks)
+        self.pool = None
+        if processes > 1:
+            self.pool = multiprocessing.Pool(processes=processes,
+                                             initializer=_init_worker,
+                                             initargs=(classifier, features,
+                                                       labels))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+
+    def run(self, tasks, ordered=True):
+        """Runs (key, training, evaluation, params) tasks.
+
+        Yields a (key, confusion_matrix) pair per task (see
+        `evaluate_fold`), in the order of `tasks` if `ordered`,
+        or else as soon as they finish.
+
+        """
+        if self.pool is None:
+            for key, training, evaluation, params in tasks:
+                yield key, evaluate_fold(self.classifier, self.features,
+                                         self.labels, training, evaluation,
+                                         params=params)
+        elif ordered:
+            yield from self.pool.imap(_run_task, tasks)
+        else:
+            yield from self.pool.imap_unordered(_run_task, tasks)
+
+
+def fold_indices(sample_sets, samples, oversampling=False):
+    """Returns the (training, evaluation) row indices of each fold.
+
+    Each sample set is the evaluation set of a fold, and the rest of
+    them its training set. Rows are the positions of the samples in
+    `samples`.
+
+    """
+    rows = {id(s): i for i, s in enumerate(samples)}
+    folds = []
+    for i, evaluation_set in enumerate(sample_sets):
+        training_set = sample.SampleSet()
+        training_set.load_from_sample_sets(sample_sets[:i])
+        training_set.load_from_sample_sets(sample_sets[i + 1:])
+        if oversampling:
+            training_set = training_set.oversample()
+        training = np.array([rows[id(s)] for s in training_set],
+                            dtype=np.intp)
+        evaluation = np.array([rows[id(s)] for s in evaluation_set],
+                              dtype=np.intp)
+        folds.append((training, evaluation))
+    return folds
+
+def evaluate_fold(classifier, features, labels, training, evaluation,
+                  params=None):
+    """Trains with some rows of a feature matrix and classifies others.
+
+    `training` and `evaluation` are row indices. Returns the confusion
+    matrix of the evaluation rows. The classifier is reset afterwards.
+
+    """
+    classifier.train_features(features[training], labels[training],
+                              params=params)
+    detected = classifier.classify_features(features[evaluation])
+    num_classes = classifier.num_classes
+    confusion_matrix = np.zeros(shape=(num_classes, num_classes), dtype='int')
+    np.add.at(confusion_matrix, (labels[evaluation], detected), 1)
+    classifier.reset()
+    return confusion_matrix
+
+def _init_worker(classifier, features, labels):
+    global _worker_classifier, _worker_features, _worker_labels
+    _worker_classifier = classifier
+    _worker_features = features
+    _worker_labels = labels
+
+def _run_task(task):
+    key, training, evaluation, params = task
+    return key, evaluate_fold(_worker_classifier, _worker_features,
+                              _worker_labels, training, evaluation,
+                              params=params)
@@ -0,0 +1,151 @@
+# Eyegrade: grading multiple choice questions with a webcam
+# Copyright (C) 2010-2018 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+"""On-disk cache of the features of training samples.
+
+The features of the samples of an index file are stored next to it,
+in a .npy matrix that is memory-mapped when loaded and a .json file
+with the key of each row. A key is made of the path of the image
+(relative to the index), its modification time and the corners of
+the sample, so that editing an image or its corners invalidates its
+row. Caches are separate for every extractor and set of extractor
+parameters.
+
+"""
+import hashlib
+import json
+import os
+import os.path
+
+import numpy as np
+
+from . import sample
+
+
+class FeatureCache:
+    def __init__(self, filename, features_extractor):
+        """Cache stored in `filename`.npy and `filename`.json."""
+        self.filename = filename
+        self.features_extractor = features_extractor
+        self.dirname = os.path.dirname(os.path.abspath(filename))
+        self._matrix_file = filename + '.npy'
+        self._keys_file = filename + '.json'
+
+    @classmethod
+    def for_index(cls, index_filename, features_extractor):
+        """Returns the cache of the samples of an index file."""
+        digest = hashlib.sha1(
+            features_extractor.cache_key.encode('utf-8')).hexdigest()
+        return cls('{}.features-{}'.format(index_filename, digest[:10]),
+                   features_extractor)
+
+    def load_features(self, samples):
+        """Attaches the features of the extractor to the samples.
+
+        The features of the samples that are not in the cache yet
+        are extracted and the cache is rewritten with exactly the
+        samples given. Samples without an image file are ignored.
+        Afterwards, `sample.cached_features` returns a row of the
+        memory-mapped matrix for each of the rest.
+
+        Returns the number of samples whose features were extracted.
+
+        """
+        samples = [s for s in samples if s.image_filename]
+        keys = [self._sample_key(s) for s in samples]
+        matrix, rows = self._read()
+        missing = [i for i, key in enumerate(keys) if key not in rows]
+        if missing or len(rows) != len(set(keys)):
+            features, unique_keys = self._merge(matrix, rows, samples,
+                                                keys, missing)
+            # The old matrix must be unmapped before replacing its file
+            matrix = None
+            self._write(features, unique_keys)
+            matrix, rows = self._read()
+        extractor_key = self.features_extractor.cache_key
+        for samp, key in zip(samples, keys):
+            samp.cache_features(extractor_key, matrix[rows[key]])
+        return len(missing)
+
+    def _merge(self, matrix, rows, samples, keys, missing):
+        """Builds the new matrix from cached and extracted features."""
+        unique_keys = list(dict.fromkeys(keys))
+        new_rows = {key: i for i, key in enumerate(unique_keys)}
+        features = np.empty((len(unique_keys),
+                             self.features_extractor.features_len),
+                            dtype=np.float32)
+        extracted = self.features_extractor.extract_batch(
+                                        [samples[i] for i in missing])
+        for i, row in zip(missing, extracted):
+            features[new_rows[keys[i]]] = row
+        for key, i in new_rows.items():
+            if key in rows:
+                features[i] = matrix[rows[key]]
+        return features, unique_keys
+
+    def _read(self):
+        try:
+            with open(self._keys_file) as f:
+                metadata = json.load(f)
+            matrix = np.load(self._matrix_file, mmap_mode='r')
+        except (OSError, ValueError):
+            return None, {}
+        if (metadata.get('extractor') != self.features_extractor.cache_key
+            or matrix.shape != (len(metadata['keys']),
+                                self.features_extractor.features_len)):
+            return None, {}
+        return matrix, {key: i for i, key in enumerate(metadata['keys'])}
+
+    def _write(self, features, keys):
+        # Written first to temporary files and then renamed, so that an
+        # interrupted run never leaves a half-written cache behind.
+        metadata = {
+            'extractor': self.features_extractor.cache_key,
+            'keys': keys,
+        }
+        tmp_matrix = self._matrix_file + '.tmp'
+        tmp_keys = self._keys_file + '.tmp'
+        with open(tmp_matrix, mode='wb') as f:
+            np.save(f, features)
+        with open(tmp_keys, mode='w') as f:
+            json.dump(metadata, f)
+        os.replace(tmp_matrix, self._matrix_file)
+        os.replace(tmp_keys, self._keys_file)
+
+    def _sample_key(self, samp):
+        path = os.path.abspath(samp.image_filename)
+        mtime = os.stat(path).st_mtime_ns
+        corners = ' '.join(str(int(c)) for c in samp.corners.ravel())
+        return '{}\t{}\t{}'.format(os.path.relpath(path, self.dirname),
+                                   mtime, corners)
+
+
+def load_sample_set(index_filenames, features_extractor=None):
+    """Loads a sample set from index files.
+
+    If a feature extractor is given, the features of the samples of
+    every index file are loaded from (or stored into) its cache.
+
+    """
+    sample_set = sample.SampleSet()
+    for filename in index_filenames:
+        samples = sample.SampleLoader(filename).samples()
+        if features_extractor is not None:
+            cache = FeatureCache.for_index(filename, features_extractor)
+            cache.load_features(samples)
+        sample_set.load_from_samples(samples)
+    return sample_set
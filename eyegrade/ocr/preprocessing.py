@@ -15,6 +15,7 @@
 # along with this program.  If not, see
 # <https://www.gnu.org/licenses/>.
 #
+import functools
 
 import cv2
 import numpy as np
@@ -32,36 +33,66 @@ class FeatureExtractor:
         self.dim = dim
 
     def extract(self, sample):
-        image = self._reshape(sample)
-        image = deskew(image, self.dim)
-        image = clear_boundbox(image)
-        image = cv2.resize(image, (self.dim, self.dim))
-        image_matrix = np.array(image, np.float32) / 255.0
-        feature_vector = image_matrix.reshape(self.features_len, )
-        return feature_vector
+        return self.extract_batch([sample])[0]
+
+    def extract_batch(self, samples, out=None):
+        """Returns the feature matrix of the samples (one row each).
+
+        The features are written into `out` if it is given (see
+        `feature_matrix`). The images of the intermediate steps are
+        reused from one sample to the next.
+
+        """
+        features = feature_matrix(len(samples), self.features_len, out=out)
+        buffers = {}
+        deskewed = np.empty((self.dim, self.dim), dtype=np.uint8)
+        resized = np.empty((self.dim, self.dim), dtype=np.uint8)
+        for i, sample in enumerate(samples):
+            image = self._reshape(sample, buffers=buffers)
+            image = deskew(image, self.dim, dst=deskewed)
+            image = clear_boundbox(image)
+            cv2.resize(image, (self.dim, self.dim), dst=resized)
+            np.divide(resized, np.float32(255.0),
+                      out=features[i].reshape(self.dim, self.dim))
+        return features
 
     @property
     def features_len(self):
         return self.dim * self.dim
 
+    @property
+    def cache_key(self):
+        """Identifies the extractor and its parameters in feature caches."""
+        return '{}(dim={})'.format(type(self).__name__, self.dim)
+
     @staticmethod
-    def _project_to_rectangle(sample, width, height):
+    def _project_to_rectangle(sample, width, height, dst=None):
         p = sample.corners
-        corners_dst = np.array([[0, 0],
-                                [width - 1, 0],
-                                [0, height - 1],
-                                [width - 1, height - 1]],
-                                dtype='float32')
-        h = cv2.findHomography(np.array(p, dtype='float32'), corners_dst)
-        image = cv2.warpPerspective(sample.image, h[0], (width, height))
-        return cv2.threshold(image, 64, 255, cv2.THRESH_BINARY)[1]
+        h = cv2.findHomography(np.array(p, dtype='float32'),
+                               rectangle_corners(width, height))
+        image = cv2.warpPerspective(sample.image, h[0], (width, height),
+                                    dst=dst)
+        return cv2.threshold(image, 64, 255, cv2.THRESH_BINARY, dst=image)[1]
 
     @staticmethod
-    def _reshape(sample):
+    def _reshape(sample, buffers=None):
+        """Projects the sample to a rectangle of about its size.
+
+        `buffers` is a dictionary from sizes to images of that size
+        to project into. Missing sizes are added to it.
+
+        """
         p = sample.corners
         width = int((cv2.norm(p[0,:], p[1,:]) + cv2.norm(p[2,:], p[3,:])) / 2)
         height = int((cv2.norm(p[0,:], p[2,:]) + cv2.norm(p[1,:], p[3,:])) / 2)
-        return FeatureExtractor._project_to_rectangle(sample, width, height)
+        dst = None
+        if buffers is not None and width > 0 and height > 0:
+            dst = buffers.get((width, height))
+            if dst is None:
+                dst = np.empty((height, width), dtype=np.uint8)
+                buffers[(width, height)] = dst
+        return FeatureExtractor._project_to_rectangle(sample, width, height,
+                                                      dst=dst)
 
 
 class CrossesFeatureExtractor(FeatureExtractor):
@@ -71,34 +102,70 @@ class CrossesFeatureExtractor(FeatureExtractor):
     def __init__(self, dim=28):
         super(CrossesFeatureExtractor, self).__init__(dim=dim)
 
-    def extract(self, sample):
-        image = self._project_to_rectangle(sample, self.dim, self.dim)
-#        image = cv2.resize(image, (self.dim, self.dim))
-        image_matrix = np.array(image, np.float32) / 255.0
-        feature_vector = image_matrix.reshape(self.features_len, )
-        return feature_vector
+    def extract_batch(self, samples, out=None):
+        """Returns the feature matrix of the samples (one row each).
+
+        The features are written into `out` if it is given (see
+        `feature_matrix`). When all the samples come from the same
+        image (the cells of an exam capture) the image is warped just
+        once for all of them, instead of once per cell.
+
+        """
+        features = feature_matrix(len(samples), self.features_len, out=out)
+        if (len(samples) < 2
+            or any(s.image is not samples[0].image for s in samples)):
+            warped = np.empty((self.dim, self.dim), dtype=np.uint8)
+            for i, sample in enumerate(samples):
+                self._project_to_rectangle(sample, self.dim, self.dim,
+                                           dst=warped)
+                np.divide(warped, np.float32(255.0),
+                          out=features[i].reshape(self.dim, self.dim))
+            return features
+        corners = np.array([s.corners for s in samples], dtype=np.float64)
+        cells = project_to_rectangles(samples[0].image, corners,
+                                      self.dim, self.dim)
+        np.divide(cells.reshape(len(samples), self.features_len),
+                  np.float32(255.0), out=features)
+        return features
 
 
 class OpenCVExampleExtractor:
     def __init__(self, dim=20, threshold=False):
         self.dim = dim
         self.threshold = threshold
-        self._corners_dst = np.array([[0, 0],
-                                      [dim - 1, 0],
-                                      [0, dim - 1],
-                                      [dim - 1, dim - 1]],
-                                     dtype='float32')
+        self._corners_dst = rectangle_corners(dim, dim)
         self.features_len = 64
 
+    @property
+    def cache_key(self):
+        """Identifies the extractor and its parameters in feature caches."""
+        return '{}(dim={}, threshold={})'.format(type(self).__name__,
+                                                 self.dim, self.threshold)
+
     def extract(self, sample):
-        corners = np.array(sample.corners, dtype='float32')
-        h = cv2.findHomography(corners, self._corners_dst)
-        image = cv2.warpPerspective(sample.image, h[0], (self.dim, self.dim))
-        if self.threshold:
-            image = cv2.threshold(image, 64, 255, cv2.THRESH_BINARY)[1]
-        image = deskew(image, self.dim)
-        feature_vector = self._preprocess_hog(image)
-        return feature_vector
+        return self.extract_batch([sample])[0]
+
+    def extract_batch(self, samples, out=None):
+        """Returns the feature matrix of the samples (one row each).
+
+        The features are written into `out` if it is given (see
+        `feature_matrix`). The warped and deskewed images are reused
+        from one sample to the next.
+
+        """
+        features = feature_matrix(len(samples), self.features_len, out=out)
+        warped = np.empty((self.dim, self.dim), dtype=np.uint8)
+        deskewed = np.empty((self.dim, self.dim), dtype=np.uint8)
+        for i, sample in enumerate(samples):
+            corners = np.array(sample.corners, dtype='float32')
+            h = cv2.findHomography(corners, self._corners_dst)
+            image = cv2.warpPerspective(sample.image, h[0],
+                                        (self.dim, self.dim), dst=warped)
+            if self.threshold:
+                cv2.threshold(image, 64, 255, cv2.THRESH_BINARY, dst=image)
+            image = deskew(image, self.dim, dst=deskewed)
+            features[i] = self._preprocess_hog(image)
+        return features
 
     def _preprocess_hog(self, image):
         gx = cv2.Sobel(image, cv2.CV_32F, 1, 0)
@@ -119,51 +186,181 @@ class OpenCVExampleExtractor:
         return np.float32(hist)
 
 
-def deskew(image, dim):
+def feature_matrix(num_samples, features_len, out=None):
+    """Returns a float32 matrix for the features of several samples.
+
+    It has a row of `features_len` values per sample. If `out` is
+    given, it is returned instead of a new matrix, and it must have
+    that shape and type.
+
+    """
+    shape = (num_samples, features_len)
+    if out is None:
+        return np.empty(shape, dtype=np.float32)
+    if out.shape != shape or out.dtype != np.float32:
+        raise ValueError('Expected a float32 matrix of shape {0}'\
+                         .format(shape))
+    return out
+
+@functools.lru_cache(maxsize=64)
+def rectangle_corners(width, height):
+    """Returns the corners of a width x height image, as float32.
+
+    They are in the order of the corners of samples: left-up,
+    right-up, left-bottom and right-bottom. The array is shared by
+    all the callers, and therefore read-only.
+
+    """
+    corners = np.array([[0, 0],
+                        [width - 1, 0],
+                        [0, height - 1],
+                        [width - 1, height - 1]],
+                       dtype=np.float32)
+    corners.flags.writeable = False
+    return corners
+
+def project_to_rectangles(image, corners, width, height):
+    """Projects several quadrilaterals of an image to width x height cells.
+
+    `corners` is a (n, 4, 2) array with the corners of each
+    quadrilateral (left-up, right-up, left-bottom, right-bottom).
+    The result is a (n, height, width) array with the same contents
+    `FeatureExtractor._project_to_rectangle` would produce for each
+    quadrilateral, but the homographies of all of them are solved
+    together and the image is warped with a few `cv2.remap` calls,
+    each one filling a strip that holds a block of cells one below
+    the other.
+
+    """
+    num_cells = len(corners)
+    cells = np.zeros((num_cells, height, width), dtype=np.uint8)
+    if num_cells == 0:
+        return cells
+    corners_dst = np.array([[0, 0],
+                            [width - 1, 0],
+                            [0, height - 1],
+                            [width - 1, height - 1]],
+                           dtype=np.float64)
+    h = _homographies(corners_dst, np.asarray(corners, dtype=np.float64))
+    h = h[:, :, :, np.newaxis, np.newaxis]
+    u = np.arange(width, dtype=np.float64)[np.newaxis, :]
+    v = np.arange(height, dtype=np.float64)[:, np.newaxis]
+    block = max(1, min(_REMAP_BLOCK_CELLS, _MAX_REMAP_ROWS // height))
+    for first in range(0, num_cells, block):
+        hb = h[first:first + block]
+        strip = cells[first:first + block].reshape(-1, width)
+        # Source coordinates of every pixel of the cells, in the
+        # fixed-point representation cv2.warpPerspective would use
+        w = (hb[:, 2, 0] * u) + (hb[:, 2, 1] * v + hb[:, 2, 2])
+        w = np.divide(_INTER_TAB_SIZE, w, out=np.zeros_like(w), where=w != 0)
+        x = ((hb[:, 0, 0] * u) + (hb[:, 0, 1] * v + hb[:, 0, 2])) * w
+        y = ((hb[:, 1, 0] * u) + (hb[:, 1, 1] * v + hb[:, 1, 2])) * w
+        x = np.clip(np.rint(x, out=x), _MAP_MIN, _MAP_MAX, out=x)\
+            .astype(np.int32).reshape(strip.shape)
+        y = np.clip(np.rint(y, out=y), _MAP_MIN, _MAP_MAX, out=y)\
+            .astype(np.int32).reshape(strip.shape)
+        map1 = np.empty(strip.shape + (2,), dtype=np.int16)
+        map1[:, :, 0] = x >> _INTER_BITS
+        map1[:, :, 1] = y >> _INTER_BITS
+        map2 = (((y & (_INTER_TAB_SIZE - 1)) << _INTER_BITS)
+                | (x & (_INTER_TAB_SIZE - 1))).astype(np.uint16)
+        cv2.remap(image, map1, map2, cv2.INTER_LINEAR, dst=strip,
+                  borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    strip = cells.reshape(-1, width)
+    cv2.threshold(strip, 64, 255, cv2.THRESH_BINARY, dst=strip)
+    return cells
+
+# Fixed-point representation of remap coordinates, as used by OpenCV
+_INTER_BITS = 5
+_INTER_TAB_SIZE = 1 << _INTER_BITS
+_MAP_MIN = -32768 * _INTER_TAB_SIZE
+_MAP_MAX = 32767 * _INTER_TAB_SIZE
+# Cells warped per remap call (keeps the maps small enough for the cache)
+_REMAP_BLOCK_CELLS = 64
+_MAX_REMAP_ROWS = 32766
+
+def _homographies(points_src, points_dst):
+    """Solves the homographies that map points_src to each points_dst.
+
+    `points_src` is a (4, 2) array and `points_dst` a (n, 4, 2) array.
+    Returns a (n, 3, 3) array.
+
+    """
+    num = len(points_dst)
+    a = np.zeros((num, 8, 8), dtype=np.float64)
+    b = np.zeros((num, 8), dtype=np.float64)
+    for k, (x, y) in enumerate(points_src):
+        big_x = points_dst[:, k, 0]
+        big_y = points_dst[:, k, 1]
+        a[:, 2 * k, 0] = x
+        a[:, 2 * k, 1] = y
+        a[:, 2 * k, 2] = 1
+        a[:, 2 * k, 6] = -x * big_x
+        a[:, 2 * k, 7] = -y * big_x
+        a[:, 2 * k + 1, 3] = x
+        a[:, 2 * k + 1, 4] = y
+        a[:, 2 * k + 1, 5] = 1
+        a[:, 2 * k + 1, 6] = -x * big_y
+        a[:, 2 * k + 1, 7] = -y * big_y
+        b[:, 2 * k] = big_x
+        b[:, 2 * k + 1] = big_y
+    h = np.ones((num, 9), dtype=np.float64)
+    h[:, :8] = np.linalg.solve(a, b[:, :, np.newaxis])[:, :, 0]
+    return h.reshape(num, 3, 3)
+
+def deskew(image, dim, dst=None):
     """Deskew an image.
 
     It improves classifier performance.
-    The image must be a cv2 image.
+    The image must be a cv2 image. The result is a dim x dim image,
+    written into `dst` if it is given, except when the skew is
+    negligible: then `image` itself is returned, and therefore the
+    result must not be modified.
 
     """
     affine_flags = cv2.WARP_INVERSE_MAP | cv2.INTER_LINEAR
     m = cv2.moments(image)
     if abs(m['mu02']) < 1e-2:
-        return image.copy()
+        return image
     skew = m['mu11'] / m['mu02']
     M = np.float32([[1, skew, -0.5 * dim * skew], [0, 1, 0]])
-    image = cv2.warpAffine(image, M, (dim, dim), flags=affine_flags)
-    return image
+    return cv2.warpAffine(image, M, (dim, dim), dst=dst, flags=affine_flags)
 
 def clear_boundbox(image):
     """Clear the blank surrounding area of an image.
 
     It improves classifier performance.
-    The image must be a cv2 image.
+    The image must be a cv2 image. Returns a view of it.
+
+    The area starts at the first row that is non-blank along with
+    the next one, and at the first non-blank column whose second
+    next column is also non-blank (or that is one of the two last
+    columns). It ends before the next blank row and column.
+
+    """
+    rows = np.any(image, axis=1)
+    columns = np.any(image, axis=0)
+    top, bot = _boundbox_range(rows, 1)
+    left, right = _boundbox_range(columns, 2)
+    return image[top:bot, left:right]
+
+def _boundbox_range(non_blank, step):
+    """Returns the range of `clear_boundbox` along one axis.
+
+    `non_blank` tells which rows (or columns) are non-blank. The
+    range starts at the first one that is non-blank, as well as the
+    one `step` positions after it (if any). It ends at the next
+    blank one. If there is no start, the range is the whole axis.
 
     """
-    top = 0
-    bot = image.shape[0]
-    right = image.shape[1]
-    left = 0
-    it = 0
-    for index, row in enumerate(image):
-        if not np.all(row == 0) and it == 0:
-            if index == image.shape[0] or not np.all(image[index + 1] == 0):
-                top = index
-                it = 1
-        elif np.all(row == 0) and it == 1:
-            bot = index
-            break
-    it = 0
-    for index, col in enumerate(image.T):
-        if (not np.all(col == 0)) and it == 0:
-            if (index + 2 >= image.shape[1]
-                    or not np.all(image.T[index + 2] == 0)):
-                left = index
-                it = 1
-        elif np.all(col == 0) and it == 1:
-            right = index
-            break
-    cleared_image = image[top:bot, left:right]
-    return cleared_image
+    length = len(non_blank)
+    starts = non_blank.copy()
+    starts[:-step] &= non_blank[step:]
+    starts = np.flatnonzero(starts)
+    if len(starts) == 0:
+        return 0, length
+    first = starts[0]
+    blank = np.flatnonzero(~non_blank[first + 1:])
+    if len(blank) == 0:
+        return first, length
+    return first, first + 1 + blank[0]
@@ -36,7 +36,7 @@ class Sample:
         self.image_filename = image_filename
         self.label = label
         self._image = image
-        self._features = None
+        self._features = {}
 
     @property
     def image(self):
@@ -47,6 +47,13 @@ class Sample:
                                  .format(self.image_filename))
         return self._image
 
+    def cached_features(self, extractor_key):
+        """Returns the features cached for the given extractor, or None."""
+        return self._features.get(extractor_key)
+
+    def cache_features(self, extractor_key, features):
+        self._features[extractor_key] = features
+
     def check_label(self, label):
         return self.label == label
 
@@ -129,19 +136,26 @@ class SampleSet:
             iterator = self._iterate_samples()
         return iterator
 
-    def partition(self, num_groups):
+    def partition(self, num_groups, seed=None):
+        """Splits the samples at random into `num_groups` sample sets.
+
+        The same `seed` gives the same partitions of the same samples.
+
+        """
         total_samples = len(self)
         partition_lens = [total_samples // num_groups] * num_groups
         for i in range(total_samples % num_groups):
             partition_lens[i] += 1
         partitions = []
-        samples = set(self.samples())
+        samples = self.samples()
+        random.Random(seed).shuffle(samples)
+        start = 0
         for partition_len in partition_lens:
-            partition = random.sample(samples, partition_len)
-            samples -= set(partition)
             sample_set = SampleSet()
-            sample_set.load_from_samples(partition)
+            sample_set.load_from_samples(
+                                    samples[start:start + partition_len])
             partitions.append(sample_set)
+            start += partition_len
         return partitions
 
     def oversample(self):
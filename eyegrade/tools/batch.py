@@ -0,0 +1,293 @@
+# Eyegrade: grading multiple choice questions with a webcam
+# Copyright (C) 2010-2018 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+"""Grades a batch of scanned answer sheets without the GUI.
+
+Detection is distributed over a pool of processes. Each process owns
+its own detection context (and therefore its own SVM classifiers).
+Results are stored, in input order, into an existing session.
+
+"""
+import argparse
+import glob
+import multiprocessing
+import os
+import os.path
+import sys
+import time
+
+import cv2
+
+from .. import detection
+from .. import exams
+from .. import images
+from .. import sessiondb
+from .. import utils
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.pbm', '.pgm',
+                    '.ppm', '.tif', '.tiff')
+MULTI_PAGE_EXTENSIONS = ('.tif', '.tiff')
+
+# Per-process state, initialized by _init_worker()
+_worker_context = None
+_worker_dimensions = None
+_worker_options = None
+_worker_width = None
+_worker_error = None
+
+
+class SheetResult:
+    """Outcome of the detection of one sheet, sent back by the workers."""
+
+    def __init__(self, source, success, capture=None, decisions=None,
+                 status=None, error=None):
+        self.source = source
+        self.success = success
+        self.capture = capture
+        self.decisions = decisions
+        self.status = status
+        self.error = error
+
+
+def _cmd_options():
+    parser = argparse.ArgumentParser(
+        description='Grade a batch of scanned answer sheets into a session.')
+    parser.add_argument('session',
+                        help='Directory of an existing Eyegrade session')
+    parser.add_argument('inputs', metavar='input', nargs='+',
+                        help=('Image file, directory, glob pattern '
+                              'or multi-page TIFF file'))
+    parser.add_argument('-j', '--processes',
+                        dest='processes',
+                        type=int,
+                        default=None,
+                        help=('Number of worker processes '
+                              '(default: number of CPUs)'))
+    parser.add_argument('-w', '--width',
+                        dest='width',
+                        type=int,
+                        default=None,
+                        help=('Scale images to this width before detection '
+                              '(default: keep the original size)'))
+    parser.add_argument('-n', '--dry-run',
+                        dest='dry_run',
+                        action='store_true',
+                        help='Detect, but do not store anything in the session')
+    return parser.parse_args()
+
+def expand_inputs(inputs):
+    """Returns the list of (filename, page) sheets to be processed.
+
+    `inputs` may contain image files, directories (their image files
+    are taken in name order), glob patterns and multi-page TIFF
+    files. `page` is None for single-page image files.
+
+    """
+    filenames = []
+    for item in inputs:
+        if os.path.isdir(item):
+            filenames.extend(sorted(
+                os.path.join(item, name) for name in os.listdir(item)
+                if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS))
+        elif glob.has_magic(item):
+            filenames.extend(sorted(glob.glob(item)))
+        else:
+            filenames.append(item)
+    sheets = []
+    for filename in filenames:
+        extension = os.path.splitext(filename)[1].lower()
+        if extension in MULTI_PAGE_EXTENSIONS and os.path.isfile(filename):
+            num_pages = images.count_image_pages(filename)
+            if num_pages > 1:
+                sheets.extend((filename, page) for page in range(num_pages))
+                continue
+        sheets.append((filename, None))
+    return sheets
+
+def format_source(source):
+    filename, page = source
+    if page is None:
+        return filename
+    else:
+        return '{0}[{1}]'.format(filename, page)
+
+def detection_options(exam_config):
+    """Detection options for an exam, as the GUI sets them for grading."""
+    options = detection.ExamDetector.get_default_options()
+    if exam_config.id_num_digits and exam_config.id_num_digits > 0:
+        options['read-id'] = True
+        options['id-num-digits'] = exam_config.id_num_digits
+    options['left-to-right-numbering'] = exam_config.left_to_right_numbering
+    # Scanned sheets are usually much larger than webcam frames
+    options['pyramid-lines'] = True
+    return options
+
+def _init_worker(dimensions, options, width):
+    global _worker_context, _worker_dimensions, _worker_options, _worker_width
+    global _worker_error
+    try:
+        _worker_context = detection.ExamDetectorContext()
+    except Exception as e:
+        # An initializer that raises would make the pool start new
+        # workers forever: report the error for every sheet instead
+        _worker_error = 'cannot create the detection context: {0}'.format(e)
+        return
+    # Thresholds are chosen explicitly for every sheet by _detect_sheet
+    _worker_context.lock_threshold()
+    _worker_dimensions = dimensions
+    _worker_options = options
+    _worker_width = width
+
+def _load_sheet(source):
+    filename, page = source
+    if page is None:
+        image = images.load_image(filename)
+    else:
+        image = images.load_image_page(filename, page)
+    if image is not None and _worker_width is not None:
+        if images.width(image) != _worker_width:
+            height = int(round(images.height(image) * _worker_width
+                               / images.width(image)))
+            image = cv2.resize(image, (_worker_width, height),
+                               interpolation=cv2.INTER_AREA)
+    return image
+
+def _detect_sheet(source):
+    """Detects one sheet. Runs in a worker process.
+
+    The Hough thresholds are tried in order, starting from the one
+    that worked for the previous sheet of this process: consecutive
+    sheets of a scanner batch usually share the same threshold.
+
+    """
+    if _worker_error is not None:
+        return SheetResult(source, False, error=_worker_error)
+    image = _load_sheet(source)
+    if image is None:
+        return SheetResult(source, False, error='cannot load the image')
+    context = _worker_context
+    num_thresholds = len(context.hough_thresholds)
+    first_idx = context.hough_thresholds_idx
+    detector = None
+    for i in range(num_thresholds):
+        if detector is not None:
+            detector.release()
+        context.hough_thresholds_idx = (first_idx + i) % num_thresholds
+        detector = detection.ExamDetector(_worker_dimensions, context,
+                                          _worker_options, image_raw=image)
+        detector.detect_safe()
+        if detector.success:
+            break
+    if not detector.success:
+        detector.release()
+        context.hough_thresholds_idx = first_idx
+        return SheetResult(source, False, status=detector.status,
+                           error='detection failed')
+    # The drawn image is rebuilt in the main process: don't send it back
+    detector.capture.image_drawn = None
+    return SheetResult(source, True, capture=detector.capture,
+                       decisions=detector.decisions, status=detector.status)
+
+def _create_exam(session, result, exam_id):
+    """Returns (exam, error_message) for a successfully detected sheet."""
+    exam_config = session.exam_config
+    model = result.decisions.model
+    if model is None:
+        return None, 'the exam model could not be read'
+    if model not in exam_config.solutions and not exam_config.survey_mode:
+        return None, 'there are no solutions for model {0}'.format(model)
+    scores = exam_config.scores.get(model)
+    exam = exams.Exam(result.capture, result.decisions,
+                      exam_config.get_solutions(model),
+                      session.students, exam_id, scores, sessiondb=session)
+    exam.reset_image()
+    exam.draw_answers()
+    return exam, None
+
+def grade_batch(session, sources, processes=None, width=None, dry_run=False):
+    """Detects the given sheets in parallel and stores them in the session.
+
+    Returns (num_stored, failures, elapsed_time), being failures a list
+    of (source, error_message) pairs.
+
+    """
+    exam_config = session.exam_config
+    options = detection_options(exam_config)
+    exam_id = session.next_exam_id()
+    num_stored = 0
+    failures = []
+    start_time = time.monotonic()
+    pool = multiprocessing.Pool(processes=processes,
+                                initializer=_init_worker,
+                                initargs=(exam_config.dimensions, options,
+                                          width))
+    try:
+        for result in pool.imap(_detect_sheet, sources, chunksize=2):
+            name = format_source(result.source)
+            if result.success:
+                exam, error = _create_exam(session, result, exam_id)
+            else:
+                exam, error = None, result.error
+            if exam is None:
+                failures.append((result.source, error))
+                print('{0}: FAILED ({1})'.format(name, error))
+                continue
+            if not dry_run:
+                session.store_exam(exam_id, exam.capture, exam.decisions,
+                                   exam.score)
+            print('{0}: exam {1}, model {2}, student {3}'\
+                  .format(name, exam_id, exam.decisions.model,
+                          exam.get_student_id_and_name()))
+            exam_id += 1
+            num_stored += 1
+    finally:
+        pool.close()
+        pool.join()
+    return num_stored, failures, time.monotonic() - start_time
+
+def main():
+    args = _cmd_options()
+    try:
+        session = sessiondb.SessionDB(args.session)
+    except utils.EyegradeException as e:
+        print('Cannot open the session:', e, file=sys.stderr)
+        sys.exit(1)
+    sources = expand_inputs(args.inputs)
+    if not sources:
+        print('No input images found', file=sys.stderr)
+        sys.exit(1)
+    try:
+        num_stored, failures, elapsed = grade_batch(session, sources,
+                                                    processes=args.processes,
+                                                    width=args.width,
+                                                    dry_run=args.dry_run)
+    finally:
+        if not args.dry_run:
+            session.save_legacy_answers(utils.config['csv-dialect'])
+        session.close()
+    print()
+    print('Graded {0} of {1} sheets in {2:.1f}s ({3:.2f} sheets/s)'\
+          .format(num_stored, len(sources), elapsed,
+                  len(sources) / elapsed if elapsed > 0 else 0.0))
+    if failures:
+        print('Failed sheets:')
+        for source, error in failures:
+            print('    {0}: {1}'.format(format_source(source), error))
+        sys.exit(2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+# Eyegrade: grading multiple choice questions with a webcam
+# Copyright (C) 2010-2018 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+"""Benchmarks the detector over a corpus of captures with ground truth.
+
+The corpus is a directory like the ones `synthetic.generate_corpus`
+writes. Every capture is detected with every table engine and every
+combination of detection options, and with every Hough threshold when
+the engine is 'hough'. Throughput, stage latencies, success rate and
+accuracy are reported, also for each engine, and can be compared with
+a baseline stored in a JSON file.
+
+"""
+import argparse
+import collections
+import itertools
+import json
+import sys
+import time
+
+import numpy as np
+
+from .. import detection
+from .. import images
+from . import synthetic
+
+# Detection options that the benchmark combines
+BENCHMARK_OPTIONS = ('read-id', 'infobits', 'left-to-right-numbering')
+
+# Default regression margins
+param_max_slowdown = 0.1
+param_max_accuracy_drop = 0.01
+
+
+class _Stats:
+    """Accumulates the results of a group of detections."""
+
+    def __init__(self):
+        self.frames = 0
+        self.seconds = 0.0
+        self.successes = 0
+        self.answers = 0
+        self.correct_answers = 0
+        self.models = 0
+        self.correct_models = 0
+        self.ids = 0
+        self.correct_ids = 0
+        self.stage_times = collections.OrderedDict([('total', [])])
+
+    def add(self, detector, seconds, truth_answers, truth):
+        self.frames += 1
+        self.seconds += seconds
+        for stage, stage_seconds in detector.timings.items():
+            self.stage_times.setdefault(stage, []).append(stage_seconds)
+        self.stage_times['total'].append(seconds)
+        if not detector.success:
+            return
+        self.successes += 1
+        decisions = detector.decisions
+        self.answers += len(truth_answers)
+        self.correct_answers += sum(1 for a, b
+                                    in zip(decisions.answers, truth_answers)
+                                    if a == b)
+        if detector.options['infobits']:
+            self.models += 1
+            self.correct_models += decisions.model == truth.model
+        if detector.options['read-id']:
+            self.ids += 1
+            self.correct_ids += decisions.detected_id == truth.student_id
+
+    def summary(self):
+        return collections.OrderedDict([
+            ('frames', self.frames),
+            ('fps', _ratio(self.frames, self.seconds)),
+            ('success-rate', _ratio(self.successes, self.frames)),
+            ('answer-accuracy', _ratio(self.correct_answers, self.answers)),
+            ('model-accuracy', _ratio(self.correct_models, self.models)),
+            ('id-accuracy', _ratio(self.correct_ids, self.ids)),
+        ])
+
+    def stage_latencies(self):
+        """Returns the p50 and p95 latencies of each stage, in ms."""
+        latencies = collections.OrderedDict()
+        for stage, times in self.stage_times.items():
+            if not times:
+                continue
+            p50, p95 = np.percentile(np.array(times) * 1000, (50, 95))
+            latencies[stage] = collections.OrderedDict([('p50', p50),
+                                                        ('p95', p95)])
+        return latencies
+
+
+def option_combinations(read_id=True):
+    """Returns the combinations of the benchmarked detection options.
+
+    Each one is a dictionary from option names to booleans. The
+    combinations with 'read-id' are left out if `read_id` is False.
+
+    """
+    combinations = []
+    for values in itertools.product((False, True),
+                                    repeat=len(BENCHMARK_OPTIONS)):
+        combination = collections.OrderedDict(zip(BENCHMARK_OPTIONS, values))
+        if combination['read-id'] and not read_id:
+            continue
+        combinations.append(combination)
+    return combinations
+
+def combination_name(combination):
+    return ','.join('{0}={1}'.format(option, 'yes' if value else 'no')
+                    for option, value in combination.items())
+
+def run_benchmark(corpus, thresholds=None, combinations=None, engines=None):
+    """Detects every capture of the corpus and returns the results.
+
+    `corpus` is a list of (filename, truth) pairs, as returned by
+    `synthetic.read_corpus`. `thresholds` defaults to all the Hough
+    thresholds of the detector, `combinations` to all the option
+    combinations (those with 'read-id' only if every capture has an
+    id) and `engines` to all the table engines of the detector.
+    Returns a dictionary that can be dumped as JSON.
+
+    """
+    if thresholds is None:
+        thresholds = detection.param_hough_thresholds
+    if combinations is None:
+        read_id = all(truth.student_id for _, truth in corpus)
+        combinations = option_combinations(read_id=read_id)
+    if engines is None:
+        engines = list(detection.ExamDetector.table_engines)
+    context = detection.ExamDetectorContext()
+    context.hough_thresholds = list(thresholds)
+    context.lock_threshold()
+    total = _Stats()
+    by_combination = collections.OrderedDict(
+        (combination_name(c), _Stats()) for c in combinations)
+    by_threshold = collections.OrderedDict((t, _Stats()) for t in thresholds)
+    by_engine = collections.OrderedDict((e, _Stats()) for e in engines)
+    for filename, truth in corpus:
+        image = images.load_image(filename)
+        if image is None:
+            raise ValueError('Cannot load {0}'.format(filename))
+        for combination, engine in itertools.product(combinations, engines):
+            options = _detection_options(combination, engine, truth)
+            detector = None
+            # Only the Hough engine depends on the threshold
+            if engine == 'hough':
+                engine_thresholds = thresholds
+            else:
+                engine_thresholds = [None]
+            for idx, threshold in enumerate(engine_thresholds):
+                if threshold is not None:
+                    context.hough_thresholds_idx = idx
+                start = time.perf_counter()
+                if detector is None:
+                    detector = detection.ExamDetector(truth.dimensions,
+                                                      context, options,
+                                                      image_raw=image)
+                else:
+                    detector.reset(image_raw=image)
+                detector.detect_safe()
+                seconds = time.perf_counter() - start
+                if options['left-to-right-numbering']:
+                    truth_answers = \
+                        detector._set_left_to_right(list(truth.answers))
+                else:
+                    truth_answers = truth.answers
+                groups = [total,
+                          by_combination[combination_name(combination)],
+                          by_engine[engine]]
+                if threshold is not None:
+                    groups.append(by_threshold[threshold])
+                for stats in groups:
+                    stats.add(detector, seconds, truth_answers, truth)
+            detector.release()
+    results = total.summary()
+    results['stages'] = total.stage_latencies()
+    results['combinations'] = collections.OrderedDict(
+        (name, stats.summary()) for name, stats in by_combination.items())
+    results['engines'] = collections.OrderedDict(
+        (engine, stats.summary()) for engine, stats in by_engine.items())
+    results['thresholds'] = collections.OrderedDict(
+        (str(threshold), stats.summary()['success-rate'])
+        for threshold, stats in by_threshold.items())
+    return results
+
+def compare_results(results, baseline, max_slowdown=param_max_slowdown,
+                    max_accuracy_drop=param_max_accuracy_drop):
+    """Returns the list of regressions of `results` against `baseline`.
+
+    Throughput regresses when it drops more than the `max_slowdown`
+    fraction of the baseline. Success rate and accuracies regress
+    when they drop more than `max_accuracy_drop` (an absolute
+    difference). Metrics missing in any of them are not compared.
+
+    """
+    regressions = []
+    if 'fps' in baseline and 'fps' in results:
+        if results['fps'] < baseline['fps'] * (1.0 - max_slowdown):
+            regressions.append('fps dropped from {0:.2f} to {1:.2f}'\
+                               .format(baseline['fps'], results['fps']))
+    for metric in ('success-rate', 'answer-accuracy', 'model-accuracy',
+                   'id-accuracy'):
+        old = baseline.get(metric)
+        new = results.get(metric)
+        if old is None or new is None:
+            continue
+        if new < old - max_accuracy_drop:
+            regressions.append('{0} dropped from {1:.4f} to {2:.4f}'\
+                               .format(metric, old, new))
+    return regressions
+
+def _detection_options(combination, engine, truth):
+    options = detection.ExamDetector.get_default_options()
+    options.update(combination)
+    options['table-engine'] = engine
+    if options['read-id']:
+        options['id-num-digits'] = len(truth.student_id)
+    return options
+
+def _ratio(numerator, denominator):
+    if denominator == 0:
+        return None
+    return numerator / denominator
+
+def _cmd_options():
+    parser = argparse.ArgumentParser(
+        description=('Benchmark detection over a corpus of captures '
+                     'with ground truth.'))
+    parser.add_argument('corpus',
+                        help=('Directory with the captures and their '
+                              'ground-truth.jsonl file'))
+    parser.add_argument('-o', '--output',
+                        dest='output',
+                        type=str,
+                        default=None,
+                        help='Write the results to the given JSON file')
+    parser.add_argument('-b', '--baseline',
+                        dest='baseline',
+                        type=str,
+                        default=None,
+                        help='Compare the results with this JSON file')
+    parser.add_argument('--max-slowdown',
+                        dest='max_slowdown',
+                        type=float,
+                        default=param_max_slowdown,
+                        help=('Maximum allowed drop of throughput, as a '
+                              'fraction of the baseline (default: %(default)s)'))
+    parser.add_argument('--max-accuracy-drop',
+                        dest='max_accuracy_drop',
+                        type=float,
+                        default=param_max_accuracy_drop,
+                        help=('Maximum allowed drop of success rate and '
+                              'accuracies (default: %(default)s)'))
+    parser.add_argument('-n', '--num-sheets',
+                        dest='num_sheets',
+                        type=int,
+                        default=None,
+                        help='Use only the first captures of the corpus')
+    parser.add_argument('-e', '--engines',
+                        dest='engines',
+                        nargs='+',
+                        choices=list(detection.ExamDetector.table_engines),
+                        default=None,
+                        help='Benchmark only these table engines')
+    return parser.parse_args()
+
+def main():
+    args = _cmd_options()
+    corpus = synthetic.read_corpus(args.corpus)
+    if args.num_sheets is not None:
+        corpus = corpus[:args.num_sheets]
+    results = run_benchmark(corpus, engines=args.engines)
+    print(json.dumps(results, indent=4))
+    if args.output is not None:
+        with open(args.output, 'w') as file_:
+            json.dump(results, file_, indent=4)
+    if args.baseline is not None:
+        with open(args.baseline) as file_:
+            baseline = json.load(file_)
+        regressions = compare_results(results, baseline, args.max_slowdown,
+                                      args.max_accuracy_drop)
+        if regressions:
+            print('Regressions against {0}:'.format(args.baseline),
+                  file=sys.stderr)
+            for regression in regressions:
+                print('    ' + regression, file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -52,6 +52,12 @@ def _cmd_options():
                         default=0,
                         help=('Detect student id with the given '
                               'number of digits'))
+    parser.add_argument('-T', '--timings-file',
+                        dest='timings_file',
+                        type=str,
+                        default=None,
+                        help=('Append the time spent in each detection '
+                              'stage to the given file as JSON'))
     return parser.parse_args()
 
 
@@ -64,6 +70,7 @@ def main():
     options['capture-raw-file'] = args.image
     if args.draw_lines_to is not None:
         options['show-lines'] = True
+    options['timings-file'] = args.timings_file
     if args.id_num_digits:
         options['read-id'] = True
         options['id-num-digits'] = 9
@@ -75,6 +82,8 @@ def main():
     else:
         print('Detection failed :(')
         print(detector.status)
+    for stage, seconds in detector.timings.items():
+        print('{0}: {1:.1f} ms'.format(stage, 1000 * seconds))
     if args.draw_lines_to is not None:
         detector.capture.save_image_drawn(args.draw_lines_to)
     if args.image_proc_to:
@@ -0,0 +1,158 @@
+# Eyegrade: grading multiple choice questions with a webcam
+# Copyright (C) 2010-2018 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+"""Micro-benchmarks the preprocessing of digit samples.
+
+`clear_boundbox` and `deskew` of `ocr.preprocessing` are timed on a
+digit image (for instance, tests/digit.png) against the row by row
+implementations they replaced, which are kept here as a reference.
+Both versions are checked to produce the same images.
+
+"""
+import argparse
+import collections
+import json
+import timeit
+
+import cv2
+import numpy as np
+
+from ..ocr import preprocessing
+from ..ocr import sample
+
+# Default number of calls timed for each function
+param_repeat = 2000
+
+
+def clear_boundbox_reference(image):
+    """Row by row implementation of `preprocessing.clear_boundbox`.
+
+    Unlike the vectorized version, it fails with an IndexError when
+    the first non-blank row is the last one.
+
+    """
+    top = 0
+    bot = image.shape[0]
+    right = image.shape[1]
+    left = 0
+    it = 0
+    for index, row in enumerate(image):
+        if not np.all(row == 0) and it == 0:
+            if index == image.shape[0] or not np.all(image[index + 1] == 0):
+                top = index
+                it = 1
+        elif np.all(row == 0) and it == 1:
+            bot = index
+            break
+    it = 0
+    for index, col in enumerate(image.T):
+        if (not np.all(col == 0)) and it == 0:
+            if (index + 2 >= image.shape[1]
+                    or not np.all(image.T[index + 2] == 0)):
+                left = index
+                it = 1
+        elif np.all(col == 0) and it == 1:
+            right = index
+            break
+    return image[top:bot, left:right]
+
+def deskew_reference(image, dim):
+    """Implementation of `preprocessing.deskew` that always allocates."""
+    affine_flags = cv2.WARP_INVERSE_MAP | cv2.INTER_LINEAR
+    m = cv2.moments(image)
+    if abs(m['mu02']) < 1e-2:
+        return image.copy()
+    skew = m['mu11'] / m['mu02']
+    M = np.float32([[1, skew, -0.5 * dim * skew], [0, 1, 0]])
+    return cv2.warpAffine(image, M, (dim, dim), flags=affine_flags)
+
+def run_benchmark(image, corners=None, dim=28, repeat=param_repeat):
+    """Times the preprocessing of a digit image.
+
+    `image` is a grayscale image and `corners` the corners of the
+    digit cell in it (the whole image by default). The cell is
+    projected as `FeatureExtractor` does, and then deskewed and
+    cleared. Returns a dictionary with the microseconds per call of
+    each version of each function and the speedups.
+
+    Raises ValueError if both versions do not produce the same images.
+
+    """
+    if corners is None:
+        height, width = image.shape[:2]
+        corners = np.array([[0, 0], [width - 1, 0],
+                            [0, height - 1], [width - 1, height - 1]])
+    cell = preprocessing.FeatureExtractor._reshape(
+                                        sample.Sample(corners, image=image))
+    deskewed = deskew_reference(cell, dim)
+    buffer = np.empty((dim, dim), dtype=np.uint8)
+    if not np.array_equal(preprocessing.deskew(cell, dim, dst=buffer),
+                          deskewed):
+        raise ValueError('deskew differs from the reference')
+    if not np.array_equal(preprocessing.clear_boundbox(deskewed),
+                          clear_boundbox_reference(deskewed)):
+        raise ValueError('clear_boundbox differs from the reference')
+    timings = collections.OrderedDict([
+        ('deskew-reference', lambda: deskew_reference(cell, dim)),
+        ('deskew', lambda: preprocessing.deskew(cell, dim, dst=buffer)),
+        ('clear-boundbox-reference',
+         lambda: clear_boundbox_reference(deskewed)),
+        ('clear-boundbox', lambda: preprocessing.clear_boundbox(deskewed)),
+    ])
+    results = collections.OrderedDict()
+    for name, function in timings.items():
+        seconds = min(timeit.repeat(function, number=repeat, repeat=3))
+        results[name] = seconds / repeat * 1e6
+    for name in ('deskew', 'clear-boundbox'):
+        results[name + '-speedup'] = \
+            results[name + '-reference'] / results[name]
+    return results
+
+def _cmd_options():
+    parser = argparse.ArgumentParser(
+        description='Micro-benchmark the preprocessing of digit samples.')
+    parser.add_argument('image',
+                        help=('Grayscale image of a digit '
+                              '(e.g. tests/digit.png)'))
+    parser.add_argument('-c', '--corners',
+                        dest='corners',
+                        type=int,
+                        nargs=8,
+                        default=None,
+                        help=('Corners of the digit cell: left-up, right-up, '
+                              'left-bottom and right-bottom x y pairs '
+                              '(default: the whole image)'))
+    parser.add_argument('-n', '--repeat',
+                        dest='repeat',
+                        type=int,
+                        default=param_repeat,
+                        help='Calls timed per function (default: %(default)s)')
+    return parser.parse_args()
+
+def main():
+    args = _cmd_options()
+    image = cv2.imread(args.image, 0)
+    if image is None:
+        raise ValueError('Cannot load {0}'.format(args.image))
+    corners = None
+    if args.corners is not None:
+        corners = np.array(args.corners).reshape(4, 2)
+    results = run_benchmark(image, corners=corners, repeat=args.repeat)
+    print(json.dumps(results, indent=4))
+
+if __name__ == '__main__':
+    main()
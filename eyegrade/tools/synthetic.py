@@ -0,0 +1,425 @@
+# Eyegrade: grading multiple choice questions with a webcam
+# Copyright (C) 2010-2018 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+"""Renders synthetic captures of answer sheets with known contents.
+
+The answer tables follow the layout that `exammaker.create_answer_table`
+typesets (table rows from `exammaker.table_geometry`, model bits from
+`utils.encode_model`). The sheet is drawn flat and then distorted as
+a camera would see it. Every capture comes with its ground truth:
+answers, model, student id and table corners. The same seed always
+produces the same corpus.
+
+"""
+import argparse
+import json
+import os
+import os.path
+import string
+
+import cv2
+import numpy as np
+
+from .. import exammaker
+from .. import utils
+
+# Layout of the flat sheet, in pixels (similar to a 640x480 webcam
+# capture of a sheet filling the frame)
+param_cell_width = 85
+param_row_height = 46
+param_number_width = 55
+param_id_cell_width = 40
+param_id_height = 44
+param_id_label_width = 100
+param_id_gap_rows = 1.4
+param_bit_size = 28
+param_margin = 60
+param_line_thickness = 2
+
+# Colors (BGR)
+param_paper_color = (235, 238, 240)
+param_print_color = (40, 40, 40)
+param_ink_color = (170, 70, 40)
+
+
+default_options = {
+    'width': 640,
+    'height': 480,
+    'fill': 0.85,
+    'perspective': 0.03,
+    'blur': 0.8,
+    'noise': 3.0,
+    'lighting': 0.25,
+    'blank-ratio': 0.1,
+    'id-label': 'ID',
+}
+
+def get_default_options():
+    return dict(default_options)
+
+
+class SheetTruth:
+    """Ground truth of a synthetic capture."""
+
+    def __init__(self, dimensions, model, answers, student_id, tables):
+        self.dimensions = dimensions
+        self.model = model
+        self.answers = answers
+        self.student_id = student_id
+        self.tables = tables
+
+    def to_dict(self):
+        return {
+            'dimensions': [list(d) for d in self.dimensions],
+            'model': self.model,
+            'answers': self.answers,
+            'id': self.student_id,
+            'tables': self.tables,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls([tuple(d) for d in data['dimensions']], data['model'],
+                   data['answers'], data['id'], data['tables'])
+
+
+def render_sheet(dimensions, model, answers, student_id=None, options=None,
+                 seed=None):
+    """Renders a capture of an answer sheet.
+
+    `dimensions` has the (num_choices, num_questions) pair of each
+    table, as `utils.parse_dimensions` returns. `model` is the model
+    letter. `answers` has an integer per question, in question order:
+    0 for a blank answer, or the number (starting at 1) of the marked
+    choice. `student_id` is a string of digits, or None for a sheet
+    without id box. `options` is a dictionary like the one
+    `get_default_options` returns. `seed` makes the distortions
+    reproducible.
+
+    Returns the pair (image, truth): a BGR image and a `SheetTruth`.
+
+    """
+    if options is None:
+        options = default_options
+    num_choices = dimensions[0][0]
+    for d in dimensions:
+        if d[0] != num_choices:
+            raise utils.EyegradeException('', 'same_num_choices')
+    if len(answers) != sum(d[1] for d in dimensions):
+        raise ValueError('Wrong number of answers')
+    rng = np.random.default_rng(seed)
+    sheet, table_corners = _draw_sheet(dimensions, model, answers,
+                                       student_id, options, rng)
+    image, transform = _camera_view(sheet, options, rng)
+    tables = []
+    for corners in table_corners:
+        points = np.array(corners, dtype=np.float64).reshape(-1, 1, 2)
+        points = cv2.perspectiveTransform(points, transform).reshape(-1, 2)
+        tables.append(np.rint(points).astype(int).tolist())
+    truth = SheetTruth(list(dimensions), model, list(answers), student_id,
+                       tables)
+    return image, truth
+
+def random_sheet(dimensions, id_num_digits=0, options=None, seed=None):
+    """Renders a sheet with random answers, model and student id.
+
+    Returns the pair (image, truth), as `render_sheet` does.
+
+    """
+    if options is None:
+        options = default_options
+    rng = np.random.default_rng(seed)
+    num_choices = dimensions[0][0]
+    num_bits = len(dimensions) * num_choices
+    model = chr(65 + int(rng.integers(0, min(8, 2 ** num_bits))))
+    answers = []
+    for d in dimensions:
+        for i in range(d[1]):
+            if rng.random() < options['blank-ratio']:
+                answers.append(0)
+            else:
+                answers.append(int(rng.integers(1, d[0] + 1)))
+    if id_num_digits > 0:
+        student_id = ''.join(str(d) for d in
+                             rng.integers(0, 10, id_num_digits))
+    else:
+        student_id = None
+    return render_sheet(dimensions, model, answers, student_id, options,
+                        seed=rng.integers(0, 2 ** 32))
+
+def generate_corpus(directory, num_sheets, dimensions, id_num_digits=0,
+                    options=None, seed=0):
+    """Writes `num_sheets` random captures into `directory`.
+
+    Images are named sheet-0000.png, sheet-0001.png, etc. Their ground
+    truth is written as JSON lines into ground-truth.jsonl, in the
+    same order. Returns the list of (filename, truth) pairs.
+
+    """
+    seeds = np.random.default_rng(seed).integers(0, 2 ** 32, num_sheets)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    corpus = []
+    with open(os.path.join(directory, 'ground-truth.jsonl'), 'w') as file_:
+        for i, sheet_seed in enumerate(seeds):
+            image, truth = random_sheet(dimensions, id_num_digits, options,
+                                        seed=sheet_seed)
+            filename = os.path.join(directory, 'sheet-{0:04d}.png'.format(i))
+            cv2.imwrite(filename, image)
+            data = truth.to_dict()
+            data['image'] = os.path.basename(filename)
+            file_.write(json.dumps(data) + '\n')
+            corpus.append((filename, truth))
+    return corpus
+
+def read_corpus(directory):
+    """Returns the (filename, truth) pairs of a corpus directory."""
+    corpus = []
+    with open(os.path.join(directory, 'ground-truth.jsonl')) as file_:
+        for line in file_:
+            data = json.loads(line)
+            corpus.append((os.path.join(directory, data['image']),
+                           SheetTruth.from_dict(data)))
+    return corpus
+
+def _draw_sheet(dimensions, model, answers, student_id, options, rng):
+    """Draws the flat sheet.
+
+    Returns the sheet image and the outer corners (left-up, right-up,
+    left-bottom, right-bottom) of each table in it.
+
+    """
+    num_choices = dimensions[0][0]
+    geometry, question_numbers = exammaker.table_geometry(dimensions)
+    bits = utils.encode_model(model, len(dimensions), num_choices)
+    table_width = param_number_width + num_choices * param_cell_width
+    tables_width = len(dimensions) * table_width
+    if student_id is not None:
+        id_width = (param_id_label_width
+                    + len(student_id) * param_id_cell_width)
+        top = (param_margin + param_id_height
+               + param_id_gap_rows * param_row_height)
+    else:
+        id_width = 0
+        top = param_margin + param_row_height
+    top = int(round(top))
+    sheet_width = max(tables_width, id_width) + 2 * param_margin
+    sheet_height = top + len(geometry) * param_row_height + param_margin
+    sheet = np.empty((sheet_height, sheet_width, 3), dtype=np.uint8)
+    sheet[:, :] = param_paper_color
+    left = (sheet_width - tables_width) // 2
+    if student_id is not None:
+        _draw_id_box(sheet, student_id, (sheet_width - id_width) // 2,
+                     param_margin, options['id-label'], rng)
+    # Horizontal lines go above each row, as exammaker._horizontal_line
+    for i, row_geometry in enumerate(geometry):
+        extra_line = max(row_geometry) > 0 or -1 in row_geometry
+        y = top + i * param_row_height
+        for j, cell in enumerate(row_geometry):
+            if cell > 0 or cell == -1 or extra_line:
+                x0 = left + j * table_width + param_number_width
+                _line(sheet, (x0, y), (x0 + num_choices * param_cell_width, y))
+    table_corners = []
+    question = 0
+    for j, (num_choices, num_rows) in enumerate(dimensions):
+        x0 = left + j * table_width + param_number_width
+        x1 = x0 + num_choices * param_cell_width
+        y1 = top + num_rows * param_row_height
+        for k in range(num_choices + 1):
+            x = x0 + k * param_cell_width
+            _line(sheet, (x, top), (x, y1))
+        for k in range(num_choices):
+            _text(sheet, string.ascii_uppercase[k],
+                  (x0 + (k + 0.5) * param_cell_width,
+                   top - 0.5 * param_row_height), 1.2)
+        for i in range(num_rows):
+            y = top + i * param_row_height
+            _text(sheet, str(question_numbers[j] + i),
+                  (x0 - 0.5 * param_number_width, y + 0.5 * param_row_height),
+                  1.2)
+            if answers[question] > 0:
+                _draw_cross(sheet, x0 + (answers[question] - 1)
+                            * param_cell_width, y, rng)
+            question += 1
+        # Infobits: the first row has the bits set, the second the rest
+        table_bits = bits[j * num_choices:(j + 1) * num_choices]
+        for k, bit in enumerate(table_bits):
+            cx = x0 + (k + 0.5) * param_cell_width
+            cy = y1 + (0.0 if bit else 1.0) * param_row_height \
+                 + param_row_height / 2.6
+            half = param_bit_size / 2
+            cv2.rectangle(sheet, (int(cx - half), int(cy - half)),
+                          (int(cx + half), int(cy + half)),
+                          param_print_color, thickness=-1)
+        table_corners.append(((x0, top), (x1, top), (x0, y1), (x1, y1)))
+    return sheet, table_corners
+
+def _draw_id_box(sheet, student_id, x, y, label, rng):
+    x0 = x + param_id_label_width
+    x1 = x0 + len(student_id) * param_id_cell_width
+    y1 = y + param_id_height
+    _line(sheet, (x0, y), (x1, y))
+    _line(sheet, (x0, y1), (x1, y1))
+    for k in range(len(student_id) + 1):
+        xk = x0 + k * param_id_cell_width
+        _line(sheet, (xk, y), (xk, y1))
+    _text(sheet, label + ':', (x + param_id_label_width / 2, y
+                               + param_id_height / 2), 1.2)
+    for k, digit in enumerate(student_id):
+        center = (x0 + (k + 0.5) * param_id_cell_width
+                  + rng.uniform(-2, 2),
+                  y + 0.5 * param_id_height + rng.uniform(-2, 2))
+        _text(sheet, digit, center, 1.1, param_ink_color,
+              cv2.FONT_HERSHEY_SCRIPT_SIMPLEX)
+
+def _draw_cross(sheet, x, y, rng):
+    """Draws a hand-made looking cross in the cell with corner (x, y)."""
+    jitter = lambda: rng.uniform(-0.06, 0.06)
+    points = [(x + (u + jitter()) * param_cell_width,
+               y + (v + jitter()) * param_row_height)
+              for u, v in ((0.15, 0.15), (0.85, 0.85),
+                           (0.85, 0.15), (0.15, 0.85))]
+    points = [(int(round(px)), int(round(py))) for px, py in points]
+    cv2.line(sheet, points[0], points[1], param_ink_color, thickness=3,
+             lineType=cv2.LINE_AA)
+    cv2.line(sheet, points[2], points[3], param_ink_color, thickness=3,
+             lineType=cv2.LINE_AA)
+
+def _line(sheet, p0, p1):
+    cv2.line(sheet, p0, p1, param_print_color,
+             thickness=param_line_thickness)
+
+def _text(sheet, text, center, scale, color=param_print_color,
+          font=cv2.FONT_HERSHEY_SIMPLEX):
+    (width, height), _ = cv2.getTextSize(text, font, scale, 2)
+    origin = (int(round(center[0] - width / 2)),
+              int(round(center[1] + height / 2)))
+    cv2.putText(sheet, text, origin, font, scale, color, thickness=2,
+                lineType=cv2.LINE_AA)
+
+def _camera_view(sheet, options, rng):
+    """Distorts the flat sheet as a camera would capture it.
+
+    Returns the capture and the perspective transform from the sheet
+    to the capture.
+
+    """
+    width, height = options['width'], options['height']
+    sheet_height, sheet_width = sheet.shape[:2]
+    scale = options['fill'] * min(width / sheet_width, height / sheet_height)
+    dx = (width - scale * sheet_width) / 2
+    dy = (height - scale * sheet_height) / 2
+    source = np.float32([(0, 0), (sheet_width, 0),
+                         (0, sheet_height), (sheet_width, sheet_height)])
+    target = source * scale + (dx, dy)
+    target += rng.uniform(-1, 1, (4, 2)) * options['perspective'] \
+              * np.float32([width, height])
+    transform = cv2.getPerspectiveTransform(source, np.float32(target))
+    image = cv2.warpPerspective(sheet, transform, (width, height),
+                                flags=cv2.INTER_AREA,
+                                borderMode=cv2.BORDER_CONSTANT,
+                                borderValue=param_paper_color)
+    image = image.astype(np.float32)
+    if options['lighting'] > 0:
+        # Linear gradient in a random direction
+        angle = rng.uniform(0, 2 * np.pi)
+        ys, xs = np.mgrid[0:height, 0:width]
+        t = xs * np.cos(angle) + ys * np.sin(angle)
+        t = (t - t.min()) / (t.max() - t.min())
+        image *= (1.0 - options['lighting'] * t)[:, :, np.newaxis]
+    if options['blur'] > 0:
+        image = cv2.GaussianBlur(image, (0, 0), options['blur'])
+    if options['noise'] > 0:
+        image += rng.normal(0, options['noise'], image.shape)
+    image = np.clip(np.rint(image), 0, 255).astype(np.uint8)
+    return image, transform
+
+def _cmd_options():
+    parser = argparse.ArgumentParser(
+        description=('Generate synthetic captures of answer sheets '
+                     'with their ground truth.'))
+    parser.add_argument('dimensions',
+                        help='Answer box dimensions spec. (e.g. "3,5;3,5")')
+    parser.add_argument('directory',
+                        help='Directory in which to write the captures')
+    parser.add_argument('-n', '--num-sheets',
+                        dest='num_sheets',
+                        type=int,
+                        default=100,
+                        help='Number of captures (default: 100)')
+    parser.add_argument('-i', '--id-num-digits',
+                        dest='id_num_digits',
+                        type=int,
+                        default=0,
+                        help='Number of digits of the student id box')
+    parser.add_argument('-s', '--seed',
+                        dest='seed',
+                        type=int,
+                        default=0,
+                        help='Random seed (default: 0)')
+    parser.add_argument('--size',
+                        dest='size',
+                        type=str,
+                        default='640x480',
+                        help='Size of the captures (default: 640x480)')
+    parser.add_argument('--perspective',
+                        dest='perspective',
+                        type=float,
+                        default=default_options['perspective'],
+                        help=('Maximum displacement of the corners of the '
+                              'sheet, as a fraction of the capture size'))
+    parser.add_argument('--blur',
+                        dest='blur',
+                        type=float,
+                        default=default_options['blur'],
+                        help='Sigma of the Gaussian blur, in pixels')
+    parser.add_argument('--noise',
+                        dest='noise',
+                        type=float,
+                        default=default_options['noise'],
+                        help='Standard deviation of the pixel noise')
+    parser.add_argument('--lighting',
+                        dest='lighting',
+                        type=float,
+                        default=default_options['lighting'],
+                        help=('Darkening at the dark end of the lighting '
+                              'gradient (0 for uniform lighting)'))
+    parser.add_argument('--blank-ratio',
+                        dest='blank_ratio',
+                        type=float,
+                        default=default_options['blank-ratio'],
+                        help='Probability of leaving a question blank')
+    return parser.parse_args()
+
+def main():
+    args = _cmd_options()
+    dimensions, _ = utils.parse_dimensions(args.dimensions)
+    options = get_default_options()
+    width, height = args.size.split('x')
+    options['width'] = int(width)
+    options['height'] = int(height)
+    options['perspective'] = args.perspective
+    options['blur'] = args.blur
+    options['noise'] = args.noise
+    options['lighting'] = args.lighting
+    options['blank-ratio'] = args.blank_ratio
+    corpus = generate_corpus(args.directory, args.num_sheets, dimensions,
+                             args.id_num_digits, options, args.seed)
+    print('{0} captures written to {1}'.format(len(corpus), args.directory))
+
+if __name__ == '__main__':
+    main()
@@ -97,6 +97,7 @@ def _read_config():
         'save-filename-pattern': default_capture_pattern,
         'csv-dialect': 'tabs',
         'default-charset': 'utf8', # special value: 'system-default'
+        'table-engine': 'hough',
     }
     parser = configparser.ConfigParser()
     home = user_home()
@@ -116,6 +117,22 @@ def _read_config():
         config['error-logging'] = True
     else:
         config['error-logging'] = False
+    if 'pyramid-lines' in config and config['pyramid-lines'] == 'yes':
+        config['pyramid-lines'] = True
+    else:
+        config['pyramid-lines'] = False
+    if 'multi-threshold' in config and config['multi-threshold'] == 'yes':
+        config['multi-threshold'] = True
+    else:
+        config['multi-threshold'] = False
+    if 'frame-gate' in config and config['frame-gate'] == 'yes':
+        config['frame-gate'] = True
+    else:
+        config['frame-gate'] = False
+    if 'grid-fit' in config and config['grid-fit'] == 'yes':
+        config['grid-fit'] = True
+    else:
+        config['grid-fit'] = False
     config['camera-dev'] = int(config['camera-dev'])
     if config['default-charset'] == 'system-default':
         config['default-charset'] = locale.getpreferredencoding()
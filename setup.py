@@ -59,7 +59,7 @@ setuptools.setup(name='eyegrade',
           'eyegrade.tools'
       ],
       package_data={'eyegrade': ['data/*', 'data/svm/*']},
-      scripts=['bin/eyegrade', 'bin/eyegrade-create'],
+      scripts=['bin/eyegrade', 'bin/eyegrade-create', 'bin/eyegrade-batch'],
       install_requires=[
           'opencv-python',
           'PyQt5',
@@ -0,0 +1,224 @@
+# Eyegrade: grading multiple choice questions with a webcam
+# Copyright (C) 2010-2018 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+import io
+import os.path
+import tempfile
+import unittest
+import unittest.mock as mock
+
+import cv2
+import numpy as np
+
+import eyegrade.detection as detection
+import eyegrade.exams as exams
+import eyegrade.sessiondb as sessiondb
+import eyegrade.tools.batch as batch
+import eyegrade.tools.synthetic as synthetic
+
+# Other test modules replace read_infobits while they run
+_read_infobits = detection.read_infobits
+
+
+class FakeContext:
+    def __init__(self, thresholds_idx=0):
+        self.hough_thresholds = [30, 40, 50, 60]
+        self.hough_thresholds_idx = thresholds_idx
+
+
+class FakeCapture:
+    image_drawn = 'drawn'
+
+
+class FakeDecisions:
+    def __init__(self, model):
+        self.model = model
+
+
+class FakeResult:
+    def __init__(self, model):
+        self.capture = FakeCapture()
+        self.decisions = FakeDecisions(model)
+
+
+class FakeSession:
+    def __init__(self, exam_config):
+        self.exam_config = exam_config
+        self.students = {}
+
+
+class TestExpandInputs(unittest.TestCase):
+
+    def test_expand_inputs(self):
+        image = np.zeros((8, 10), dtype=np.uint8)
+        with tempfile.TemporaryDirectory() as dirname:
+            for name in ('b.png', 'a.jpg', 'single.tiff'):
+                cv2.imwrite(os.path.join(dirname, name), image)
+            cv2.imwritemulti(os.path.join(dirname, 'scan.tif'),
+                             [image, image, image])
+            with open(os.path.join(dirname, 'notes.txt'), mode='w') as f:
+                f.write('not an image\n')
+            path = lambda name: os.path.join(dirname, name)
+            self.assertEqual(batch.expand_inputs([dirname]), [
+                (path('a.jpg'), None),
+                (path('b.png'), None),
+                (path('scan.tif'), 0),
+                (path('scan.tif'), 1),
+                (path('scan.tif'), 2),
+                (path('single.tiff'), None),
+            ])
+            # Glob patterns, and files kept in the order given
+            self.assertEqual(
+                batch.expand_inputs([path('*.png'), path('scan.tif'),
+                                     path('missing.png')]),
+                [(path('b.png'), None),
+                 (path('scan.tif'), 0),
+                 (path('scan.tif'), 1),
+                 (path('scan.tif'), 2),
+                 (path('missing.png'), None)])
+        self.assertEqual(batch.format_source(('a.png', None)), 'a.png')
+        self.assertEqual(batch.format_source(('scan.tif', 2)), 'scan.tif[2]')
+
+
+class TestDetectSheet(unittest.TestCase):
+
+    def setUp(self):
+        self.detectors = []
+        self.succeed_at = set()
+
+    def _new_detector(self, dimensions, context, options, image_raw=None):
+        detector = mock.Mock(spec=['detect_safe', 'release'])
+        detector.thresholds_idx = context.hough_thresholds_idx
+        detector.success = detector.thresholds_idx in self.succeed_at
+        detector.status = {'cells': detector.success}
+        detector.capture = FakeCapture()
+        detector.decisions = FakeDecisions('A')
+        self.detectors.append(detector)
+        return detector
+
+    def _detect(self, context, image=np.zeros((8, 10), dtype=np.uint8)):
+        with mock.patch.object(batch, '_worker_context', context), \
+             mock.patch.object(batch, '_load_sheet', return_value=image), \
+             mock.patch.object(detection, 'ExamDetector',
+                               side_effect=self._new_detector):
+            return batch._detect_sheet(('sheet.png', None))
+
+    def test_threshold_order(self):
+        self.succeed_at = {0}
+        context = FakeContext(thresholds_idx=2)
+        result = self._detect(context)
+        self.assertTrue(result.success)
+        # From the last threshold that worked, wrapping around
+        self.assertEqual([d.thresholds_idx for d in self.detectors],
+                         [2, 3, 0])
+        self.assertEqual(context.hough_thresholds_idx, 0)
+        # Only the detectors dropped are released
+        self.assertEqual([d.release.called for d in self.detectors],
+                         [True, True, False])
+        self.assertIs(result.capture, self.detectors[-1].capture)
+        self.assertIsNone(result.capture.image_drawn)
+
+    def test_detection_failed(self):
+        context = FakeContext(thresholds_idx=1)
+        result = self._detect(context)
+        self.assertFalse(result.success)
+        self.assertEqual(result.error, 'detection failed')
+        self.assertEqual([d.thresholds_idx for d in self.detectors],
+                         [1, 2, 3, 0])
+        self.assertTrue(all(d.release.called for d in self.detectors))
+        # The next sheet starts again from the same threshold
+        self.assertEqual(context.hough_thresholds_idx, 1)
+
+    def test_cannot_load(self):
+        result = self._detect(FakeContext(), image=None)
+        self.assertFalse(result.success)
+        self.assertEqual(result.error, 'cannot load the image')
+        self.assertEqual(self.detectors, [])
+
+    def test_context_error(self):
+        with mock.patch.object(batch, '_worker_error', None), \
+             mock.patch.object(batch, '_worker_context', None), \
+             mock.patch.object(detection, 'ExamDetectorContext',
+                               side_effect=ValueError('no classifier')):
+            batch._init_worker([(3, 5)], {}, None)
+            result = batch._detect_sheet(('sheet.png', None))
+        self.assertFalse(result.success)
+        self.assertEqual(result.error, 'cannot create the detection '
+                                       'context: no classifier')
+
+
+class TestCreateExam(unittest.TestCase):
+
+    def test_errors(self):
+        exam_config = exams.ExamConfig()
+        exam_config.set_dimensions('3,2')
+        exam_config.set_solutions('A', [1, 3])
+        session = FakeSession(exam_config)
+        exam, error = batch._create_exam(session, FakeResult(None), 1)
+        self.assertIsNone(exam)
+        self.assertEqual(error, 'the exam model could not be read')
+        exam, error = batch._create_exam(session, FakeResult('B'), 1)
+        self.assertIsNone(exam)
+        self.assertEqual(error, 'there are no solutions for model B')
+
+
+class TestGradeBatch(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(detection, 'read_infobits',
+                                    _read_infobits)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _create_session(self, dirname, dimensions, solutions):
+        exam_config = exams.ExamConfig()
+        exam_config.set_dimensions(dimensions)
+        exam_config.set_solutions('A', solutions)
+        session_dir = os.path.join(dirname, 'session')
+        sessiondb.create_session_directory(session_dir, exam_config, [])
+        session = sessiondb.SessionDB(session_dir)
+        self.addCleanup(session.close)
+        return session
+
+    def test_grade_batch(self):
+        dimensions = [(3, 5)]
+        answers = [[1, 0, 3, 2, 2], [3, 1, 1, 0, 2]]
+        with tempfile.TemporaryDirectory() as dirname:
+            session = self._create_session(dirname, '3,5', [1, 2, 3, 2, 2])
+            sources = []
+            for i, sheet_answers in enumerate(answers):
+                image, truth = synthetic.render_sheet(dimensions, 'A',
+                                                      sheet_answers, seed=i)
+                filename = os.path.join(dirname, 'sheet-{}.png'.format(i))
+                cv2.imwrite(filename, image)
+                sources.append((filename, None))
+            missing = (os.path.join(dirname, 'missing.png'), None)
+            with mock.patch('sys.stdout', new_callable=io.StringIO):
+                num_stored, failures, elapsed = batch.grade_batch(
+                                    session, sources + [missing], processes=1)
+            self.assertEqual(num_stored, 2)
+            self.assertEqual(failures, [(missing, 'cannot load the image')])
+            self.assertEqual(session.next_exam_id(), 3)
+            for exam_id, sheet_answers in enumerate(answers, 1):
+                self.assertEqual(session.read_answers(exam_id), sheet_answers)
+            # Nothing is stored in a dry run
+            with mock.patch('sys.stdout', new_callable=io.StringIO):
+                num_stored, failures, elapsed = batch.grade_batch(
+                                    session, sources, processes=1,
+                                    dry_run=True)
+            self.assertEqual(num_stored, 2)
+            self.assertEqual(session.next_exam_id(), 3)
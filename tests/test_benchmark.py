@@ -0,0 +1,74 @@
+# Eyegrade: grading multiple choice questions with a webcam
+# Copyright (C) 2010-2019 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+#
+import tempfile
+import unittest
+
+import eyegrade.tools.benchmark as benchmark
+import eyegrade.tools.synthetic as synthetic
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_option_combinations(self):
+        combinations = benchmark.option_combinations()
+        self.assertEqual(len(combinations), 8)
+        names = set(benchmark.combination_name(c) for c in combinations)
+        self.assertEqual(len(names), 8)
+        combinations = benchmark.option_combinations(read_id=False)
+        self.assertEqual(len(combinations), 4)
+        self.assertFalse(any(c['read-id'] for c in combinations))
+
+    def test_compare_results(self):
+        baseline = {'fps': 20.0, 'success-rate': 0.9,
+                    'answer-accuracy': 0.99, 'model-accuracy': 1.0,
+                    'id-accuracy': None}
+        results = dict(baseline, fps=18.5)
+        results['success-rate'] = 0.895
+        self.assertEqual(benchmark.compare_results(results, baseline), [])
+        results = dict(baseline, fps=17.0)
+        results['answer-accuracy'] = 0.95
+        regressions = benchmark.compare_results(results, baseline)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(regressions[0].startswith('fps'))
+        self.assertTrue(regressions[1].startswith('answer-accuracy'))
+        self.assertEqual(benchmark.compare_results(results, baseline,
+                                                   max_slowdown=0.2,
+                                                   max_accuracy_drop=0.05),
+                         [])
+
+    def test_run_benchmark(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            synthetic.generate_corpus(dirname, 2, [(3, 5)], seed=1)
+            corpus = synthetic.read_corpus(dirname)
+            results = benchmark.run_benchmark(corpus, thresholds=[180, 160],
+                                              engines=['hough'])
+            all_engines = benchmark.run_benchmark(corpus,
+                                                  thresholds=[180, 160])
+        self.assertEqual(results['frames'], 2 * 2 * 4)
+        self.assertEqual(len(results['combinations']), 4)
+        self.assertEqual(list(results['thresholds']), ['180', '160'])
+        self.assertIn('total', results['stages'])
+        self.assertGreater(results['success-rate'], 0.0)
+        self.assertEqual(results['answer-accuracy'], 1.0)
+        # The contours engine detects each capture once per combination
+        self.assertEqual(all_engines['frames'], 2 * 4 * (2 + 1))
+        self.assertEqual(list(all_engines['engines']), ['hough', 'contours'])
+        self.assertEqual(all_engines['engines']['contours']['frames'], 2 * 4)
+        self.assertEqual(all_engines['thresholds'], results['thresholds'])
+        self.assertGreater(all_engines['engines']['contours']['success-rate'],
+                           0.0)
@@ -16,9 +16,19 @@
 # <http://www.gnu.org/licenses/>.
 #
 import os
+import json
+import time
+import tempfile
+import threading
 import unittest
 
+import cv2
+import numpy as np
+
+import eyegrade.capture as capture
 import eyegrade.detection as detection
+import eyegrade.geometry as geometry
+import eyegrade.images as images
 
 
 class _MockExamDetector(detection.ExamDetector):
@@ -43,9 +53,182 @@ class _MockExamDetector(detection.ExamDetector):
 def _mock_read_infobits(image, corner_matrixes):
         return [False, True, False, False, False, True]
 
-detection.read_infobits = _mock_read_infobits
+_read_infobits = detection.read_infobits
+
+def setUpModule():
+    detection.read_infobits = _mock_read_infobits
+
+def tearDownModule():
+    detection.read_infobits = _read_infobits
+
+def _full_mask_infobit(image, mask, center_up, dy):
+    # Reference implementation that draws the masks on the whole image
+    center_down = (center_up[0] + dy[0], center_up[1] + dy[1])
+    radius = max(1, int(round((dy[0] ** 2 + dy[1] ** 2) ** 0.5
+                              * detection.param_bit_mask_radius_multiplier)))
+    mask[:, :] = 0
+    cv2.circle(mask, center_up, radius, (1), thickness=-1)
+    mask_pixels = cv2.countNonZero(mask)
+    pixels_up = cv2.countNonZero(cv2.multiply(image, mask))
+    mask[:, :] = 0
+    cv2.circle(mask, center_down, radius, (1), thickness=-1)
+    pixels_down = cv2.countNonZero(cv2.multiply(image, mask))
+    if mask_pixels < 1:
+        return (False, False)
+    threshold = detection.param_bit_mask_threshold
+    return (pixels_up / mask_pixels >= threshold,
+            pixels_down / mask_pixels >= threshold)
+
+
+def _walk_adjust_point_vertically(image, point, line, interval, iwidth):
+    # Reference implementation that walks every line point by point
+    rho, theta = line
+    lines = [line]
+    for i in range(interval[0], interval[1] + 1):
+        lines.append((rho + i, theta))
+        lines.append((rho - i, theta))
+    values = []
+    for l in lines:
+        match = 0
+        for xx in range(point[0] - 2, point[0] + 3):
+            x, y = geometry.line_point(l, x=xx)
+            if y >= 0 and x >= 0 and x < iwidth and image[y, x] > 0:
+                match += 1
+        p = geometry.line_point(l, x=point[0])
+        values.append((match, p[1], p))
+    values.sort(reverse=True)
+    best = [(m, ppp) for (m, yyy, ppp) in values if m == values[0][0]]
+    return best[len(best) // 2][1]
+
+def _walk_match_level(image, p0, p1):
+    # Reference implementation that walks the line point by point
+    points = [(x, y) for (x, y) in geometry.walk_line(p0, p1)]
+    active = len([(x, y) for (x, y) in points if image[y, x] > 0])
+    return float(active) / len(points)
+
+def _walk_line_bounds(image, line, iwidth):
+    # Reference implementation with a per-pixel state machine
+    p0 = geometry.line_point(line, x=0)
+    if p0[1] < 0:
+        p0 = geometry.line_point(line, y=0)
+    p1 = geometry.line_point(line, x=iwidth - 1)
+    if p1[1] < 0:
+        p1 = geometry.line_point(line, y=0)
+    image_dimensions = (images.width(image), images.height(image))
+    if (not geometry.point_is_valid(p0, image_dimensions)
+        or not geometry.point_is_valid(p1, image_dimensions)):
+        return None, None
+    ini_found = False
+    ini = None
+    end = None
+    last = 0
+    count = 0
+    for x, y in geometry.walk_line(p0, p1):
+        value = 1 if image[y, x] > 0 else 0
+        if value == last:
+            count += 1
+        else:
+            last = value
+            count = 1
+        if not ini_found:
+            if last == 1:
+                if count == 1:
+                    ini = (x, y)
+                elif count == 3:
+                    ini_found = True
+        else:
+            if last == 1 and count > 2:
+                end = (x, y)
+    if ini is None or end is None:
+        ini = None
+        end = None
+    return ini, end
+
+
+class _FakeCamera:
+    """Camera that produces numbered frames, one per `tick` call."""
+
+    def __init__(self):
+        self.count = 0
+        self.ticks = threading.Semaphore(0)
+        self.retrieved_into = []
+
+    def tick(self, frames=1):
+        for i in range(frames):
+            self.ticks.release()
+
+    def grab(self):
+        return self.ticks.acquire(timeout=0.05)
+
+    def retrieve(self, image=None):
+        self.retrieved_into.append(image)
+        self.count += 1
+        if image is None:
+            image = np.zeros((4, 4, 3), dtype=np.uint8)
+        image[:, :] = self.count
+        return True, image
+
+
+class TestFrameGrabber(unittest.TestCase):
+
+    def test_newest_frame(self):
+        camera = _FakeCamera()
+        grabber = detection.FrameGrabber(camera, num_buffers=3)
+        grabber.start()
+        try:
+            self.assertIsNone(grabber.read(timeout=0.1))
+            camera.tick(5)
+            while camera.count < 5:
+                time.sleep(0.01)
+            # Let the grabber publish the last frame
+            time.sleep(0.05)
+            frame = grabber.read()
+            self.assertEqual(frame[0, 0, 0], 5)
+            # A frame is never returned twice
+            self.assertIsNone(grabber.read(timeout=0.1))
+            camera.tick()
+            next_frame = grabber.read()
+            self.assertEqual(next_frame[0, 0, 0], 6)
+            # The caller owns the frames: later frames don't overwrite them
+            num_retrieved = len(camera.retrieved_into)
+            camera.tick(4)
+            while camera.count < 10:
+                time.sleep(0.01)
+            self.assertEqual(frame[0, 0, 0], 5)
+            self.assertEqual(next_frame[0, 0, 0], 6)
+            self.assertFalse(any(buffer is frame or buffer is next_frame
+                                 for buffer
+                                 in camera.retrieved_into[num_retrieved:]))
+            # Buffers of frames nobody read are reused
+            self.assertTrue(any(buffer is not None
+                                for buffer in camera.retrieved_into))
+        finally:
+            grabber.stop()
 
 
+class TestBufferPool(unittest.TestCase):
+
+    def test_reuse(self):
+        pool = detection.BufferPool(max_free=2)
+        image_1 = pool.acquire((4, 5))
+        image_2 = pool.acquire((4, 5, 3))
+        self.assertEqual(image_1.shape, (4, 5))
+        self.assertEqual(image_2.shape, (4, 5, 3))
+        pool.release(image_1)
+        pool.release(image_1)
+        pool.release(image_2)
+        self.assertIs(pool.acquire((4, 5)), image_1)
+        self.assertIsNot(pool.acquire((4, 5)), image_1)
+        self.assertIs(pool.acquire((4, 5, 3)), image_2)
+        # No more than max_free images of each shape are kept
+        images_ = [pool.acquire((2, 2)) for i in range(3)]
+        for image in images_:
+            pool.release(image)
+        self.assertIs(pool.acquire((2, 2)), images_[1])
+        self.assertIs(pool.acquire((2, 2)), images_[0])
+        self.assertFalse(any(pool.acquire((2, 2)) is image
+                             for image in images_))
+
 
 class TestDetection(unittest.TestCase):
 
@@ -93,6 +276,348 @@ class TestDetection(unittest.TestCase):
         self.assertEqual(len(detector.decisions.detected_id), 9)
         self.assertEqual(len(detector.decisions.model), 1)
 
+    def test_detection_timings(self):
+        image_path = self._get_test_file_path('capture.png')
+        options = detection.ExamDetector.get_default_options()
+        options['capture-from-file'] = True
+        options['capture-raw-file'] = image_path
+        dimensions = ((3, 5), )
+        with tempfile.TemporaryDirectory() as dirname:
+            options['timings-file'] = os.path.join(dirname, 'timings.jsonl')
+            context = detection.ExamDetectorContext(fixed_hough_threshold=180)
+            for i in range(3):
+                detector = detection.ExamDetector(dimensions, context, options)
+                detector.detect()
+            with open(options['timings-file']) as file_:
+                records = [json.loads(line) for line in file_]
+        for stage in ('pre-process', 'hough', 'detect-boxes', 'filter-axes',
+                      'cell-corners', 'classify-cells', 'infobits'):
+            self.assertIn(stage, detector.timings)
+            self.assertGreaterEqual(detector.timings[stage], 0.0)
+        self.assertEqual(len(records), 3)
+        self.assertEqual(set(records[-1]['timings']), set(detector.timings))
+        percentiles = context.timing_percentiles()
+        self.assertEqual(set(percentiles), set(detector.timings))
+        for stage, values in percentiles.items():
+            self.assertEqual(list(values), [50, 90, 99])
+            self.assertLessEqual(values[50], values[99])
+
+    def test_track_axes(self):
+        image = images.load_image(self._get_test_file_path('capture.png'))
+        dimensions = ((3, 5), )
+        corners = self._hough_corner_matrixes(detection.pre_process(image),
+                                              dimensions)
+        segments = detection.tracking_segments(corners, [])
+        shift = np.float32([[1, 0, 3], [0, 1, -2]])
+        moved = cv2.warpAffine(image, shift, (images.width(image),
+                                              images.height(image)),
+                               borderMode=cv2.BORDER_REPLICATE)
+        image_proc = detection.pre_process(moved)
+        axes, new_segments = detection.track_axes(image_proc, segments)
+        self.assertIsNotNone(axes)
+        self.assertEqual(len(new_segments[0]), len(segments[0]))
+        self.assertEqual(len(new_segments[1]), len(segments[1]))
+        tracked = detection.cell_corners(axes[1][1], axes[0][1],
+                                         images.width(image),
+                                         images.height(image), dimensions)
+        self.assertEqual(len(tracked), 1)
+        for row, tracked_row in zip(corners[0], tracked[0]):
+            for point, tracked_point in zip(row, tracked_row):
+                self.assertLessEqual(abs(point[0] + 3 - tracked_point[0]), 2)
+                self.assertLessEqual(abs(point[1] - 2 - tracked_point[1]), 2)
+        # Nothing to track in an empty image
+        empty = np.zeros_like(image_proc)
+        self.assertEqual(detection.track_axes(empty, segments), (None, None))
+
+    def test_region_of_interest(self):
+        image = images.load_image(self._get_test_file_path('capture.png'))
+        roi = (150, 100, 500, 420)
+        x0, y0, x1, y1 = roi
+        image_proc = detection.pre_process(image)
+        roi_proc = detection.pre_process(image, roi=roi)
+        self.assertEqual(roi_proc.shape, image_proc.shape)
+        self.assertTrue(np.array_equal(roi_proc[y0:y1, x0:x1],
+                                       image_proc[y0:y1, x0:x1]))
+        roi_proc[y0:y1, x0:x1] = 0
+        self.assertFalse(roi_proc.any())
+        # Lines found in the region are in whole image coordinates
+        lines = detection.detect_lines(image_proc, 180)
+        roi_lines = detection.detect_lines(detection.pre_process(image, roi),
+                                           180, roi=roi)
+        self.assertTrue(len(roi_lines) > 0)
+        for rho, theta in roi_lines:
+            self.assertTrue(any(abs(rho - r) <= 2 and abs(theta - t) <= 0.02
+                                for r, t in lines))
+
+    def test_refine_axes(self):
+        image = images.load_image(self._get_test_file_path('capture.png'))
+        dimensions = ((3, 5), )
+        image_proc = detection.pre_process(image)
+        corners = self._hough_corner_matrixes(image_proc, dimensions)
+        lines = detection.detect_lines(image_proc, 180)
+        axes = detection.filter_axes(detection.detect_boxes(lines, dimensions),
+                                     dimensions, images.width(image),
+                                     images.height(image), False)
+        big = cv2.resize(image, (2 * images.width(image),
+                                 2 * images.height(image)))
+        big_proc = detection.pre_process(big)
+        big_axes = detection.refine_axes(big_proc, axes, corners, 0.5,
+                                         dimensions)
+        self.assertEqual(len(big_axes[0][1]), 4)
+        self.assertEqual(len(big_axes[1][1]), len(axes[1][1]))
+        big_corners = detection.cell_corners(big_axes[1][1], big_axes[0][1],
+                                             images.width(big),
+                                             images.height(big), dimensions)
+        self.assertEqual(len(big_corners), 1)
+        for row, big_row in zip(corners[0], big_corners[0]):
+            for point, big_point in zip(row, big_row):
+                self.assertLessEqual(abs(2 * point[0] - big_point[0]), 6)
+                self.assertLessEqual(abs(2 * point[1] - big_point[1]), 6)
+
+    def test_pre_process_buffers(self):
+        image = images.load_image(self._get_test_file_path('capture.png'))
+        dst = np.full(image.shape[:2], 7, dtype=np.uint8)
+        gray = np.empty(image.shape[:2], dtype=np.uint8)
+        result = detection.pre_process(image, dst=dst, gray=gray)
+        self.assertIs(result, dst)
+        self.assertTrue(np.array_equal(dst, detection.pre_process(image)))
+        roi = (100, 50, 400, 300)
+        dst[:, :] = 7
+        detection.pre_process(image, roi=roi, dst=dst, gray=gray)
+        self.assertTrue(np.array_equal(
+            dst, detection.pre_process(image, roi=roi)))
+
+    def test_detector_reset(self):
+        image = images.load_image(self._get_test_file_path('capture.png'))
+        options = detection.ExamDetector.get_default_options()
+        dimensions = ((3, 5), )
+        context = detection.ExamDetectorContext(fixed_hough_threshold=180)
+        detector = detection.ExamDetector(dimensions, context, options,
+                                          image_raw=image)
+        detector.detect()
+        answers = detector.decisions.answers
+        image_proc = detector.image_proc
+        image_drawn = detector.capture.image_drawn
+        # The new frame is processed in the buffers of the previous one
+        detector.reset(image_raw=image)
+        detector.detect()
+        self.assertEqual(detector.decisions.answers, answers)
+        self.assertIs(detector.image_proc, image_proc)
+        self.assertIs(detector.capture.image_drawn, image_drawn)
+        self.assertIs(detector.capture.image_raw, image)
+
+    def test_detect_lines_thresholds(self):
+        image = detection.pre_process(
+            images.load_image(self._get_test_file_path('capture.png')))
+        thresholds = [260, 180, 225]
+        for roi in (None, (100, 50, 500, 400)):
+            all_lines = detection.detect_lines_thresholds(image, thresholds,
+                                                          roi=roi)
+            self.assertEqual(len(all_lines), 3)
+            for threshold, lines in zip(thresholds, all_lines):
+                self.assertEqual(lines, detection.detect_lines(image,
+                                                               threshold,
+                                                               roi=roi))
+
+    def test_multi_threshold(self):
+        image = images.load_image(self._get_test_file_path('capture.png'))
+        options = detection.ExamDetector.get_default_options()
+        options['multi-threshold'] = True
+        dimensions = ((3, 5), )
+        context = detection.ExamDetectorContext()
+        # The first threshold does not work for this image
+        self.assertEqual(context.get_hough_threshold(), 280)
+        detector = detection.ExamDetector(dimensions, context, options,
+                                          image_raw=image)
+        self.assertTrue(detector.detect())
+        threshold = context.get_hough_threshold()
+        self.assertNotEqual(threshold, 280)
+        # The context stays at the threshold that worked
+        detector = detection.ExamDetector(dimensions, context, options,
+                                          image_raw=image)
+        self.assertTrue(detector.detect())
+        self.assertEqual(context.get_hough_threshold(), threshold)
+
+    def test_fit_lattice(self):
+        # Two groups of 4 and 2 cells: the line at 70 is missing and
+        # the one at 60 is spurious
+        lines = [(10.0, 0.01), (30.2, 0.01), (50.0, 0.01), (60.0, 0.01),
+                 (90.1, 0.01), (150.0, 0.01), (169.9, 0.01), (190.0, 0.01)]
+        fitted = detection.fit_lattice(lines, [4, 2])
+        self.assertEqual(len(fitted), 8)
+        expected = (10, 30, 50, 70, 90, 150, 170, 190)
+        for (rho, theta), rho_expected in zip(fitted, expected):
+            self.assertAlmostEqual(rho, rho_expected, delta=0.5)
+            self.assertAlmostEqual(theta, 0.01)
+        # The border line of the first group is missing
+        self.assertIsNone(detection.fit_lattice(lines[1:], [4, 2]))
+
+    def test_grid_fit(self):
+        image = images.load_image(self._get_test_file_path('capture.png'))
+        image_proc = detection.pre_process(image)
+        dimensions = ((3, 5), )
+        axes = detection.fit_grid(detection.detect_lines(image_proc, 225),
+                                  dimensions)
+        self.assertEqual(len(axes[0][1]), 4)
+        self.assertEqual(len(axes[1][1]), 8)
+        corner_matrixes = detection.cell_corners(axes[1][1], axes[0][1],
+                                                 640, 480, dimensions)
+        self.assertEqual(len(corner_matrixes), 1)
+        options = detection.ExamDetector.get_default_options()
+        options['grid-fit'] = True
+        context = detection.ExamDetectorContext(fixed_hough_threshold=225)
+        detector = detection.ExamDetector(dimensions, context, options,
+                                          image_raw=image)
+        self.assertTrue(detector.detect())
+        self.assertIn('fit-grid', detector.timings)
+        self.assertEqual(len(detector.decisions.answers), 5)
+
+    def test_detect_tables_contours(self):
+        image = detection.pre_process(
+            images.load_image(self._get_test_file_path('capture.png')))
+        axes, corner_matrixes = \
+            detection.detect_tables_contours(image, ((3, 5), ))
+        self.assertEqual(len(corner_matrixes), 1)
+        self.assertEqual(corner_matrixes[0].shape, (6, 4, 2))
+        self.assertTrue(detection.check_corners(corner_matrixes, 640, 480))
+        self.assertEqual(len(axes[0][1]), 4)
+        # The two lines of the id box and those of the table
+        self.assertEqual(len(axes[1][1]), 2 + 6)
+        # Not enough cells for these tables
+        self.assertEqual(detection.detect_tables_contours(image, ((3, 8), )),
+                         (None, []))
+        blank = np.zeros_like(image)
+        self.assertEqual(detection.detect_tables_contours(blank, ((3, 5), )),
+                         (None, []))
+
+    def test_contour_engine(self):
+        image = images.load_image(self._get_test_file_path('capture.png'))
+        options = detection.ExamDetector.get_default_options()
+        options['read-id'] = True
+        options['id-num-digits'] = 9
+        dimensions = ((3, 5), )
+        cells = []
+        for engine in ('hough', 'contours'):
+            options['table-engine'] = engine
+            context = detection.ExamDetectorContext(fixed_hough_threshold=180)
+            detector = detection.ExamDetector(dimensions, context, options,
+                                              image_raw=image)
+            self.assertTrue(detector.detect())
+            self.assertEqual(len(detector.decisions.detected_id), 9)
+            cells.append(np.array([cell.corners()
+                                   for row in detector.capture.answer_cells
+                                   for cell in row]))
+        self.assertIn('contours', detector.timings)
+        self.assertLessEqual(np.abs(cells[0] - cells[1]).max(), 3)
+        options['table-engine'] = 'unknown'
+        detector = detection.ExamDetector(dimensions, context, options,
+                                          image_raw=image)
+        self.assertRaises(ValueError, detector.detect)
+
+    def test_gate_frame(self):
+        image = images.load_image(self._get_test_file_path('capture.png'))
+        thumbnail = detection.frame_thumbnail(image)
+        self.assertEqual(thumbnail.shape, (120, 160))
+        self.assertIsNone(detection.gate_frame(thumbnail))
+        self.assertIsNone(detection.gate_frame(thumbnail, thumbnail))
+        moved = detection.frame_thumbnail(np.roll(image, 60, axis=1))
+        self.assertEqual(detection.gate_frame(thumbnail, moved), 'motion')
+        blank = detection.frame_thumbnail(np.full_like(image, 120))
+        self.assertEqual(detection.gate_frame(blank), 'edges')
+        stripes = np.tile(np.sin(np.linspace(0, 60, 160)) * 40 + 120,
+                          (120, 1)).astype(np.uint8)
+        self.assertEqual(detection.gate_frame(stripes), 'orientation')
+        blurred = detection.frame_thumbnail(cv2.blur(image, (25, 1)))
+        self.assertEqual(detection.gate_frame(blurred), 'orientation')
+
+    def test_decide_infobit(self):
+        image = detection.pre_process(
+            images.load_image(self._get_test_file_path('capture.png')))
+        mask = images.new_image(images.width(image), images.height(image), 1)
+        for center in ((300, 420), (420, 425), (0, 0), (639, 479), (-3, 5),
+                       (100, 478), (250, 200)):
+            for dy in ((1, 48), (0, 2), (-2, 30), (3, -45)):
+                self.assertEqual(detection.decide_infobit(image, center, dy),
+                                 _full_mask_infobit(image, mask, center, dy))
+
+    def test_compare_frames(self):
+        image = images.load_image(self._get_test_file_path('capture.png'))
+        cells = [[capture.CellGeometry((215, 134), (505, 134),
+                                       (215, 401), (505, 401), None, None)]]
+        self.assertEqual(detection.answer_cells_region(cells, 640, 480),
+                         (186, 107, 534, 428))
+        moved = np.roll(image, 3, axis=1)
+        brighter = np.clip(image * 0.7 + 20, 0, 255).astype(np.uint8)
+        self.assertTrue(detection.compare_frames(moved, image, cells))
+        self.assertTrue(detection.compare_frames(brighter, image, cells))
+        blank = np.full_like(image, 200)
+        self.assertFalse(detection.compare_frames(blank, image, cells))
+        self.assertIsNone(detection.compare_frames(image[:240], image, cells))
+        self.assertIsNone(detection.compare_frames(None, image, cells))
+
+    def test_change_reference(self):
+        image = images.load_image(self._get_test_file_path('capture.png'))
+        cells = [[capture.CellGeometry((215, 134), (505, 134),
+                                       (215, 401), (505, 401), None, None)]]
+        context = detection.ExamDetectorContext()
+        options = detection.ExamDetector.get_default_options()
+        detector = detection.ExamDetector(((3, 5), ), context, options,
+                                          image_raw=image)
+        exam_capture = detector._new_capture(cells, [], 1.0)
+        self.assertIs(exam_capture.image_reference, image)
+        for option in ('show-image-proc', 'show-lines'):
+            options = detection.ExamDetector.get_default_options()
+            options[option] = True
+            detector = detection.ExamDetector(((3, 5), ), context, options,
+                                              image_raw=image)
+            if option == 'show-lines':
+                detector.image_to_show[:, ::20] = (255, 0, 0)
+            exam_capture = detector._new_capture(cells, [], 1.0)
+            self.assertIsNot(exam_capture.image_raw, image)
+            self.assertTrue(np.array_equal(exam_capture.image_reference,
+                                           images.rgb_to_gray(image)))
+            # The same frame is still the same exam
+            self.assertTrue(detection.compare_frames(
+                                        image, exam_capture.image_reference,
+                                        cells))
+            if option == 'show-image-proc':
+                # The inverted, thresholded image would look like
+                # another exam
+                self.assertFalse(detection.compare_frames(
+                                        image, exam_capture.image_raw, cells))
+
+    def test_construct_box(self):
+        outer_corners = ((113, 125), (251, 117), (117, 332), (259, 325))
+        corners = detection.construct_box(outer_corners, 3, 5)
+        self.assertEqual(corners.shape, (6, 4, 2))
+        # Same points as interpolating each line with tuples
+        plu, pru, pld, prd = outer_corners
+        factor_h = geometry.distance(pld, prd) / geometry.distance(plu, pru)
+        factor_v = geometry.distance(pru, prd) / geometry.distance(plu, pld)
+        left = geometry.interpolate_line_progressive(plu, pld, 6, factor_h)
+        right = geometry.interpolate_line_progressive(pru, prd, 6, factor_h)
+        for row, pl, pr in zip(corners.tolist(), left, right):
+            expected = geometry.interpolate_line_progressive(pl, pr, 4,
+                                                             factor_v)
+            self.assertEqual([tuple(p) for p in row], expected)
+
+    def _hough_corner_matrixes(self, image_proc, dimensions):
+        for th in (170, 180, 190):
+            lines = detection.detect_lines(image_proc, th)
+            axes = detection.detect_boxes(lines, dimensions)
+            if axes is None:
+                continue
+            axes = detection.filter_axes(axes, dimensions,
+                                         images.width(image_proc),
+                                         images.height(image_proc), False)
+            corners = detection.cell_corners(axes[1][1], axes[0][1],
+                                             images.width(image_proc),
+                                             images.height(image_proc),
+                                             dimensions)
+            if corners:
+                return corners
+        self.fail('No tables found in the test capture')
+
     def test_manual_detection(self):
         manual_points = [
             (113, 125),
@@ -123,14 +648,14 @@ class TestDetection(unittest.TestCase):
                     self.assertEqual(len(point), 2)
         # Manual points are in the proper places:
         box_1, box_2 = corner_matrixes
-        self.assertEqual(box_1[0][0], manual_points[0])
-        self.assertEqual(box_1[0][3], manual_points[1])
-        self.assertEqual(box_1[5][0], manual_points[4])
-        self.assertEqual(box_1[5][3], manual_points[5])
-        self.assertEqual(box_2[0][0], manual_points[2])
-        self.assertEqual(box_2[0][3], manual_points[3])
-        self.assertEqual(box_2[5][0], manual_points[6])
-        self.assertEqual(box_2[5][3], manual_points[7])
+        self.assertEqual(tuple(box_1[0, 0]), manual_points[0])
+        self.assertEqual(tuple(box_1[0, 3]), manual_points[1])
+        self.assertEqual(tuple(box_1[5, 0]), manual_points[4])
+        self.assertEqual(tuple(box_1[5, 3]), manual_points[5])
+        self.assertEqual(tuple(box_2[0, 0]), manual_points[2])
+        self.assertEqual(tuple(box_2[0, 3]), manual_points[3])
+        self.assertEqual(tuple(box_2[5, 0]), manual_points[6])
+        self.assertEqual(tuple(box_2[5, 3]), manual_points[7])
         # Reordering points should have no effect:
         manual_points[1], manual_points[5] = manual_points[5], manual_points[1]
         manual_points[0], manual_points[4] = manual_points[4], manual_points[0]
@@ -138,4 +663,112 @@ class TestDetection(unittest.TestCase):
         self.assertTrue(detector.detect_manual(manual_points))
         corner_matrixes_2 = detection.process_box_corners(manual_points,
                                                           dimensions)
-        self.assertEqual(corner_matrixes, corner_matrixes_2)
+        for box, box_2 in zip(corner_matrixes, corner_matrixes_2):
+            self.assertTrue(np.array_equal(box, box_2))
+
+
+class TestIdBoxLines(unittest.TestCase):
+
+    def _random_image(self, rng, density, shape=(40, 60)):
+        image = (rng.random(shape) < density).astype(np.uint8) * 255
+        # Some long horizontal runs, as the lines of the id box
+        for y in rng.integers(0, shape[0], 3):
+            x0, x1 = sorted(rng.integers(0, shape[1], 2))
+            image[y, x0:x1 + 1] = 255
+        return image
+
+    def test_match_levels_fixed(self):
+        image = np.zeros((10, 12), dtype=np.uint8)
+        image[4, 2:8] = 255
+        image[1:9, 10] = 255
+        pairs = [((0, 4), (11, 4)), ((2, 4), (7, 4)), ((10, 0), (10, 9)),
+                 ((5, 4), (5, 4)), ((0, 0), (11, 0))]
+        self.assertEqual(detection.id_boxes_match_levels(image, pairs),
+                         [7 / 12, 1.0, 0.8, 1.0, 0.0])
+        self.assertEqual(detection.id_boxes_match_levels(image, []), [])
+        self.assertEqual(detection.id_boxes_match_level(image, (2, 4),
+                                                        (11, 4)), 0.7)
+
+    def test_match_levels(self):
+        rng = np.random.default_rng(3)
+        for density in (0.1, 0.5, 0.9):
+            image = self._random_image(rng, density)
+            height, width = image.shape
+            pairs = []
+            for i in range(200):
+                p0 = tuple(int(c) for c in rng.integers(0, (width, height)))
+                p1 = tuple(int(c) for c in rng.integers(0, (width, height)))
+                if i % 4 == 1:
+                    p1 = (p0[0], p1[1])
+                elif i % 4 == 2:
+                    p1 = (p1[0], p0[1])
+                elif i % 8 == 3:
+                    p1 = p0
+                pairs.append((p0, p1))
+            expected = [_walk_match_level(image, p0, p1) for p0, p1 in pairs]
+            self.assertEqual(detection.id_boxes_match_levels(image, pairs),
+                             expected)
+
+    def test_adjust_point_vertically_fixed(self):
+        image = np.zeros((30, 40), dtype=np.uint8)
+        image[14, :] = 255
+        # Half-integer rhos, because line_point truncates coordinates
+        horizontal = (10.5, np.pi / 2)
+        self.assertEqual(detection.id_boxes_adjust_point_vertically(
+                                image, (20, 10), horizontal, (1, 5), 40),
+                         (20, 14))
+        # Next to the left border, part of the columns are clipped
+        self.assertEqual(detection.id_boxes_adjust_point_vertically(
+                                image, (0, 10), horizontal, (1, 5), 40),
+                         (0, 14))
+
+    def test_adjust_point_vertically(self):
+        rng = np.random.default_rng(4)
+        for density in (0.1, 0.5, 0.9):
+            image = self._random_image(rng, density)
+            height, width = image.shape
+            for i in range(200):
+                # Points near or beyond the left, right and top borders
+                point = (int(rng.integers(-3, width + 3)),
+                         int(rng.integers(-5, height - 10)))
+                theta = np.pi / 2 + rng.uniform(-0.05, 0.05)
+                rho = point[0] * np.cos(theta) + point[1] * np.sin(theta)
+                interval = (1, int(rng.integers(1, 4)))
+                self.assertEqual(
+                    detection.id_boxes_adjust_point_vertically(
+                                image, point, (rho, theta), interval, width),
+                    _walk_adjust_point_vertically(
+                                image, point, (rho, theta), interval, width))
+
+    def test_line_bounds_fixed(self):
+        image = np.zeros((20, 30), dtype=np.uint8)
+        image[8, 4:20] = 255
+        image[8, 24:26] = 255
+        image[12, 3:5] = 255
+        # Half-integer rhos, because line_point truncates coordinates
+        horizontal = np.pi / 2
+        self.assertEqual(detection.line_bounds(image, (8.5, horizontal), 30),
+                         ((4, 8), (19, 8)))
+        # Runs shorter than three pixels are ignored
+        self.assertEqual(detection.line_bounds(image, (12.5, horizontal), 30),
+                         (None, None))
+        self.assertEqual(detection.line_bounds(image, (2.5, horizontal), 30),
+                         (None, None))
+        # Lines out of the image
+        self.assertEqual(detection.line_bounds(image, (25.5, horizontal), 30),
+                         (None, None))
+        self.assertEqual(detection.line_bounds(image, (-3.5, horizontal), 30),
+                         (None, None))
+
+    def test_line_bounds(self):
+        rng = np.random.default_rng(5)
+        for density in (0.05, 0.3, 0.7):
+            image = self._random_image(rng, density)
+            height, width = image.shape
+            for i in range(300):
+                theta = np.pi / 2 + rng.uniform(-0.2, 0.2)
+                rho = rng.uniform(-10, height + 10)
+                self.assertEqual(detection.line_bounds(image, (rho, theta),
+                                                       width),
+                                 _walk_line_bounds(image, (rho, theta),
+                                                   width))
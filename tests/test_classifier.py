@@ -15,13 +15,64 @@
 # along with this program.  If not, see
 # <http://www.gnu.org/licenses/>.
 #
+import io
 import os
+import pickle
+import shutil
+import tempfile
 import unittest
+from unittest import mock
 
+import cv2
 import numpy as np
 
 import eyegrade.ocr.sample as sample
 import eyegrade.ocr.classifiers as classifiers
+import eyegrade.ocr.decide_params as decide_params
+import eyegrade.ocr.evaluation as evaluation
+import eyegrade.ocr.preprocessing as preprocessing
+import eyegrade.ocr.feature_cache as feature_cache
+import eyegrade.tools.ocr_benchmark as ocr_benchmark
+
+
+def _project_reference(samp, width, height, threshold=True):
+    corners_dst = np.array([[0, 0],
+                            [width - 1, 0],
+                            [0, height - 1],
+                            [width - 1, height - 1]],
+                           dtype='float32')
+    h = cv2.findHomography(np.array(samp.corners, dtype='float32'),
+                           corners_dst)
+    image = cv2.warpPerspective(samp.image, h[0], (width, height))
+    if threshold:
+        image = cv2.threshold(image, 64, 255, cv2.THRESH_BINARY)[1]
+    return image
+
+
+def _extract_reference(extractor, samp):
+    """Sample by sample feature extraction, allocating every image.
+
+    It is the way the extractors of `preprocessing` worked before
+    they extracted whole batches into a preallocated matrix.
+
+    """
+    if isinstance(extractor, preprocessing.CrossesFeatureExtractor):
+        image = _project_reference(samp, extractor.dim, extractor.dim)
+    elif isinstance(extractor, preprocessing.FeatureExtractor):
+        p = samp.corners
+        width = int((cv2.norm(p[0,:], p[1,:]) + cv2.norm(p[2,:], p[3,:])) / 2)
+        height = int((cv2.norm(p[0,:], p[2,:]) + cv2.norm(p[1,:], p[3,:])) / 2)
+        image = _project_reference(samp, width, height)
+        image = ocr_benchmark.deskew_reference(image, extractor.dim)
+        image = ocr_benchmark.clear_boundbox_reference(image)
+        image = cv2.resize(image, (extractor.dim, extractor.dim))
+    else:
+        image = _project_reference(samp, extractor.dim, extractor.dim,
+                                   threshold=extractor.threshold)
+        image = ocr_benchmark.deskew_reference(image, extractor.dim)
+        return extractor._preprocess_hog(image)
+    image_matrix = np.array(image, np.float32) / 255.0
+    return image_matrix.reshape(extractor.features_len, )
 
 
 class TestClassifier(unittest.TestCase):
@@ -45,3 +96,237 @@ class TestClassifier(unittest.TestCase):
         classifier = classifiers.DefaultCrossesClassifier()
         label = classifier.classify(samp)
         self.assertTrue(label == 0 or label == 1)
+
+    def test_classify_cross_batch(self):
+        image_path = self._get_test_file_path('cross.png')
+        corners_list = [
+            np.array([[0, 0], [27, 0], [1, 32], [29, 32]]),
+            np.array([[2, 1], [25, 2], [2, 30], [27, 31]]),
+            np.array([[0, 0], [29, 0], [0, 32], [29, 32]]),
+        ]
+        samples = [sample.Sample(corners, image_filename=image_path)
+                   for corners in corners_list]
+        classifier = classifiers.DefaultCrossesClassifier()
+        labels = classifier.classify_batch(samples)
+        self.assertEqual(labels, [classifier.classify(s) for s in samples])
+        self.assertEqual(classifier.is_cross_batch(samples),
+                         [label == 1 for label in labels])
+        self.assertEqual(classifier.classify_batch([]), [])
+
+    def test_extract_batch_same_image(self):
+        image_path = self._get_test_file_path('cross.png')
+        image = sample.Sample(np.zeros((4, 2)),
+                              image_filename=image_path).image
+        corners_list = [
+            np.array([[0, 0], [27, 0], [1, 32], [29, 32]]),
+            np.array([[2, 1], [25, 2], [2, 30], [27, 31]]),
+            np.array([[0.5, 0.2], [28.7, 1.1], [0.3, 31.6], [29.2, 32.4]]),
+            np.array([[-3, -2], [31, 0], [0, 35], [29, 32]]),
+        ] * 40
+        samples = [sample.Sample(corners, image=image)
+                   for corners in corners_list]
+        extractor = preprocessing.CrossesFeatureExtractor()
+        features = extractor.extract_batch(samples)
+        expected = np.array([_extract_reference(extractor, s)
+                             for s in samples])
+        self.assertEqual(features.dtype, np.float32)
+        self.assertTrue(np.array_equal(features, expected))
+
+    def test_extract_batch_out(self):
+        image_path = self._get_test_file_path('cross.png')
+        corners_list = [
+            np.array([[0, 0], [27, 0], [1, 32], [29, 32]]),
+            np.array([[2, 1], [25, 2], [2, 30], [27, 31]]),
+            np.array([[0.5, 0.2], [28.7, 1.1], [0.3, 31.6], [29.2, 32.4]]),
+        ]
+        samples = [sample.Sample(corners, image_filename=image_path)
+                   for corners in corners_list]
+        extractors = [preprocessing.FeatureExtractor(),
+                      preprocessing.CrossesFeatureExtractor(),
+                      preprocessing.OpenCVExampleExtractor(threshold=True)]
+        for extractor in extractors:
+            out = np.zeros((len(samples), extractor.features_len),
+                           dtype=np.float32)
+            features = extractor.extract_batch(samples, out=out)
+            self.assertIs(features, out)
+            for samp, row in zip(samples, features):
+                expected = _extract_reference(extractor, samp)
+                self.assertTrue(np.array_equal(row, expected))
+                self.assertTrue(np.array_equal(extractor.extract(samp),
+                                               expected))
+            self.assertEqual(extractor.extract_batch([]).shape,
+                             (0, extractor.features_len))
+            self.assertRaises(ValueError, extractor.extract_batch, samples,
+                              out=np.zeros((2, extractor.features_len),
+                                           dtype=np.float32))
+            self.assertRaises(ValueError, extractor.extract_batch, samples,
+                              out=out.astype(np.float64))
+
+    def test_clear_boundbox(self):
+        rng = np.random.default_rng(3)
+        digit = sample.Sample(np.array([[0, 1], [19, 0], [0, 7], [21, 17]]),
+                              image_filename=self._get_test_file_path(
+                                                                'digit.png'))
+        images = [preprocessing.deskew(
+                        preprocessing.FeatureExtractor._reshape(digit), 28),
+                  np.zeros((28, 28), dtype=np.uint8),
+                  np.full((5, 7), 255, dtype=np.uint8)]
+        for density in (0.02, 0.1, 0.3, 0.6):
+            for shape in ((28, 28), (9, 13), (3, 2), (1, 1)):
+                images.extend((rng.random(shape) < density).astype(np.uint8)
+                              * 255 for _ in range(50))
+        for image in images:
+            try:
+                expected = ocr_benchmark.clear_boundbox_reference(image)
+            except IndexError:
+                # Only the last row is a valid start: the vectorized
+                # version starts there instead of failing
+                self.assertEqual(preprocessing.clear_boundbox(image).shape[0],
+                                 1)
+                continue
+            self.assertTrue(np.array_equal(
+                                preprocessing.clear_boundbox(image), expected))
+
+    def test_deskew(self):
+        digit = sample.Sample(np.array([[0, 1], [19, 0], [0, 7], [21, 17]]),
+                              image_filename=self._get_test_file_path(
+                                                                'digit.png'))
+        image = preprocessing.FeatureExtractor._reshape(digit)
+        dst = np.empty((28, 28), dtype=np.uint8)
+        deskewed = preprocessing.deskew(image, 28, dst=dst)
+        self.assertIs(deskewed, dst)
+        expected = ocr_benchmark.deskew_reference(image, 28)
+        self.assertTrue(np.array_equal(deskewed, expected))
+        # Negligible skew: the image is returned as is
+        blank = np.zeros((20, 18), dtype=np.uint8)
+        self.assertIs(preprocessing.deskew(blank, 28, dst=dst), blank)
+        results = ocr_benchmark.run_benchmark(digit.image,
+                                              corners=digit.corners,
+                                              repeat=10)
+        self.assertGreater(results['clear-boundbox-speedup'], 0.0)
+
+    def test_feature_cache(self):
+        extractor = preprocessing.FeatureExtractor()
+        with tempfile.TemporaryDirectory() as dirname:
+            image_path = os.path.join(dirname, 'digit.png')
+            shutil.copy(self._get_test_file_path('digit.png'), image_path)
+            index = os.path.join(dirname, 'samples.txt')
+            with open(index, mode='w') as f:
+                f.write('digit.png\t3\t0\t1\t19\t0\t0\t7\t21\t17\n')
+                f.write('digit.png\t3\t1\t1\t18\t0\t0\t8\t20\t17\n')
+            samples = sample.SampleLoader(index).samples()
+            cache = feature_cache.FeatureCache.for_index(index, extractor)
+            self.assertEqual(cache.load_features(samples), 2)
+            for samp in samples:
+                self.assertTrue(np.array_equal(
+                    samp.cached_features(extractor.cache_key),
+                    extractor.extract(samp)))
+            # A new run reads the features without loading the images
+            sample_set = feature_cache.load_sample_set(
+                                    [index], features_extractor=extractor)
+            cached = sample_set.samples()
+            self.assertTrue(all(s._image is None for s in cached))
+            classifier = classifiers.SVMDigitClassifier(extractor)
+            features = classifier.extract_features(cached)
+            self.assertTrue(all(s._image is None for s in cached))
+            self.assertTrue(np.array_equal(
+                features, extractor.extract_batch(samples)))
+            self.assertEqual(cache.load_features(
+                                sample.SampleLoader(index).samples()), 0)
+            # Changing the image invalidates its rows
+            stat = os.stat(image_path)
+            os.utime(image_path, ns=(stat.st_atime_ns,
+                                     stat.st_mtime_ns + 10 ** 9))
+            self.assertEqual(cache.load_features(
+                                sample.SampleLoader(index).samples()), 2)
+            # Other extractors have their own cache
+            other = preprocessing.FeatureExtractor(dim=20)
+            other_cache = feature_cache.FeatureCache.for_index(index, other)
+            self.assertNotEqual(other_cache.filename, cache.filename)
+            self.assertEqual(other_cache.load_features(samples), 2)
+
+    def test_k_fold_cross_evaluation(self):
+        image_path = self._get_test_file_path('cross.png')
+        rng = np.random.default_rng(5)
+        base = np.array([[0, 0], [27, 0], [1, 32], [29, 32]])
+        samples = [sample.Sample(base + rng.integers(-2, 3, size=(4, 2)),
+                                 image_filename=image_path, label=i % 2)
+                   for i in range(60)]
+        sample_set = sample.SampleSet()
+        sample_set.load_from_samples(samples)
+        partitions = sample_set.partition(4)
+        extractor = preprocessing.CrossesFeatureExtractor()
+        classifier = classifiers.SVMCrossesClassifier(extractor)
+        copy = pickle.loads(pickle.dumps(classifier))
+        self.assertIsNot(copy.svm, classifier.svm)
+        for processes in (1, 2):
+            e = evaluation.KFoldCrossEvaluation(classifier, partitions,
+                                                processes=processes)
+            self.assertEqual(e.confusion_matrix.sum(), len(samples))
+            self.assertAlmostEqual(e.success_rate,
+                                   e.confusion_matrix.trace() / len(samples))
+            # Below the threshold it stops after the first fold
+            e = evaluation.KFoldCrossEvaluation(classifier, partitions,
+                                                threshold=1.1,
+                                                processes=processes)
+            self.assertEqual(e.confusion_matrix.sum(), len(partitions[0]))
+
+    def test_decide_params(self):
+        image_path = self._get_test_file_path('cross.png')
+        rng = np.random.default_rng(7)
+        base = np.array([[0, 0], [27, 0], [1, 32], [29, 32]])
+        samples = [sample.Sample(base + rng.integers(-2, 3, size=(4, 2)),
+                                 image_filename=image_path, label=i % 2)
+                   for i in range(40)]
+        sample_set = sample.SampleSet()
+        sample_set.load_from_samples(samples)
+        classifier = classifiers.SVMCrossesClassifier(
+                                    preprocessing.CrossesFeatureExtractor())
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = os.path.join(dirname, 'results.jsonl')
+            results, rmat = decide_params.decide_params(
+                                classifier, sample_set, [1, 100], [0.01, 0.1],
+                                k=4, processes=2, results_file=filename,
+                                min_folds=1, eta=2)
+            self.assertEqual(len(results), 4)
+            self.assertEqual(rmat.shape, (2, 2))
+            with open(filename) as f:
+                lines = f.readlines()
+            # Folds 1, 2 and 4 of 4, 2 and 1 points, plus the header
+            self.assertEqual(len(lines), 1 + 4 * 1 + 2 * 1 + 1 * 2)
+            # A resumed search evaluates nothing again
+            with open(filename, mode='a') as f:
+                f.write('{"C": 1, "gam')
+            resumed = decide_params.decide_params(
+                                classifier, sample_set, [1, 100], [0.01, 0.1],
+                                k=4, processes=1, results_file=filename,
+                                min_folds=1, eta=2)
+            self.assertEqual(resumed[0], results)
+            with open(filename) as f:
+                self.assertEqual(len(f.readlines()), len(lines) + 1)
+            self.assertRaises(ValueError, decide_params.decide_params,
+                              classifier, sample_set, [1, 100], [0.01, 0.1],
+                              k=4, processes=1, results_file=filename,
+                              seed=1)
+
+    def test_rungs(self):
+        self.assertEqual(decide_params._rungs(10, 2, 3), [2, 6, 10])
+        self.assertEqual(decide_params._rungs(10, 1, 2), [1, 2, 4, 8, 10])
+        self.assertEqual(decide_params._rungs(5, 1, 5), [1, 5])
+        self.assertEqual(decide_params._rungs(4, 6, 3), [4])
+        self.assertEqual(decide_params._rungs(3, None, 3), [1, 2, 3])
+        self.assertEqual(decide_params._rungs(3, 0, 3), [1, 2, 3])
+        # Schedules that would never reach k are rejected
+        sample_set = sample.SampleSet()
+        for min_folds, eta in ((1, 1), (2, 0), (0, 3), (-1, 3)):
+            self.assertRaises(ValueError, decide_params.decide_params,
+                              None, sample_set, [1], [0.1], k=5,
+                              min_folds=min_folds, eta=eta)
+        for argv in (['--eta', '1'], ['--min-folds', '-1']):
+            with mock.patch('sys.argv', ['decide_params', 'crosses',
+                                         'samples.txt'] + argv), \
+                 mock.patch('sys.stderr', new_callable=io.StringIO):
+                self.assertRaises(SystemExit, decide_params._parse_args)
+        with mock.patch('sys.argv', ['decide_params', 'crosses',
+                                     'samples.txt', '--min-folds', '0']):
+            self.assertIsNone(decide_params._parse_args().min_folds)
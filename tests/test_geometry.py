@@ -0,0 +1,89 @@
+# Eyegrade: grading multiple choice questions with a webcam
+# Copyright (C) 2010-2018 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+import unittest
+
+import numpy as np
+
+import eyegrade.geometry as geometry
+
+
+def _random_lines(seed, num_lines, size=60):
+    rng = np.random.default_rng(seed)
+    lines = []
+    for i in range(num_lines):
+        p0 = tuple(int(c) for c in rng.integers(-size, size, 2))
+        p1 = tuple(int(c) for c in rng.integers(-size, size, 2))
+        kind = i % 4
+        if kind == 1:
+            # Vertical
+            p1 = (p0[0], p1[1])
+        elif kind == 2:
+            # Horizontal
+            p1 = (p1[0], p0[1])
+        elif kind == 3 and i % 8 == 3:
+            # Degenerate: a single point
+            p1 = p0
+        lines.append((p0, p1))
+    return lines
+
+
+class TestWalkLine(unittest.TestCase):
+
+    def test_walk_line_array_fixed(self):
+        cases = [
+            (((0, 0), (4, 2)), [0, 1, 2, 3, 4], [0, 0, 1, 1, 2]),
+            (((4, 2), (0, 0)), [0, 1, 2, 3, 4], [0, 0, 1, 1, 2]),
+            (((1, 5), (1, 2)), [1, 1, 1, 1], [2, 3, 4, 5]),
+            (((3, 7), (-1, 7)), [-1, 0, 1, 2, 3], [7, 7, 7, 7, 7]),
+            (((2, 0), (0, 5)), [2, 2, 1, 1, 0, 0], [0, 1, 2, 3, 4, 5]),
+            (((6, 6), (6, 6)), [6], [6]),
+        ]
+        for (p0, p1), expected_xs, expected_ys in cases:
+            xs, ys = geometry.walk_line_array(p0, p1)
+            self.assertEqual(xs.tolist(), expected_xs)
+            self.assertEqual(ys.tolist(), expected_ys)
+            self.assertEqual(list(zip(expected_xs, expected_ys)),
+                             list(geometry.walk_line(p0, p1)))
+
+    def test_walk_line_array(self):
+        for p0, p1 in _random_lines(1, 400):
+            xs, ys = geometry.walk_line_array(p0, p1)
+            self.assertEqual(list(zip(xs.tolist(), ys.tolist())),
+                             list(geometry.walk_line(p0, p1)))
+            # The same points as walk_line_ordered, maybe reversed
+            ordered = list(geometry.walk_line_ordered(p0, p1))
+            self.assertEqual(ordered[0], p0)
+            self.assertEqual(ordered[-1], p1)
+            self.assertEqual(sorted(ordered),
+                             sorted(zip(xs.tolist(), ys.tolist())))
+
+    def test_walk_lines_array(self):
+        lines = _random_lines(2, 200)
+        xs, ys, lengths = geometry.walk_lines_array(
+                                            [p0 for p0, p1 in lines],
+                                            [p1 for p0, p1 in lines])
+        self.assertEqual(xs.shape, (len(lines), lengths.max()))
+        self.assertEqual(ys.shape, xs.shape)
+        for (p0, p1), row_x, row_y, length in zip(lines, xs, ys, lengths):
+            expected = list(geometry.walk_line(p0, p1))
+            self.assertEqual(length, len(expected))
+            self.assertEqual(list(zip(row_x[:length].tolist(),
+                                      row_y[:length].tolist())), expected)
+            # Padded with the last point
+            self.assertTrue(np.all(row_x[length:] == expected[-1][0]))
+            self.assertTrue(np.all(row_y[length:] == expected[-1][1]))
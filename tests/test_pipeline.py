@@ -0,0 +1,253 @@
+# Eyegrade: grading multiple choice questions with a webcam
+# Copyright (C) 2010-2018 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+import os.path
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import eyegrade.detection as detection
+import eyegrade.eyegrade as eyegrade
+
+
+class FakeInterface:
+    """Runs workers and callbacks only when the test says so."""
+
+    def __init__(self):
+        self.workers = []
+        self.callbacks = []
+        self.timers = []
+
+    def run_worker(self, task, callback):
+        self.workers.append((task, callback))
+
+    def run_later(self, callback, delay=0):
+        self.callbacks.append(callback)
+
+    def register_timer(self, time_delta, callback):
+        self.timers.append((time_delta, callback))
+
+    def finish_worker(self):
+        task, callback = self.workers.pop(0)
+        task.run()
+        callback()
+
+    def run_callbacks(self):
+        while self.callbacks:
+            self.callbacks.pop(0)()
+
+
+class FakeDetector:
+    def __init__(self, number):
+        self.number = number
+        self.released = False
+
+    def release(self):
+        self.released = True
+
+
+class FakeTask:
+    def __init__(self, number, fail=False):
+        self.number = number
+        self.fail = fail
+        self.detector = None
+
+    def run(self):
+        if not self.fail:
+            self.detector = FakeDetector(self.number)
+
+
+class ClosedCameraContext:
+    """Detection context whose camera has been closed."""
+
+    def __init__(self):
+        self.buffers = detection.BufferPool()
+        self.roi = None
+        self.tracked_segments = None
+        self.gate_thumbnail = None
+
+    def capture(self):
+        return None
+
+
+class PooledFrameContext(ClosedCameraContext):
+    """Detection context that captures its frames from its pool."""
+
+    def capture(self):
+        return self.buffers.acquire((48, 64))
+
+
+class FakeReferenceCapture:
+    def __init__(self):
+        self.image_reference = np.zeros((48, 64), dtype=np.uint8)
+        self.answer_cells = []
+
+
+class TestSearchPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.interface = FakeInterface()
+        self.tasks = []
+        self.failing = set()
+        self.max_tasks = None
+        self.rendered = []
+        self.pipeline = eyegrade.SearchPipeline(self.interface,
+                                                self._create_task,
+                                                self.rendered.append)
+
+    def _create_task(self):
+        if self.max_tasks is not None and len(self.tasks) >= self.max_tasks:
+            return None
+        task = FakeTask(len(self.tasks), fail=len(self.tasks) in self.failing)
+        self.tasks.append(task)
+        return task
+
+    def _rendered_numbers(self):
+        return [detector.number for detector in self.rendered]
+
+    def test_detect_and_render(self):
+        self.pipeline.start()
+        self.assertEqual(len(self.interface.workers), 1)
+        self.interface.finish_worker()
+        # The next detection starts before the result is rendered
+        self.assertEqual(len(self.interface.workers), 1)
+        self.assertEqual(self.rendered, [])
+        self.interface.run_callbacks()
+        self.assertEqual(self._rendered_numbers(), [0])
+        self.interface.finish_worker()
+        self.interface.run_callbacks()
+        self.assertEqual(self._rendered_numbers(), [0, 1])
+        self.assertFalse(any(d.released for d in self.rendered))
+
+    def test_drop_oldest(self):
+        self.pipeline.start()
+        for i in range(4):
+            self.interface.finish_worker()
+        # Only the newest two (the depth) are still waiting
+        self.assertEqual([t.detector.released for t in self.tasks[:4]],
+                         [True, True, False, False])
+        self.interface.run_callbacks()
+        self.assertEqual(self._rendered_numbers(), [2, 3])
+
+    def test_stop_discards_results(self):
+        self.pipeline.start()
+        self.interface.finish_worker()
+        self.pipeline.stop()
+        self.assertTrue(self.tasks[0].detector.released)
+        # The detection in progress belongs to an older generation
+        self.interface.finish_worker()
+        self.assertTrue(self.tasks[1].detector.released)
+        self.interface.run_callbacks()
+        self.assertEqual(self.rendered, [])
+        self.assertEqual(self.interface.workers, [])
+
+    def test_restart_while_detecting(self):
+        self.pipeline.start()
+        self.pipeline.start()
+        # The old detection must finish before a new one is launched
+        self.assertEqual(len(self.interface.workers), 1)
+        self.interface.finish_worker()
+        self.assertTrue(self.tasks[0].detector.released)
+        self.assertEqual(len(self.interface.workers), 1)
+        self.interface.finish_worker()
+        self.interface.run_callbacks()
+        self.assertEqual(self._rendered_numbers(), [1])
+
+    def test_no_more_tasks(self):
+        self.max_tasks = 1
+        self.pipeline.start()
+        self.interface.finish_worker()
+        self.assertFalse(self.pipeline.running)
+        self.assertEqual(self.interface.workers, [])
+        self.interface.run_callbacks()
+        self.assertEqual(self.rendered, [])
+        self.assertTrue(self.tasks[0].detector.released)
+
+    def test_failed_task(self):
+        self.failing = {0}
+        self.pipeline.start()
+        self.interface.finish_worker()
+        self.assertFalse(self.pipeline.detecting)
+        self.assertEqual(self.interface.workers, [])
+        # The search is retried later, not given up
+        self.assertEqual(len(self.interface.timers), 1)
+        self.interface.timers.pop()[1]()
+        self.interface.finish_worker()
+        self.interface.run_callbacks()
+        self.assertEqual(self._rendered_numbers(), [1])
+        # No retry is scheduled after the pipeline is stopped
+        self.failing = {2}
+        self.pipeline.stop()
+        self.pipeline.start()
+        self.pipeline.stop()
+        self.interface.finish_worker()
+        self.assertEqual(self.interface.timers, [])
+
+
+class TestImageDetectTask(unittest.TestCase):
+
+    def _options(self):
+        options = detection.ExamDetector.get_default_options()
+        options['error-logging'] = False
+        return options
+
+    def test_camera_closed(self):
+        task = eyegrade.ImageDetectTask(((3, 5), ), ClosedCameraContext(),
+                                        self._options())
+        task.run()
+        self.assertIsNone(task.detector)
+
+    def test_capture_file_missing(self):
+        options = self._options()
+        options['capture-from-file'] = True
+        options['capture-raw-file'] = os.path.join(
+                        os.path.dirname(os.path.abspath(__file__)),
+                        'missing.png')
+        task = eyegrade.ImageDetectTask(((3, 5), ), ClosedCameraContext(),
+                                        options)
+        task.run()
+        self.assertIsNone(task.detector)
+
+
+class TestImageChangeTask(unittest.TestCase):
+
+    def _options(self):
+        options = detection.ExamDetector.get_default_options()
+        options['error-logging'] = False
+        return options
+
+    def test_camera_closed(self):
+        task = eyegrade.ImageChangeTask(((3, 5), ), ClosedCameraContext(),
+                                        self._options(),
+                                        FakeReferenceCapture())
+        task.run()
+        self.assertFalse(task.exam_detected)
+        self.assertFalse(task.frame_changed)
+
+    def test_comparison_fails(self):
+        context = PooledFrameContext()
+        task = eyegrade.ImageChangeTask(((3, 5), ), context, self._options(),
+                                        FakeReferenceCapture())
+        with mock.patch.object(detection, 'compare_frames',
+                               side_effect=ValueError('broken frame')):
+            task.run()
+        self.assertFalse(task.exam_detected)
+        self.assertFalse(task.frame_changed)
+        # The frame went back to the pool
+        self.assertEqual(sum(len(free) for free
+                             in context.buffers._free.values()), 1)
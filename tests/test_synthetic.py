@@ -0,0 +1,92 @@
+# Eyegrade: grading multiple choice questions with a webcam
+# Copyright (C) 2010-2019 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+#
+import os.path
+import tempfile
+import unittest
+import unittest.mock as mock
+
+import numpy as np
+
+import eyegrade.detection as detection
+import eyegrade.images as images
+import eyegrade.tools.synthetic as synthetic
+
+# Other test modules replace read_infobits while they run
+_read_infobits = detection.read_infobits
+
+
+class TestSyntheticSheets(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(detection, 'read_infobits',
+                                    _read_infobits)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_deterministic(self):
+        image_1, truth_1 = synthetic.random_sheet([(3, 5), (3, 4)], 9, seed=7)
+        image_2, truth_2 = synthetic.random_sheet([(3, 5), (3, 4)], 9, seed=7)
+        image_3, truth_3 = synthetic.random_sheet([(3, 5), (3, 4)], 9, seed=8)
+        self.assertTrue(np.array_equal(image_1, image_2))
+        self.assertEqual(truth_1.to_dict(), truth_2.to_dict())
+        self.assertFalse(np.array_equal(image_1, image_3))
+
+    def test_truth(self):
+        options = synthetic.get_default_options()
+        options['width'] = 800
+        options['height'] = 600
+        image, truth = synthetic.render_sheet([(4, 3), (4, 2)], 'C',
+                                              [1, 0, 4, 2, 3], '0123',
+                                              options, seed=1)
+        self.assertEqual(images.width(image), 800)
+        self.assertEqual(images.height(image), 600)
+        self.assertEqual(truth.answers, [1, 0, 4, 2, 3])
+        self.assertEqual(truth.student_id, '0123')
+        self.assertEqual(len(truth.tables), 2)
+        for corners in truth.tables:
+            self.assertEqual(len(corners), 4)
+            for x, y in corners:
+                self.assertTrue(0 <= x < 800 and 0 <= y < 600)
+        # Wrong number of answers
+        self.assertRaises(ValueError, synthetic.render_sheet, [(4, 3)], 'A',
+                          [1, 2], None)
+
+    def test_corpus(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            corpus = synthetic.generate_corpus(dirname, 3, [(3, 5)], seed=2)
+            read = synthetic.read_corpus(dirname)
+            self.assertEqual(len(read), 3)
+            for (filename, truth), (read_filename, read_truth) \
+                    in zip(corpus, read):
+                self.assertEqual(filename, read_filename)
+                self.assertTrue(os.path.isfile(filename))
+                self.assertEqual(truth.to_dict(), read_truth.to_dict())
+
+    def test_detect_synthetic(self):
+        dimensions = [(3, 5)]
+        image, truth = synthetic.random_sheet(dimensions, seed=1)
+        options = detection.ExamDetector.get_default_options()
+        for th in detection.param_hough_thresholds:
+            context = detection.ExamDetectorContext(fixed_hough_threshold=th)
+            detector = detection.ExamDetector(dimensions, context, options,
+                                              image_raw=image)
+            if detector.detect():
+                break
+        self.assertTrue(detector.success)
+        self.assertEqual(detector.decisions.answers, truth.answers)
+        self.assertEqual(detector.decisions.model, truth.model)